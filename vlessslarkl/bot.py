@@ -14,15 +14,28 @@ import qrcode
 import hashlib
 import random
 import re
+import threading
+import functools
+import itertools
+import time
+import bisect
+import inspect
+import html
+import gzip
+import shutil
+import tempfile
 from datetime import datetime, timedelta
 from decimal import Decimal, ROUND_HALF_UP
 from io import BytesIO
-from typing import List, Dict, Optional, Tuple, Any
+from typing import List, Dict, Set, Optional, Tuple, Any, Callable, ClassVar, Sequence
 from urllib.parse import urlparse, quote
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
+from dataclasses import dataclass, field, fields, replace
+from concurrent.futures import ThreadPoolExecutor
 
 import aiohttp
-from aiogram import Bot, Dispatcher, Router, F, types
+from yarl import URL
+from aiogram import Bot, Dispatcher, Router, F, types, BaseMiddleware
 from aiogram.filters import CommandStart, Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -31,7 +44,7 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import (
-    InlineKeyboardMarkup, BufferedInputFile, Message,
+    InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile, Message,
     ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
 )
 
@@ -46,12 +59,25 @@ TELEGRAM_BOT_USERNAME = os.getenv("TELEGRAM_BOT_USERNAME", "")
 
 # Платежные системы
 CRYPTOBOT_TOKEN = os.getenv("CRYPTOBOT_TOKEN", "")
+# Сколько раз фоновая проверка повторяет выдачу ключа по платежу в статусе 'error'
+# и пауза перед повтором (удваивается с каждой попыткой)
+PAYMENT_RETRY_LIMIT = int(os.getenv("PAYMENT_RETRY_LIMIT", "5"))
+PAYMENT_RETRY_DELAY_SEC = int(os.getenv("PAYMENT_RETRY_DELAY_SEC", "60"))
 
 # X-UI Настройки
 DEFAULT_XUI_HOST = os.getenv("DEFAULT_XUI_HOST", "")
 DEFAULT_XUI_USERNAME = os.getenv("DEFAULT_XUI_USERNAME", "admin")
 DEFAULT_XUI_PASSWORD = os.getenv("DEFAULT_XUI_PASSWORD", "")
 DEFAULT_XUI_INBOUND_ID = int(os.getenv("DEFAULT_XUI_INBOUND_ID", "1"))
+XUI_REQUEST_TIMEOUT_SEC = int(os.getenv("XUI_REQUEST_TIMEOUT_SEC", "30"))
+XUI_CONN_LIMIT_PER_HOST = int(os.getenv("XUI_CONN_LIMIT_PER_HOST", "8"))
+XUI_KEEPALIVE_SEC = int(os.getenv("XUI_KEEPALIVE_SEC", "60"))
+XUI_DNS_CACHE_TTL_SEC = int(os.getenv("XUI_DNS_CACHE_TTL_SEC", "300"))
+XUI_SESSION_TTL_SEC = int(os.getenv("XUI_SESSION_TTL_SEC", "3600"))
+# Окно, за которое изменения клиентов одного инбаунда собираются в одну запись
+XUI_WRITE_FLUSH_MS = int(os.getenv("XUI_WRITE_FLUSH_MS", "50"))
+# Через сколько секунд метаданные инбаунда (порт, streamSettings) обновляются в фоне
+XUI_INBOUND_CACHE_TTL_SEC = int(os.getenv("XUI_INBOUND_CACHE_TTL_SEC", "600"))
 
 # Текстовые настройки
 ABOUT_TEXT = os.getenv("ABOUT_TEXT", "VPN сервис для безопасного интернета")
@@ -75,6 +101,40 @@ REFERRAL_PERCENTAGE = float(os.getenv("REFERRAL_PERCENTAGE", "10"))
 REFERRAL_DISCOUNT = float(os.getenv("REFERRAL_DISCOUNT", "10"))
 MINIMUM_WITHDRAWAL = float(os.getenv("MINIMUM_WITHDRAWAL", "100"))
 
+# База данных
+DB_PATH = os.getenv("DB_PATH", "vless_bot.db")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE_MB = int(os.getenv("DB_MMAP_SIZE_MB", "256"))
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))
+DB_REPORT_WORKERS = int(os.getenv("DB_REPORT_WORKERS", "1"))
+# Запросы дольше порога (мс) пишутся в лог: SQL и число параметров, без их значений
+DB_SLOW_QUERY_MS = int(os.getenv("DB_SLOW_QUERY_MS", "200"))
+
+# Хранение истории: строки старше срока (в днях, 0 - хранить всегда) переносятся в архивную базу
+DB_ARCHIVE_PATH = os.getenv("DB_ARCHIVE_PATH", os.path.splitext(DB_PATH)[0] + "_archive.db")
+ADMIN_LOGS_RETENTION_DAYS = int(os.getenv("ADMIN_LOGS_RETENTION_DAYS", "90"))
+TRANSACTIONS_RETENTION_DAYS = int(os.getenv("TRANSACTIONS_RETENTION_DAYS", "365"))
+CRYPTO_PAYMENTS_RETENTION_DAYS = int(os.getenv("CRYPTO_PAYMENTS_RETENTION_DAYS", "180"))
+BROADCASTS_RETENTION_DAYS = int(os.getenv("BROADCASTS_RETENTION_DAYS", "180"))
+SUPPORT_MESSAGES_RETENTION_DAYS = int(os.getenv("SUPPORT_MESSAGES_RETENTION_DAYS", "180"))
+DB_ARCHIVE_BATCH_SIZE = int(os.getenv("DB_ARCHIVE_BATCH_SIZE", "500"))
+DB_VACUUM_STEP_PAGES = int(os.getenv("DB_VACUUM_STEP_PAGES", "256"))
+DB_MAINTENANCE_INTERVAL_SEC = int(os.getenv("DB_MAINTENANCE_INTERVAL_SEC", "3600"))
+
+# Резервные копии SQLite: каталог, период (0 - отключены), сколько наборов архивов хранить
+DB_BACKUP_DIR = os.getenv("DB_BACKUP_DIR", "backups")
+DB_BACKUP_INTERVAL_SEC = int(os.getenv("DB_BACKUP_INTERVAL_SEC", "86400"))
+DB_BACKUP_KEEP = int(os.getenv("DB_BACKUP_KEEP", "7"))
+
+# Хранилище: sqlite (по умолчанию) или postgres для нескольких экземпляров бота на одной базе
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlite").lower()
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+PG_POOL_MIN_SIZE = int(os.getenv("PG_POOL_MIN_SIZE", "2"))
+PG_POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE", "10"))
+# Часовой пояс сессии: границы "сегодня" в отчетах, как localtime в SQLite
+PG_TIMEZONE = os.getenv("PG_TIMEZONE", os.getenv("TZ", "UTC"))
+
 # === СОСТОЯНИЯ FSM ===
 class Form(StatesGroup):
     # Админ состояния
@@ -91,6 +151,7 @@ class Form(StatesGroup):
     waiting_for_add_plan = State()
     waiting_for_edit_plan = State()
     waiting_for_delete_plan = State()
+    waiting_for_withdrawal_reject_reason = State()
     waiting_for_edit_setting = State()
     waiting_for_test_xui = State()
     
@@ -99,15 +160,600 @@ class Form(StatesGroup):
     waiting_for_support_message = State()
 
 # === БАЗА ДАННЫХ ===
+def cached_read(method):
+    """Помечает метод Database, который отвечает из памяти без обращения к SQLite"""
+    method.cached_read = True
+    return method
+
+def report_read(method):
+    """Помечает отчетный метод Database: он читает согласованный снимок через read-only соединение
+    в отдельном пуле потоков и не занимает соединения и потоки записи"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        # Вложенный отчет читает тот же снимок, а внутри transaction() нужны незафиксированные записи
+        if getattr(self._local, 'in_report', False) or getattr(self._local, 'in_transaction', False):
+            return method(self, *args, **kwargs)
+        conn = self._report_connection()
+        conn.execute("BEGIN")
+        self._local.in_report = True
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._local.in_report = False
+            conn.rollback()
+    
+    wrapper.report_read = True
+    return wrapper
+
+# === ДИАГНОСТИКА ЗАПРОСОВ ===
+# Верхние границы корзин гистограммы времени вызова, мс
+LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+# Запросы, для которых имеет смысл EXPLAIN; реестр ограничен, если SQL собирается динамически
+EXPLAINABLE_KEYWORDS = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT', 'REPLACE')
+MAX_REGISTERED_STATEMENTS = 1000
+
+@dataclass
+class MethodStats:
+    """Число вызовов и гистограмма времени одного метода хранилища"""
+    name: str
+    calls: int = 0
+    errors: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+    buckets: List[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS_MS) + 1))
+    
+    def percentile(self, fraction: float) -> float:
+        """Верхняя граница корзины, в которую попадает доля fraction вызовов"""
+        threshold = self.calls * fraction
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= threshold:
+                return bound
+        return self.max_ms
+
+class QueryStats:
+    """Метрики хранилища: время методов и реестр выполненных SQL-запросов для EXPLAIN.
+    Обновляется из потоков пула базы, поэтому все изменения под блокировкой"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._methods: Dict[str, MethodStats] = {}
+        # SQL -> параметры последнего выполнения
+        self._statements: Dict[str, Any] = {}
+    
+    def observe(self, name: str, seconds: float, failed: bool = False):
+        elapsed_ms = seconds * 1000
+        bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)
+        with self._lock:
+            stats = self._methods.get(name)
+            if stats is None:
+                stats = self._methods[name] = MethodStats(name)
+            stats.calls += 1
+            stats.errors += failed
+            stats.total_ms += elapsed_ms
+            stats.max_ms = max(stats.max_ms, elapsed_ms)
+            stats.buckets[bucket] += 1
+    
+    def methods(self) -> List[MethodStats]:
+        """Копия статистики методов, самые затратные по суммарному времени первыми"""
+        with self._lock:
+            snapshot = [replace(stats, buckets=list(stats.buckets)) for stats in self._methods.values()]
+        return sorted(snapshot, key=lambda stats: stats.total_ms, reverse=True)
+    
+    def record_query(self, sql: str, params, seconds: float):
+        """Запоминает запрос для EXPLAIN и пишет в лог запросы дольше DB_SLOW_QUERY_MS.
+        Значения параметров в лог не попадают: среди них пароли панелей, реквизиты выплат
+        и тексты пользователей"""
+        elapsed_ms = seconds * 1000
+        if elapsed_ms >= DB_SLOW_QUERY_MS:
+            logger.warning(f"Медленный запрос {elapsed_ms:.0f} мс: {' '.join(sql.split())} | "
+                           f"параметров: {len(params) if params else 0}")
+        
+        statement = sql.strip()
+        if not statement or statement.split(None, 1)[0].upper() not in EXPLAINABLE_KEYWORDS:
+            return
+        with self._lock:
+            if statement in self._statements or len(self._statements) < MAX_REGISTERED_STATEMENTS:
+                self._statements[statement] = params
+    
+    def statements(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._statements)
+    
+    def clear_statements(self):
+        with self._lock:
+            self._statements.clear()
+
+query_stats = QueryStats()
+# Время запросов к X-UI панелям (вход отдельно от остальных запросов)
+xui_stats = QueryStats()
+
+def timed(name: str, method):
+    """Замеряет время каждого вызова метода (обычного или корутины) в query_stats"""
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            failed = False
+            try:
+                return await method(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                query_stats.observe(name, time.perf_counter() - started, failed)
+        return async_wrapper
+    
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        failed = False
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            query_stats.observe(name, time.perf_counter() - started, failed)
+    return wrapper
+
+def instrumented(cls):
+    """Оборачивает замером времени все публичные методы хранилища. Пометки cached_read
+    и report_read переносятся на обертку вместе с __dict__ метода"""
+    for name, method in list(vars(cls).items()):
+        if callable(method) and not name.startswith('_') and name not in ('connect', 'close', 'transaction'):
+            setattr(cls, name, timed(name, method))
+    return cls
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Курсор SQLite, который передает каждый запрос с параметрами в query_stats"""
+    
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            query_stats.record_query(sql, parameters, time.perf_counter() - started)
+    
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            query_stats.record_query(sql, None, time.perf_counter() - started)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого InstrumentedCursor, включая неявные в conn.execute()"""
+    
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def sqlite_full_scans(plan: List[str], sql: str = '') -> List[str]:
+    """Таблицы (или их псевдонимы), которые план EXPLAIN QUERY PLAN читает целиком без индекса.
+    Обход материализованных CTE и подзапросов полным сканированием не считается, как и обход
+    внешней таблицы запроса sql без WHERE, с LIMIT и без сортировки во временном B-дереве:
+    строки идут уже в порядке ORDER BY, и чтение останавливается на LIMIT"""
+    derived = {line.split()[-1] for line in plan if line.startswith(('MATERIALIZE', 'CO-ROUTINE'))}
+    ordered_limit = (re.search(r'\bLIMIT\b', sql, re.IGNORECASE) and not re.search(r'\bWHERE\b', sql, re.IGNORECASE)
+                     and not any('TEMP B-TREE' in line for line in plan))
+    scans = []
+    for line in plan:
+        match = re.fullmatch(r'SCAN (\S+)', line)
+        if not match or match.group(1) in derived:
+            continue
+        if ordered_limit:
+            ordered_limit = False
+            continue
+        scans.append(match.group(1))
+    return scans
+
+# Время в базе хранится целыми Unix epoch (секунды, UTC), чтобы фильтры шли по индексам
+SQL_NOW = "CAST(strftime('%s', 'now') AS INTEGER)"
+SQL_TODAY_START = "CAST(strftime('%s', 'now', 'localtime', 'start of day', 'utc') AS INTEGER)"
+
+def sql_days_left(column: str) -> str:
+    """SQL-выражение: сколько полных дней осталось до epoch в column (не меньше 0)"""
+    return f"MAX(0, ({column} - {SQL_NOW}) / 86400)"
+
+def sql_since(seconds_param: str = "?") -> str:
+    """SQL-выражение: epoch момента, отстоящего назад от текущего на seconds_param секунд"""
+    return f"({SQL_NOW} - {seconds_param})"
+
+PAGE_SIZE = 10
+
+UUID_PATTERN = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', re.IGNORECASE)
+
+# === СТРОКИ БАЗЫ ===
+def decode_json(value) -> Dict:
+    return json.loads(value) if value else {}
+
+class Row:
+    """Базовый класс строк: поля читаются как атрибуты, а row['field'] и row.get()
+    оставлены для кода, который обращается к строке как к словарю"""
+    __slots__ = ()
+    
+    # Поле -> функция, которая один раз декодирует значение из базы при сборке строки
+    DECODERS: ClassVar[Dict[str, Callable]] = {}
+    
+    def __getitem__(self, name: str):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+    
+    def get(self, name: str, default=None):
+        return getattr(self, name, default)
+
+@dataclass(slots=True)
+class UserRow(Row):
+    telegram_id: int
+    username: Optional[str] = None
+    full_name: Optional[str] = None
+    trial_used: bool = False
+    total_spent: float = 0.0
+    total_months: int = 0
+    referred_by: Optional[int] = None
+    referral_balance: float = 0.0
+    is_banned: bool = False
+    language: Optional[str] = None
+    created_at: Optional[str] = None
+    created_ts: Optional[int] = None
+    # Заполняются только выборками со счетчиками (_with_user_counts)
+    key_count: Optional[int] = None
+    active_key_count: Optional[int] = None
+    referral_count: Optional[int] = None
+    
+    DECODERS: ClassVar[Dict[str, Callable]] = {'trial_used': bool, 'is_banned': bool}
+
+@dataclass(slots=True)
+class KeyRow(Row):
+    key_id: int
+    user_id: int
+    host_name: str
+    xui_client_uuid: str
+    key_email: str
+    expiry_date: Optional[str] = None
+    is_active: bool = True
+    created_date: Optional[str] = None
+    expiry_ts: Optional[int] = None
+    created_ts: Optional[int] = None
+    # Вычисляются в запросе на момент чтения
+    days_left: Optional[int] = None
+    is_expired: bool = False
+    # Владелец ключа в выборках с JOIN users
+    username: Optional[str] = None
+    full_name: Optional[str] = None
+    
+    DECODERS: ClassVar[Dict[str, Callable]] = {'is_active': bool, 'is_expired': bool}
+
+@dataclass(frozen=True, slots=True)
+class HostRow(Row):
+    host_id: int
+    host_name: str
+    host_url: str
+    host_username: str
+    host_pass: str
+    host_inbound_id: int
+    is_active: bool = True
+    created_at: Optional[str] = None
+    
+    DECODERS: ClassVar[Dict[str, Callable]] = {'is_active': bool}
+
+@dataclass(frozen=True, slots=True)
+class PlanRow(Row):
+    plan_id: int
+    host_name: str
+    plan_name: str
+    months: int
+    price: float
+    is_active: bool = True
+    created_at: Optional[str] = None
+    
+    DECODERS: ClassVar[Dict[str, Callable]] = {'is_active': bool}
+
+@dataclass(slots=True)
+class PaymentRow(Row):
+    invoice_id: str
+    user_id: int
+    plan_id: Optional[int] = None
+    key_id: Optional[int] = None
+    amount: Optional[float] = None
+    asset: Optional[str] = None
+    status: str = 'pending'
+    metadata: Dict = None
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
+    created_ts: Optional[int] = None
+    # Порядок вставки для keyset-пагинации: rowid в SQLite, payment_seq в PostgreSQL
+    rowid: Optional[int] = None
+    payment_seq: Optional[int] = None
+    # Пользователь и тариф в выборках с JOIN
+    username: Optional[str] = None
+    full_name: Optional[str] = None
+    plan_name: Optional[str] = None
+    host_name: Optional[str] = None
+    
+    DECODERS: ClassVar[Dict[str, Callable]] = {'metadata': decode_json}
+
+@functools.lru_cache(maxsize=256)
+def row_builder(row_type: type, columns: Tuple[str, ...]) -> Callable[[Sequence], Row]:
+    """Сборщик row_type из значений строки запроса с колонками columns.
+    Колонки сопоставляются с полями один раз на форму запроса, а не на каждую строку;
+    лишние колонки пропускаются, отсутствующие поля получают None"""
+    positions = {name: index for index, name in enumerate(columns)}
+    plan = [(positions.get(field.name), row_type.DECODERS.get(field.name)) for field in fields(row_type)]
+    
+    def build(values: Sequence) -> Row:
+        return row_type(*[
+            None if index is None else decode(values[index]) if decode else values[index]
+            for index, decode in plan
+        ])
+    return build
+
+def fetch_rows(cursor: sqlite3.Cursor, row_type: type) -> List[Row]:
+    build = row_builder(row_type, tuple(column[0] for column in cursor.description))
+    return [build(values) for values in cursor.fetchall()]
+
+def fetch_row(cursor: sqlite3.Cursor, row_type: type) -> Optional[Row]:
+    values = cursor.fetchone()
+    if values is None:
+        return None
+    return row_builder(row_type, tuple(column[0] for column in cursor.description))(values)
+
+def record_rows(records: list, row_type: type) -> List[Row]:
+    """То же для записей asyncpg: имена колонок берутся из первой записи"""
+    if not records:
+        return []
+    build = row_builder(row_type, tuple(records[0].keys()))
+    return [build(record) for record in records]
+
+def record_row(record, row_type: type) -> Optional[Row]:
+    return row_builder(row_type, tuple(record.keys()))(record) if record else None
+
+@dataclass
+class Page:
+    """Страница keyset-пагинации: строки и ключи для перехода к соседним страницам"""
+    items: List[Dict]
+    next_key: Optional[tuple] = None
+    prev_key: Optional[tuple] = None
+
+@dataclass(frozen=True)
+class Catalog:
+    """Снимок хостов и тарифов в памяти; заменяется целиком при любом изменении каталога"""
+    version: int
+    hosts: Dict[str, HostRow]
+    hosts_by_id: Dict[int, HostRow]
+    active_hosts: Tuple[HostRow, ...]
+    plans: Dict[int, PlanRow]
+    active_plans: Tuple[PlanRow, ...]
+    plans_by_host: Dict[str, Tuple[PlanRow, ...]]
+
+def build_catalog(version: int, hosts: List[HostRow], plans: List[PlanRow]) -> Catalog:
+    """Собирает снимок каталога из всех хостов и всех тарифов (plans отсортированы по цене).
+    Строки неизменяемы, поэтому геттеры отдают их из снимка без копирования"""
+    active_plans = tuple(plan for plan in plans if plan.is_active)
+    plans_by_host: Dict[str, List[PlanRow]] = {}
+    for plan in active_plans:
+        plans_by_host.setdefault(plan.host_name, []).append(plan)
+    
+    return Catalog(
+        version=version,
+        hosts={host.host_name: host for host in hosts},
+        hosts_by_id={host.host_id: host for host in hosts},
+        active_hosts=tuple(host for host in hosts if host.is_active),
+        plans={plan.plan_id: plan for plan in plans},
+        active_plans=active_plans,
+        plans_by_host={name: tuple(items) for name, items in plans_by_host.items()},
+    )
+
+def keyset_page_query(select: str, where: Optional[str], params: tuple, sort_columns: Tuple[str, ...],
+                      key: Optional[tuple], backward: bool, limit: int) -> Tuple[str, list, str]:
+    """Запрос keyset-страницы выборки, отсортированной по убыванию sort_columns.
+    
+    key - ключ крайней строки соседней страницы: без backward берутся строки после него,
+    с backward - перед ним. Условие по ключу идет по индексу, поэтому любая страница
+    стоит столько же, сколько первая. Возвращает запрос, параметры и ORDER BY.
+    """
+    conditions = [where] if where else []
+    args = list(params)
+    columns = ', '.join(sort_columns)
+    if key is not None:
+        placeholders = ', '.join('?' * len(key))
+        conditions.append(f"({columns}) {'>' if backward else '<'} ({placeholders})")
+        args.extend(key)
+    
+    direction = 'ASC' if backward else 'DESC'
+    order = ', '.join(f"{column} {direction}" for column in sort_columns)
+    query = select
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += f" ORDER BY {order} LIMIT ?"
+    args.append(limit + 1)
+    return query, args, order
+
+def keyset_page(rows: List[Dict], sort_columns: Tuple[str, ...], key: Optional[tuple],
+                backward: bool, limit: int) -> Page:
+    """Page из строк keyset_page_query (их на одну больше limit, если есть следующая страница)"""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    
+    fields = [column.split('.')[-1] for column in sort_columns]
+    first_key = tuple(rows[0][field] for field in fields) if rows else None
+    last_key = tuple(rows[-1][field] for field in fields) if rows else None
+    
+    if backward:
+        return Page(rows, next_key=last_key if key is not None else None, prev_key=first_key if has_more else None)
+    return Page(rows, next_key=last_key if has_more else None, prev_key=first_key if key is not None else None)
+
+# Счетчики дашборда, которые ведут триггеры: таблица -> {счетчик: вклад строки {row}}
+STATS_COUNTER_SOURCES = {
+    'users': {
+        'users': "1",
+        'banned_users': "{row}.is_banned = 1",
+        'total_spent': "{row}.total_spent",
+    },
+    'user_keys': {'keys': "1"},
+    'crypto_payments': {'pending_payments': "{row}.status = 'pending'"},
+    'referral_withdrawals': {'pending_withdrawals': "{row}.status = 'pending'"},
+    'hosts': {'hosts': "{row}.is_active = 1"},
+    'plans': {'plans': "{row}.is_active = 1"},
+}
+
+# Политики хранения: таблица -> (колонка даты, какие строки можно архивировать, срок в днях)
+RETENTION_POLICIES = {
+    'admin_logs': ('created_at', "TRUE", ADMIN_LOGS_RETENTION_DAYS),
+    'transactions': ('created_date', "TRUE", TRANSACTIONS_RETENTION_DAYS),
+    'crypto_payments': ('created_at', "status NOT IN ('pending', 'processing')", CRYPTO_PAYMENTS_RETENTION_DAYS),
+    'broadcasts': ('created_at', "status = 'completed'", BROADCASTS_RETENTION_DAYS),
+    'support_messages': ('created_at', "status = 'closed'", SUPPORT_MESSAGES_RETENTION_DAYS),
+}
+
+# Настройки, которые создаются в пустой базе
+DEFAULT_SETTINGS = [
+    ("bot_name", "VLESS VPN Bot"),
+    ("bot_username", TELEGRAM_BOT_USERNAME),
+    ("admin_id", str(ADMIN_ID)),
+    ("trial_enabled", "true" if TRIAL_ENABLED else "false"),
+    ("trial_duration_days", str(TRIAL_DURATION_DAYS)),
+    ("enable_referrals", "true" if ENABLE_REFERRALS else "false"),
+    ("referral_percentage", str(REFERRAL_PERCENTAGE)),
+    ("referral_discount", str(REFERRAL_DISCOUNT)),
+    ("minimum_withdrawal", str(MINIMUM_WITHDRAWAL)),
+    ("cryptobot_token", CRYPTOBOT_TOKEN),
+    ("about_text", ABOUT_TEXT),
+    ("support_text", SUPPORT_TEXT),
+    ("support_user", SUPPORT_USER),
+    ("channel_url", CHANNEL_URL),
+    ("terms_url", TERMS_URL),
+    ("privacy_url", PRIVACY_URL),
+    ("android_url", ANDROID_URL),
+    ("ios_url", IOS_URL),
+    ("windows_url", WINDOWS_URL),
+    ("linux_url", LINUX_URL),
+    ("default_xui_host", DEFAULT_XUI_HOST),
+    ("default_xui_username", DEFAULT_XUI_USERNAME),
+    ("default_xui_password", DEFAULT_XUI_PASSWORD),
+    ("default_xui_inbound_id", str(DEFAULT_XUI_INBOUND_ID))
+]
+
+# Тарифы хоста по умолчанию (DEFAULT_XUI_HOST): хост, название, месяцев, цена
+DEFAULT_PLANS = [
+    ("Default Server", "1 Month", 1, 300),
+    ("Default Server", "3 Months", 3, 800),
+    ("Default Server", "6 Months", 6, 1500),
+    ("Default Server", "12 Months", 12, 2800)
+]
+
+@instrumented
 class Database:
-    def __init__(self, db_path="vless_bot.db"):
+    def __init__(self, db_path=DB_PATH, archive_path=DB_ARCHIVE_PATH):
         self.db_path = db_path
+        self.archive_path = archive_path
+        # Одно долгоживущее соединение на поток: открывается при первом обращении
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._settings: Dict[str, str] = {}
+        self._catalog: Optional[Catalog] = None
+        self._catalog_lock = threading.Lock()
+        self._check_auto_vacuum()
         self._init_db()
+        self._run_migrations()
+        self.reload_settings()
+        self.reload_catalog()
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                               factory=InstrumentedConnection)
+        conn.row_factory = sqlite3.Row
+        # Для новой базы режим auto_vacuum действует, только если задан до включения WAL
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE_MB * 1024 * 1024}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        # INSERT OR REPLACE должен запускать DELETE-триггеры счетчиков для вытесненной строки
+        conn.execute("PRAGMA recursive_triggers = ON")
+        conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        # Архив тоже в WAL: читатель резервной копии не блокирует перенос строк в архив
+        conn.execute("PRAGMA archive.journal_mode = WAL")
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+    
+    def _check_auto_vacuum(self):
+        """Новая база создается с auto_vacuum=INCREMENTAL. Существующую переводит только
+        оператор (python bot.py vacuum): полный VACUUM блокирует базу на время копирования"""
+        with self._get_connection() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                return
+        logger.warning(
+            "База без auto_vacuum=INCREMENTAL: место после архивации не возвращается файлу. "
+            "Остановите бота и выполните: python bot.py vacuum"
+        )
+    
+    def _report_connection(self) -> sqlite3.Connection:
+        """Read-only соединение потока для отчетов: читатель WAL не мешает записи"""
+        conn = getattr(self._local, 'report_conn', None)
+        if conn is None:
+            uri = f"file:{quote(os.path.abspath(self.db_path))}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                                   factory=InstrumentedConnection)
+            conn.row_factory = sqlite3.Row
+            conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+            conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+            conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE_MB * 1024 * 1024}")
+            conn.execute("PRAGMA temp_store = MEMORY")
+            conn.execute("PRAGMA query_only = ON")
+            with self._connections_lock:
+                self._connections.append(conn)
+            self._local.report_conn = conn
+        return conn
+    
+    def _thread_connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
     
     @contextmanager
     def _get_connection(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        if getattr(self._local, 'in_report', False):
+            # Внутри report_read все запросы идут в снимок read-only соединения
+            yield self._local.report_conn
+            return
+        conn = self._thread_connection()
+        if getattr(self._local, 'in_transaction', False):
+            # Внутри transaction() фиксацией управляет внешний блок
+            yield conn
+            return
+        try:
+            yield conn
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+    
+    @contextmanager
+    def transaction(self):
+        """Единица работы: методы, вызванные внутри блока, пишут в одну транзакцию с одним commit"""
+        conn = self._thread_connection()
+        if getattr(self._local, 'in_transaction', False):
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.in_transaction = True
         try:
             yield conn
             conn.commit()
@@ -115,7 +761,17 @@ class Database:
             conn.rollback()
             raise
         finally:
-            conn.close()
+            self._local.in_transaction = False
+    
+    def close(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
     
     def _init_db(self):
         with self._get_connection() as conn:
@@ -285,34 +941,7 @@ class Database:
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions(created_date)')
             
             # Добавляем настройки по умолчанию
-            default_settings = [
-                ("bot_name", "VLESS VPN Bot"),
-                ("bot_username", TELEGRAM_BOT_USERNAME),
-                ("admin_id", str(ADMIN_ID)),
-                ("trial_enabled", "true" if TRIAL_ENABLED else "false"),
-                ("trial_duration_days", str(TRIAL_DURATION_DAYS)),
-                ("enable_referrals", "true" if ENABLE_REFERRALS else "false"),
-                ("referral_percentage", str(REFERRAL_PERCENTAGE)),
-                ("referral_discount", str(REFERRAL_DISCOUNT)),
-                ("minimum_withdrawal", str(MINIMUM_WITHDRAWAL)),
-                ("cryptobot_token", CRYPTOBOT_TOKEN),
-                ("about_text", ABOUT_TEXT),
-                ("support_text", SUPPORT_TEXT),
-                ("support_user", SUPPORT_USER),
-                ("channel_url", CHANNEL_URL),
-                ("terms_url", TERMS_URL),
-                ("privacy_url", PRIVACY_URL),
-                ("android_url", ANDROID_URL),
-                ("ios_url", IOS_URL),
-                ("windows_url", WINDOWS_URL),
-                ("linux_url", LINUX_URL),
-                ("default_xui_host", DEFAULT_XUI_HOST),
-                ("default_xui_username", DEFAULT_XUI_USERNAME),
-                ("default_xui_password", DEFAULT_XUI_PASSWORD),
-                ("default_xui_inbound_id", str(DEFAULT_XUI_INBOUND_ID))
-            ]
-            
-            for key, value in default_settings:
+            for key, value in DEFAULT_SETTINGS:
                 cursor.execute('''
                     INSERT OR IGNORE INTO settings (key, value) 
                     VALUES (?, ?)
@@ -328,35 +957,286 @@ class Database:
                     ''', ("Default Server", DEFAULT_XUI_HOST, DEFAULT_XUI_USERNAME, DEFAULT_XUI_PASSWORD, DEFAULT_XUI_INBOUND_ID))
                     
                     # Добавляем дефолтные планы
-                    default_plans = [
-                        ("Default Server", "1 Month", 1, 300),
-                        ("Default Server", "3 Months", 3, 800),
-                        ("Default Server", "6 Months", 6, 1500),
-                        ("Default Server", "12 Months", 12, 2800)
-                    ]
-                    
-                    for plan in default_plans:
+                    for plan in DEFAULT_PLANS:
                         cursor.execute('''
                             INSERT INTO plans (host_name, plan_name, months, price)
                             VALUES (?, ?, ?, ?)
                         ''', plan)
     
+    # === МИГРАЦИИ ===
+    def _get_migrations(self) -> List[Tuple[int, str, Callable]]:
+        """Миграции схемы по порядку версий. Каждая должна быть идемпотентной"""
+        return [
+            (1, "epoch timestamp columns", self._migrate_epoch_columns),
+            (2, "hot path indexes", self._migrate_hot_path_indexes),
+            (3, "stats counters", self._migrate_stats_counters),
+            (4, "daily revenue rollup", self._migrate_revenue_daily),
+            (5, "pagination indexes", self._migrate_pagination_indexes),
+            (6, "user search index", self._migrate_users_fts),
+            (7, "retention indexes", self._migrate_retention_indexes),
+            (8, "user list indexes", self._migrate_user_list_indexes),
+        ]
+    
+    def _run_migrations(self):
+        """Применяет недостающие миграции, каждую в отдельной транзакции BEGIN IMMEDIATE"""
+        with self._get_connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.commit()
+            applied = {row[0] for row in conn.execute("SELECT version FROM schema_version")}
+            
+            for version, name, migrate in self._get_migrations():
+                if version in applied:
+                    continue
+                
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    # Перепроверяем под блокировкой: миграцию мог успеть применить другой процесс
+                    if conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone():
+                        conn.rollback()
+                        continue
+                    migrate(conn.cursor())
+                    conn.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (version, name))
+                    conn.commit()
+                except:
+                    conn.rollback()
+                    raise
+                logger.info(f"Применена миграция схемы {version}: {name}")
+    
+    def _add_column_if_missing(self, cursor, table: str, column: str, definition: str) -> bool:
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column in {row[1] for row in cursor.fetchall()}:
+            return False
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        return True
+    
+    def _migrate_epoch_columns(self, cursor):
+        """Добавляет целочисленные epoch-колонки рядом с текстовыми датами и заполняет их"""
+        # expiry_date пишется из Python как локальное время, остальные даты - CURRENT_TIMESTAMP в UTC
+        epoch_columns = [
+            ("users", "created_ts", "strftime('%s', created_at)"),
+            ("user_keys", "expiry_ts", "strftime('%s', expiry_date, 'utc')"),
+            ("user_keys", "created_ts", "strftime('%s', created_date)"),
+            ("transactions", "created_ts", "strftime('%s', created_date)"),
+            ("crypto_payments", "created_ts", "strftime('%s', created_at)"),
+        ]
+        for table, column, source in epoch_columns:
+            if self._add_column_if_missing(cursor, table, column, "INTEGER"):
+                cursor.execute(f'''
+                    UPDATE {table} SET {column} = CAST({source} AS INTEGER)
+                    WHERE {column} IS NULL
+                ''')
+        
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_created_ts ON users(created_ts)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_keys_expiry_ts ON user_keys(expiry_ts)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_keys_user_expiry_ts ON user_keys(user_id, expiry_ts)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_keys_created_ts ON user_keys(created_ts)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_status_ts ON transactions(status, created_ts)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_crypto_payments_created_ts ON crypto_payments(created_ts)')
+    
+    def _migrate_hot_path_indexes(self, cursor):
+        """Индексы под опрашиваемые фоновыми задачами и админкой выборки"""
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_crypto_payments_status ON crypto_payments(status, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_withdrawals_status ON referral_withdrawals(status, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_support_messages_status ON support_messages(status, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_plans_host_active ON plans(host_name, is_active)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_keys_host ON user_keys(host_name)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_admin_logs_created ON admin_logs(created_at)')
+    
+    def _migrate_stats_counters(self, cursor):
+        """Таблица счетчиков дашборда и триггеры, которые обновляют ее при записи"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                name TEXT PRIMARY KEY,
+                value NUMERIC NOT NULL DEFAULT 0
+            )
+        ''')
+        
+        for table, counters in STATS_COUNTER_SOURCES.items():
+            names = ', '.join(f"'{name}'" for name in counters)
+            
+            def contribution(row: str) -> str:
+                cases = ' '.join(
+                    f"WHEN '{name}' THEN COALESCE({expr.format(row=row)}, 0)"
+                    for name, expr in counters.items()
+                )
+                return f"CASE name {cases} END"
+            
+            deltas = {
+                'INSERT': contribution('NEW'),
+                'DELETE': f"-({contribution('OLD')})",
+                'UPDATE': f"{contribution('NEW')} - ({contribution('OLD')})",
+            }
+            for event, delta in deltas.items():
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_stats_{event.lower()}
+                    AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE stats_counters SET value = value + {delta}
+                        WHERE name IN ({names});
+                    END
+                ''')
+        
+        self._rebuild_stats_counters(cursor)
+    
+    def _rebuild_stats_counters(self, cursor):
+        """Пересчитывает все счетчики по текущему содержимому таблиц"""
+        for table, counters in STATS_COUNTER_SOURCES.items():
+            for name, expr in counters.items():
+                cursor.execute(f'''
+                    INSERT OR REPLACE INTO stats_counters (name, value)
+                    SELECT ?, COALESCE(SUM({expr.format(row=table)}), 0) FROM {table}
+                ''', (name,))
+    
+    def _migrate_revenue_daily(self, cursor):
+        """Дневная сводка выручки по способам оплаты, которую ведут триггеры transactions"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS revenue_daily (
+                day TEXT NOT NULL,
+                payment_method TEXT NOT NULL DEFAULT '',
+                tx_count INTEGER NOT NULL DEFAULT 0,
+                amount REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, payment_method)
+            )
+        ''')
+        
+        # Оплаченная транзакция попадает в день своего создания по локальному времени
+        day = "date(COALESCE({row}.created_ts, strftime('%s', 'now')), 'unixepoch', 'localtime')"
+        method = "COALESCE({row}.payment_method, '')"
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_transactions_revenue_insert
+            AFTER INSERT ON transactions
+            WHEN NEW.status = 'paid'
+            BEGIN
+                INSERT INTO revenue_daily (day, payment_method, tx_count, amount)
+                VALUES ({day.format(row='NEW')}, {method.format(row='NEW')}, 1, COALESCE(NEW.amount_rub, 0))
+                ON CONFLICT (day, payment_method) DO UPDATE
+                SET tx_count = tx_count + 1, amount = amount + excluded.amount;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_transactions_revenue_update
+            AFTER UPDATE OF status, amount_rub ON transactions
+            WHEN OLD.status = 'paid' OR NEW.status = 'paid'
+            BEGIN
+                UPDATE revenue_daily
+                SET tx_count = tx_count - 1, amount = amount - COALESCE(OLD.amount_rub, 0)
+                WHERE OLD.status = 'paid'
+                AND day = {day.format(row='OLD')} AND payment_method = {method.format(row='OLD')};
+                
+                INSERT INTO revenue_daily (day, payment_method, tx_count, amount)
+                SELECT {day.format(row='NEW')}, {method.format(row='NEW')}, 1, COALESCE(NEW.amount_rub, 0)
+                WHERE NEW.status = 'paid'
+                ON CONFLICT (day, payment_method) DO UPDATE
+                SET tx_count = tx_count + 1, amount = amount + excluded.amount;
+            END
+        ''')
+        
+        self._rebuild_revenue_daily(cursor)
+    
+    def _rebuild_revenue_daily(self, cursor):
+        source = "main.transactions"
+        # Перенесенные в архив транзакции остаются в отчетах о выручке
+        cursor.execute("SELECT 1 FROM archive.sqlite_master WHERE type = 'table' AND name = 'transactions'")
+        if cursor.fetchone():
+            columns = "created_ts, payment_method, amount_rub, status"
+            source = f"(SELECT {columns} FROM main.transactions UNION ALL SELECT {columns} FROM archive.transactions)"
+        
+        cursor.execute("DELETE FROM revenue_daily")
+        cursor.execute(f'''
+            INSERT INTO revenue_daily (day, payment_method, tx_count, amount)
+            SELECT
+                date(created_ts, 'unixepoch', 'localtime'),
+                COALESCE(payment_method, ''),
+                COUNT(*),
+                COALESCE(SUM(amount_rub), 0)
+            FROM {source}
+            WHERE status = 'paid'
+            GROUP BY 1, 2
+        ''')
+    
+    def _migrate_pagination_indexes(self, cursor):
+        """Индексы под порядок keyset-страниц, которых нет среди прежних"""
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_referred_created ON users(referred_by, created_ts)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_crypto_payments_status_ts ON crypto_payments(status, created_ts)')
+    
+    def _migrate_retention_indexes(self, cursor):
+        """Индексы, по которым фоновая задача находит строки старше срока хранения"""
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_crypto_payments_created ON crypto_payments(created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_broadcasts_created ON broadcasts(created_at)')
+    
+    def _migrate_user_list_indexes(self, cursor):
+        """Индекс под списки активных и заблокированных пользователей, найденный python bot.py explain"""
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_banned_created ON users(is_banned, created_ts)')
+    
+    def _migrate_users_fts(self, cursor):
+        """Полнотекстовый индекс (FTS5, trigram) по имени, username, email и UUID ключей пользователя"""
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+                username, full_name, keys, tokenize = 'trigram'
+            )
+        ''')
+        
+        # Строка индекса пользователя пересобирается целиком: rowid = telegram_id
+        def refresh(user_id: str) -> str:
+            return f'''
+                DELETE FROM users_fts WHERE rowid = {user_id};
+                INSERT INTO users_fts (rowid, username, full_name, keys)
+                SELECT u.telegram_id, u.username, u.full_name,
+                    (SELECT group_concat(uk.key_email || ' ' || uk.xui_client_uuid, ' ')
+                     FROM user_keys uk WHERE uk.user_id = u.telegram_id)
+                FROM users u WHERE u.telegram_id = {user_id};
+            '''
+        
+        triggers = {
+            'trg_users_fts_insert': ("AFTER INSERT ON users", refresh('NEW.telegram_id')),
+            'trg_users_fts_update': ("AFTER UPDATE OF username, full_name ON users", refresh('NEW.telegram_id')),
+            'trg_users_fts_delete': ("AFTER DELETE ON users", "DELETE FROM users_fts WHERE rowid = OLD.telegram_id;"),
+            'trg_user_keys_fts_insert': ("AFTER INSERT ON user_keys", refresh('NEW.user_id')),
+            'trg_user_keys_fts_update': ("AFTER UPDATE OF user_id, key_email, xui_client_uuid ON user_keys",
+                                         refresh('OLD.user_id') + refresh('NEW.user_id')),
+            'trg_user_keys_fts_delete': ("AFTER DELETE ON user_keys", refresh('OLD.user_id')),
+        }
+        for name, (event, body) in triggers.items():
+            cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+        
+        cursor.execute("DELETE FROM users_fts")
+        cursor.execute('''
+            INSERT INTO users_fts (rowid, username, full_name, keys)
+            SELECT u.telegram_id, u.username, u.full_name,
+                (SELECT group_concat(uk.key_email || ' ' || uk.xui_client_uuid, ' ')
+                 FROM user_keys uk WHERE uk.user_id = u.telegram_id)
+            FROM users u
+        ''')
+    
     # === ПОЛЬЗОВАТЕЛИ ===
-    def get_user(self, telegram_id: int) -> Optional[Dict]:
+    def get_user(self, telegram_id: int) -> Optional[UserRow]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
+            return fetch_row(cursor, UserRow)
     
     def register_user(self, telegram_id: int, username: str, full_name: str, referrer_id: int = None):
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR IGNORE INTO users (telegram_id, username, full_name, referred_by) 
-                VALUES (?, ?, ?, ?)
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO users (telegram_id, username, full_name, referred_by, created_ts)
+                VALUES (?, ?, ?, ?, {SQL_NOW})
             ''', (telegram_id, username, full_name, referrer_id))
     
+    def update_user_profile(self, telegram_id: int, username: Optional[str], full_name: Optional[str]):
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE users SET username = ?, full_name = ?
+                WHERE telegram_id = ? AND (username IS NOT ? OR full_name IS NOT ?)
+            ''', (username, full_name, telegram_id, username, full_name))
+    
     def update_user_stats(self, telegram_id: int, amount: float, months: int):
         with self._get_connection() as conn:
             cursor = conn.cursor()
@@ -406,6 +1286,7 @@ class Database:
             ''', (user_id, amount, details))
             return cursor.lastrowid
     
+    @report_read
     def get_referral_withdrawals(self, status: str = None) -> List[Dict]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
@@ -427,23 +1308,40 @@ class Database:
                 ''')
             return [dict(row) for row in cursor.fetchall()]
     
-    def update_withdrawal_status(self, withdrawal_id: int, status: str, admin_notes: str = None):
+    def get_withdrawal(self, withdrawal_id: int) -> Optional[Dict]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            if status == 'completed':
-                cursor.execute('''
-                    UPDATE referral_withdrawals 
-                    SET status = ?, admin_notes = ?, processed_at = CURRENT_TIMESTAMP
-                    WHERE withdrawal_id = ?
-                ''', (status, admin_notes, withdrawal_id))
-            else:
-                cursor.execute('''
-                    UPDATE referral_withdrawals 
-                    SET status = ?, admin_notes = ?
-                    WHERE withdrawal_id = ?
-                ''', (status, admin_notes, withdrawal_id))
+            cursor.execute('''
+                SELECT rw.*, u.username, u.full_name 
+                FROM referral_withdrawals rw
+                JOIN users u ON rw.user_id = u.telegram_id
+                WHERE rw.withdrawal_id = ?
+            ''', (withdrawal_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
     
-    def get_referrals(self, referrer_id: int) -> List[Dict]:
+    def transition_withdrawal(self, withdrawal_id: int, from_status: str, to_status: str,
+                              admin_notes: str = None) -> bool:
+        """Меняет статус заявки, только если она еще в from_status: повторный клик ничего не сделает"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE referral_withdrawals 
+                SET status = ?, admin_notes = ?, processed_at = CURRENT_TIMESTAMP
+                WHERE withdrawal_id = ? AND status = ?
+            ''', (to_status, admin_notes, withdrawal_id, from_status))
+            return cursor.rowcount == 1
+    
+    def reject_withdrawal(self, withdrawal_id: int, admin_notes: str) -> Optional[Dict]:
+        """Отклоняет ожидающую заявку и возвращает сумму на реферальный баланс одной транзакцией"""
+        with self.transaction():
+            if not self.transition_withdrawal(withdrawal_id, 'pending', 'rejected', admin_notes):
+                return None
+            withdrawal = self.get_withdrawal(withdrawal_id)
+            self.add_referral_balance(withdrawal['user_id'], withdrawal['amount'])
+            return withdrawal
+    
+    def get_referrals(self, referrer_id: int) -> List[UserRow]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -451,9 +1349,12 @@ class Database:
                 WHERE referred_by = ? 
                 ORDER BY created_at DESC
             ''', (referrer_id,))
-            return [dict(row) for row in cursor.fetchall()]
+            return fetch_rows(cursor, UserRow)
     
-    def search_users(self, query: str) -> List[Dict]:
+    def search_users(self, query: str, limit: int = 20) -> List[UserRow]:
+        """Поиск по ID, username, имени, email или UUID ключа (в том числе внутри вставленного конфига)"""
+        query = query.strip().lstrip('@')
+        
         with self._get_connection() as conn:
             cursor = conn.cursor()
             
@@ -462,57 +1363,150 @@ class Database:
                     "SELECT * FROM users WHERE telegram_id = ?",
                     (int(query),)
                 )
-                results = cursor.fetchall()
-                if results:
-                    return [dict(row) for row in results]
+                users = fetch_rows(cursor, UserRow)
+                if users:
+                    return users
+            
+            uuid_match = UUID_PATTERN.search(query)
+            if uuid_match:
+                query = uuid_match.group(0).lower()
+            
+            if len(query) < 3:
+                # Триграммный индекс не ищет по строкам короче трех символов
+                cursor.execute(
+                    "SELECT * FROM users WHERE username LIKE ? OR full_name LIKE ? LIMIT ?",
+                    (f"{query}%", f"{query}%", limit)
+                )
+                return fetch_rows(cursor, UserRow)
             
-            search_term = f"%{query}%"
+            phrase = '"' + query.replace('"', '""') + '"'
+            cursor.execute('''
+                SELECT u.*
+                FROM users_fts f
+                JOIN users u ON u.telegram_id = f.rowid
+                WHERE users_fts MATCH ?
+                ORDER BY bm25(users_fts, 10.0, 5.0, 1.0)
+                LIMIT ?
+            ''', (phrase, limit))
+            return fetch_rows(cursor, UserRow)
+    
+    def _with_user_counts(self, users_query: str, order: str) -> str:
+        """Дополняет выборку пользователей числом ключей, активных ключей и рефералов.
+        Счетчики считаются одним GROUP BY только по попавшим в выборку пользователям"""
+        return f'''
+            WITH page AS ({users_query}),
+            key_counts AS (
+                SELECT uk.user_id,
+                    COUNT(*) as key_count,
+                    SUM(uk.expiry_ts > {SQL_NOW}) as active_key_count
+                FROM page
+                JOIN user_keys uk ON uk.user_id = page.telegram_id
+                GROUP BY uk.user_id
+            ),
+            referral_counts AS (
+                SELECT r.referred_by as user_id, COUNT(*) as referral_count
+                FROM page
+                JOIN users r ON r.referred_by = page.telegram_id
+                GROUP BY r.referred_by
+            )
+            SELECT page.*,
+                COALESCE(kc.key_count, 0) as key_count,
+                COALESCE(kc.active_key_count, 0) as active_key_count,
+                COALESCE(rc.referral_count, 0) as referral_count
+            FROM page
+            LEFT JOIN key_counts kc ON kc.user_id = page.telegram_id
+            LEFT JOIN referral_counts rc ON rc.user_id = page.telegram_id
+            ORDER BY {order}
+        '''
+    
+    def get_user_with_counts(self, telegram_id: int) -> Optional[UserRow]:
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
             cursor.execute(
-                "SELECT * FROM users WHERE username LIKE ? OR full_name LIKE ? ORDER BY telegram_id DESC LIMIT 20",
-                (search_term, search_term)
+                self._with_user_counts("SELECT * FROM users WHERE telegram_id = ?", "telegram_id"),
+                (telegram_id,)
             )
-            return [dict(row) for row in cursor.fetchall()]
+            return fetch_row(cursor, UserRow)
     
-    def get_all_users(self, limit: int = 1000) -> List[Dict]:
+    @report_read
+    def get_recent_users_with_counts(self, limit: int = 20) -> List[UserRow]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users ORDER BY created_at DESC LIMIT ?", (limit,))
-            return [dict(row) for row in cursor.fetchall()]
+            cursor.execute(
+                self._with_user_counts(
+                    "SELECT * FROM users ORDER BY created_ts DESC, telegram_id DESC LIMIT ?",
+                    "created_ts DESC, telegram_id DESC"
+                ),
+                (limit,)
+            )
+            return fetch_rows(cursor, UserRow)
     
-    def get_all_users_count(self) -> int:
+    def get_referral_count(self, referrer_id: int) -> int:
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM users")
+            cursor.execute("SELECT COUNT(*) FROM users WHERE referred_by = ?", (referrer_id,))
             return cursor.fetchone()[0]
     
-    def get_active_users(self) -> List[Dict]:
+    @report_read
+    def get_all_users(self, limit: int = 1000) -> List[UserRow]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE is_banned = 0 ORDER BY created_at DESC")
-            return [dict(row) for row in cursor.fetchall()]
+            cursor.execute("SELECT * FROM users ORDER BY created_ts DESC LIMIT ?", (limit,))
+            return fetch_rows(cursor, UserRow)
+    
+    def get_all_users_count(self) -> int:
+        return int(self._get_counter('users'))
     
-    def get_banned_users(self) -> List[Dict]:
+    @report_read
+    def get_active_users(self) -> List[UserRow]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE is_banned = 1 ORDER BY created_at DESC")
-            return [dict(row) for row in cursor.fetchall()]
+            cursor.execute("SELECT * FROM users WHERE is_banned = 0 ORDER BY created_ts DESC")
+            return fetch_rows(cursor, UserRow)
     
+    @report_read
+    def get_banned_users(self) -> List[UserRow]:
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM users WHERE is_banned = 1 ORDER BY created_ts DESC")
+            return fetch_rows(cursor, UserRow)
+    
+    @report_read
     def get_today_users(self) -> int:
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM users WHERE date(created_at) = date('now')")
+            cursor.execute(f"SELECT COUNT(*) FROM users WHERE created_ts >= {SQL_TODAY_START}")
             return cursor.fetchone()[0]
     
+    def get_user_context(self, telegram_id: int) -> Dict:
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
+            user = fetch_row(cursor, UserRow)
+            cursor.execute(f'''
+                SELECT
+                    COUNT(*) as key_count,
+                    COALESCE(SUM(expiry_ts > {SQL_NOW}), 0) as active_key_count,
+                    MAX(expiry_ts) as latest_expiry_ts,
+                    MAX(0, MAX(expiry_ts) - {SQL_NOW}) as seconds_left
+                FROM user_keys
+                WHERE user_id = ?
+            ''', (telegram_id,))
+            context = dict(cursor.fetchone())
+            context['user'] = user
+            return context
+    
+    @report_read
     def get_user_activity_stats(self, days: int = 7) -> Dict:
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT 
+            cursor.execute(f'''
+                SELECT
                     COUNT(DISTINCT user_id) as active_users,
                     COUNT(*) as total_keys_created
-                FROM user_keys 
-                WHERE created_date >= datetime('now', ?)
-            ''', (f'-{days} days',))
+                FROM user_keys
+                WHERE created_ts >= {sql_since()}
+            ''', (days * 86400,))
             return dict(cursor.fetchone())
     
     # === КЛЮЧИ ===
@@ -520,44 +1514,57 @@ class Database:
                key_email: str, expiry_date: datetime) -> int:
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO user_keys 
-                (user_id, host_name, xui_client_uuid, key_email, expiry_date) 
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, host_name, xui_client_uuid, key_email, expiry_date))
+            cursor.execute(f'''
+                INSERT INTO user_keys
+                (user_id, host_name, xui_client_uuid, key_email, expiry_date, expiry_ts, created_ts)
+                VALUES (?, ?, ?, ?, ?, ?, {SQL_NOW})
+            ''', (user_id, host_name, xui_client_uuid, key_email, expiry_date, int(expiry_date.timestamp())))
             return cursor.lastrowid
     
-    def get_user_keys(self, user_id: int) -> List[Dict]:
+    def get_user_keys(self, user_id: int, limit: int = -1) -> List[KeyRow]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM user_keys 
-                WHERE user_id = ? 
-                ORDER BY created_date DESC
-            ''', (user_id,))
-            return [dict(row) for row in cursor.fetchall()]
+            cursor.execute(f'''
+                SELECT *,
+                    {sql_days_left('expiry_ts')} as days_left,
+                    expiry_ts <= {SQL_NOW} as is_expired
+                FROM user_keys
+                WHERE user_id = ?
+                ORDER BY created_ts DESC
+                LIMIT ?
+            ''', (user_id, limit))
+            return fetch_rows(cursor, KeyRow)
     
-    def get_key_by_id(self, key_id: int) -> Optional[Dict]:
+    def get_key_by_id(self, key_id: int) -> Optional[KeyRow]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM user_keys WHERE key_id = ?", (key_id,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
-    
-    def get_active_user_keys(self, user_id: int) -> List[Dict]:
+            cursor.execute(f'''
+                SELECT *,
+                    {sql_days_left('expiry_ts')} as days_left,
+                    expiry_ts <= {SQL_NOW} as is_expired
+                FROM user_keys
+                WHERE key_id = ?
+            ''', (key_id,))
+            return fetch_row(cursor, KeyRow)
+    
+    def get_active_user_keys(self, user_id: int) -> List[KeyRow]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM user_keys 
-                WHERE user_id = ? AND expiry_date > datetime('now')
-                ORDER BY expiry_date DESC
+            cursor.execute(f'''
+                SELECT *, {sql_days_left('expiry_ts')} as days_left
+                FROM user_keys
+                WHERE user_id = ? AND expiry_ts > {SQL_NOW}
+                ORDER BY expiry_ts DESC
             ''', (user_id,))
-            return [dict(row) for row in cursor.fetchall()]
+            return fetch_rows(cursor, KeyRow)
     
     def update_key_expiry(self, key_id: int, expiry_date: datetime):
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("UPDATE user_keys SET expiry_date = ? WHERE key_id = ?", (expiry_date, key_id))
+            cursor.execute(
+                "UPDATE user_keys SET expiry_date = ?, expiry_ts = ? WHERE key_id = ?",
+                (expiry_date, int(expiry_date.timestamp()), key_id)
+            )
     
     def delete_key(self, key_id: int):
         with self._get_connection() as conn:
@@ -575,26 +1582,43 @@ class Database:
             cursor.execute("SELECT COUNT(*) FROM user_keys WHERE user_id = ?", (user_id,))
             return cursor.fetchone()[0] + 1
     
+    @report_read
     def get_active_keys_count(self) -> int:
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM user_keys WHERE expiry_date > datetime('now') AND is_active = 1")
+            cursor.execute(f"SELECT COUNT(*) FROM user_keys WHERE expiry_ts > {SQL_NOW} AND is_active = 1")
             return cursor.fetchone()[0]
     
-    def get_expiring_keys(self, days: int = 7) -> List[Dict]:
+    @report_read
+    def get_expiring_keys(self, days: int = 7) -> List[KeyRow]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT uk.*, u.username, u.full_name 
+            cursor.execute(f'''
+                SELECT uk.*, u.username, u.full_name,
+                    {sql_days_left('uk.expiry_ts')} as days_left
                 FROM user_keys uk
                 JOIN users u ON uk.user_id = u.telegram_id
-                WHERE uk.expiry_date BETWEEN datetime('now') AND datetime('now', ?)
+                WHERE uk.expiry_ts BETWEEN {SQL_NOW} AND {SQL_NOW} + ?
                 AND uk.is_active = 1
-                ORDER BY uk.expiry_date ASC
-            ''', (f'+{days} days',))
-            return [dict(row) for row in cursor.fetchall()]
+                ORDER BY uk.expiry_ts ASC
+            ''', (days * 86400,))
+            return fetch_rows(cursor, KeyRow)
     
     # === ХОСТЫ ===
+    # Хосты и тарифы меняет только админ, поэтому покупки читают их из снимка в памяти.
+    # Каждое изменение каталога перечитывает обе таблицы и подменяет снимок с новой версией
+    def reload_catalog(self):
+        with self._catalog_lock:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT * FROM hosts ORDER BY host_name")
+                hosts = fetch_rows(cursor, HostRow)
+                cursor.execute("SELECT * FROM plans ORDER BY host_name, price, plan_id")
+                plans = fetch_rows(cursor, PlanRow)
+            
+            version = self._catalog.version + 1 if self._catalog else 1
+            self._catalog = build_catalog(version, hosts, plans)
+    
     def add_host(self, name: str, url: str, username: str, password: str, inbound_id: int):
         with self._get_connection() as conn:
             cursor = conn.cursor()
@@ -603,26 +1627,19 @@ class Database:
                 (host_name, host_url, host_username, host_pass, host_inbound_id) 
                 VALUES (?, ?, ?, ?, ?)
             ''', (name, url, username, password, inbound_id))
+        self.reload_catalog()
     
-    def get_all_hosts(self) -> List[Dict]:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM hosts WHERE is_active = 1 ORDER BY host_name")
-            return [dict(row) for row in cursor.fetchall()]
+    @cached_read
+    def get_all_hosts(self) -> List[HostRow]:
+        return list(self._catalog.active_hosts)
     
-    def get_host(self, host_name: str) -> Optional[Dict]:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM hosts WHERE host_name = ?", (host_name,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
+    @cached_read
+    def get_host(self, host_name: str) -> Optional[HostRow]:
+        return self._catalog.hosts.get(host_name)
     
-    def get_host_by_id(self, host_id: int) -> Optional[Dict]:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM hosts WHERE host_id = ?", (host_id,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
+    @cached_read
+    def get_host_by_id(self, host_id: int) -> Optional[HostRow]:
+        return self._catalog.hosts_by_id.get(host_id)
     
     def update_host(self, host_name: str, **kwargs):
         with self._get_connection() as conn:
@@ -631,18 +1648,17 @@ class Database:
             values = list(kwargs.values())
             values.append(host_name)
             cursor.execute(f"UPDATE hosts SET {set_clause} WHERE host_name = ?", values)
+        self.reload_catalog()
     
     def delete_host(self, host_name: str):
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE hosts SET is_active = 0 WHERE host_name = ?", (host_name,))
             cursor.execute("UPDATE plans SET is_active = 0 WHERE host_name = ?", (host_name,))
+        self.reload_catalog()
     
     def get_hosts_count(self) -> int:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM hosts WHERE is_active = 1")
-            return cursor.fetchone()[0]
+        return int(self._get_counter('hosts'))
     
     # === ТАРИФЫ ===
     def add_plan(self, host_name: str, plan_name: str, months: int, price: float):
@@ -652,33 +1668,19 @@ class Database:
                 INSERT INTO plans (host_name, plan_name, months, price) 
                 VALUES (?, ?, ?, ?)
             ''', (host_name, plan_name, months, price))
+        self.reload_catalog()
     
-    def get_plans_for_host(self, host_name: str) -> List[Dict]:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM plans 
-                WHERE host_name = ? AND is_active = 1 
-                ORDER BY price
-            ''', (host_name,))
-            return [dict(row) for row in cursor.fetchall()]
+    @cached_read
+    def get_plans_for_host(self, host_name: str) -> List[PlanRow]:
+        return list(self._catalog.plans_by_host.get(host_name, ()))
     
-    def get_plan_by_id(self, plan_id: int) -> Optional[Dict]:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM plans WHERE plan_id = ?", (plan_id,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
+    @cached_read
+    def get_plan_by_id(self, plan_id: int) -> Optional[PlanRow]:
+        return self._catalog.plans.get(plan_id)
     
-    def get_all_plans(self) -> List[Dict]:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM plans 
-                WHERE is_active = 1 
-                ORDER BY host_name, price
-            ''')
-            return [dict(row) for row in cursor.fetchall()]
+    @cached_read
+    def get_all_plans(self) -> List[PlanRow]:
+        return list(self._catalog.active_plans)
     
     def update_plan(self, plan_id: int, **kwargs):
         with self._get_connection() as conn:
@@ -687,128 +1689,102 @@ class Database:
             values = list(kwargs.values())
             values.append(plan_id)
             cursor.execute(f"UPDATE plans SET {set_clause} WHERE plan_id = ?", values)
+        self.reload_catalog()
     
     def delete_plan(self, plan_id: int):
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE plans SET is_active = 0 WHERE plan_id = ?", (plan_id,))
+        self.reload_catalog()
     
     def get_plans_count(self) -> int:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM plans WHERE is_active = 1")
-            return cursor.fetchone()[0]
+        return int(self._get_counter('plans'))
     
     # === ТРАНЗАКЦИИ ===
     def log_transaction(self, username: str, user_id: int, status: str, 
                        amount_rub: float, payment_method: str, metadata: dict):
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO transactions 
-                (username, user_id, status, amount_rub, payment_method, metadata)
-                VALUES (?, ?, ?, ?, ?, ?)
+            cursor.execute(f'''
+                INSERT INTO transactions
+                (username, user_id, status, amount_rub, payment_method, metadata, created_ts)
+                VALUES (?, ?, ?, ?, ?, ?, {SQL_NOW})
             ''', (username, user_id, status, amount_rub, payment_method, json.dumps(metadata)))
     
-    def get_all_transactions(self, limit: int = 100) -> List[Dict]:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT t.*, u.username, u.full_name 
-                FROM transactions t
-                LEFT JOIN users u ON t.user_id = u.telegram_id
-                ORDER BY t.created_date DESC 
-                LIMIT ?
-            ''', (limit,))
-            return [dict(row) for row in cursor.fetchall()]
-    
     def get_user_transactions(self, user_id: int, limit: int = 50) -> List[Dict]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT * FROM transactions 
-                WHERE user_id = ? 
-                ORDER BY created_date DESC 
+                WHERE user_id = ?
+                ORDER BY created_ts DESC
                 LIMIT ?
             ''', (user_id, limit))
             return [dict(row) for row in cursor.fetchall()]
     
-    def get_today_revenue(self) -> float:
+    def _get_revenue_for_days(self, days: int) -> float:
+        """Выручка за последние days календарных дней, включая сегодняшний"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT SUM(amount_rub) 
-                FROM transactions 
-                WHERE date(created_date) = date('now') 
-                AND status = 'paid'
-            """)
+            cursor.execute(
+                "SELECT SUM(amount) FROM revenue_daily WHERE day >= date('now', 'localtime', ?)",
+                (f'-{days - 1} days',)
+            )
             result = cursor.fetchone()[0]
             return result if result else 0.0
     
+    @report_read
+    def get_today_revenue(self) -> float:
+        return self._get_revenue_for_days(1)
+    
+    @report_read
     def get_week_revenue(self) -> float:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT SUM(amount_rub) 
-                FROM transactions 
-                WHERE created_date >= datetime('now', '-7 days') 
-                AND status = 'paid'
-            """)
-            result = cursor.fetchone()[0]
-            return result if result else 0.0
+        return self._get_revenue_for_days(7)
     
+    @report_read
     def get_month_revenue(self) -> float:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT SUM(amount_rub) 
-                FROM transactions 
-                WHERE created_date >= datetime('now', '-30 days') 
-                AND status = 'paid'
-            """)
-            result = cursor.fetchone()[0]
-            return result if result else 0.0
+        return self._get_revenue_for_days(30)
     
     def get_total_revenue(self) -> float:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT SUM(total_spent) FROM users")
-            result = cursor.fetchone()[0]
-            return result if result else 0.0
+        return float(self._get_counter('total_spent'))
     
+    @report_read
     def get_revenue_stats(self, days: int = 30) -> List[Dict]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT 
-                    date(created_date) as date,
-                    COUNT(*) as transactions,
-                    SUM(amount_rub) as revenue
-                FROM transactions 
-                WHERE created_date >= datetime('now', ?)
-                AND status = 'paid'
-                GROUP BY date(created_date)
-                ORDER BY date DESC
-            ''', (f'-{days} days',))
+                SELECT
+                    day as date,
+                    SUM(tx_count) as transactions,
+                    SUM(amount) as revenue
+                FROM revenue_daily
+                WHERE day >= date('now', 'localtime', ?)
+                GROUP BY day
+                ORDER BY day DESC
+            ''', (f'-{days - 1} days',))
             return [dict(row) for row in cursor.fetchall()]
     
+    def rebuild_revenue_daily(self):
+        """Пересобирает дневную сводку выручки по всей истории транзакций"""
+        with self._get_connection() as conn:
+            self._rebuild_revenue_daily(conn.cursor())
+    
     # === CRYPTO PAYMENTS ===
     def create_crypto_payment(self, invoice_id: str, user_id: int, plan_id: int, 
                             amount: float, asset: str, metadata: dict, key_id: int = None):
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO crypto_payments 
-                (invoice_id, user_id, plan_id, key_id, amount, asset, metadata) 
-                VALUES (?, ?, ?, ?, ?, ?, ?)
+            cursor.execute(f'''
+                INSERT OR REPLACE INTO crypto_payments
+                (invoice_id, user_id, plan_id, key_id, amount, asset, metadata, created_ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?, {SQL_NOW})
             ''', (invoice_id, user_id, plan_id, key_id, amount, asset, json.dumps(metadata)))
     
-    def get_crypto_payment(self, invoice_id: str) -> Optional[Dict]:
+    def get_crypto_payment(self, invoice_id: str) -> Optional[PaymentRow]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM crypto_payments WHERE invoice_id = ?", (invoice_id,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
+            return fetch_row(cursor, PaymentRow)
     
     def update_crypto_payment_status(self, invoice_id: str, status: str):
         with self._get_connection() as conn:
@@ -819,40 +1795,122 @@ class Database:
                 WHERE invoice_id = ?
             ''', (status, invoice_id))
     
-    def get_pending_payments(self) -> List[Dict]:
+    def update_crypto_payment_metadata(self, invoice_id: str, metadata: dict):
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT cp.*, u.username, u.full_name, p.plan_name, p.host_name
-                FROM crypto_payments cp
-                JOIN users u ON cp.user_id = u.telegram_id
-                JOIN plans p ON cp.plan_id = p.plan_id
-                WHERE cp.status = 'pending'
-                ORDER BY cp.created_at DESC
-            ''')
-            return [dict(row) for row in cursor.fetchall()]
+                UPDATE crypto_payments
+                SET metadata = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE invoice_id = ?
+            ''', (json.dumps(metadata), invoice_id))
     
-    def get_payments_by_status(self, status: str, limit: int = 100) -> List[Dict]:
+    def claim_crypto_payment(self, invoice_id: str) -> bool:
+        """Забирает платеж в обработку, чтобы один счет не выдал два ключа"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT cp.*, u.username, u.full_name, p.plan_name, p.host_name
-                FROM crypto_payments cp
-                JOIN users u ON cp.user_id = u.telegram_id
-                JOIN plans p ON cp.plan_id = p.plan_id
-                WHERE cp.status = ?
-                ORDER BY cp.created_at DESC
-                LIMIT ?
-            ''', (status, limit))
-            return [dict(row) for row in cursor.fetchall()]
-    
-    # === НАСТРОЙКИ ===
-    def get_setting(self, key: str, default: str = "") -> str:
+                UPDATE crypto_payments
+                SET status = 'processing', updated_at = CURRENT_TIMESTAMP
+                WHERE invoice_id = ? AND status IN ('pending', 'error')
+            ''', (invoice_id,))
+            return cursor.rowcount == 1
+    
+    def release_interrupted_crypto_payments(self) -> int:
+        """Возвращает в очередь платежи, обработка которых прервалась остановкой бота"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
-            row = cursor.fetchone()
-            return row[0] if row else default
+            cursor.execute('''
+                UPDATE crypto_payments
+                SET status = 'pending', updated_at = CURRENT_TIMESTAMP
+                WHERE status = 'processing'
+            ''')
+            return cursor.rowcount
+    
+    def fulfill_crypto_payment(self, invoice_id: str, host_name: str, client_uuid: str, key_email: str,
+                               expiry_date: datetime, months: int, price_rub: float,
+                               referral_percentage: float = 0) -> int:
+        """Все записи по оплаченному счету одной транзакцией: ключ, статистика,
+        транзакция, бонус реферера и статус платежа. Возвращает key_id"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT cp.user_id, cp.plan_id, u.username, u.full_name, u.referred_by
+                FROM crypto_payments cp
+                JOIN users u ON cp.user_id = u.telegram_id
+                WHERE cp.invoice_id = ? AND cp.status = 'processing'
+            ''', (invoice_id,))
+            payment = cursor.fetchone()
+            if not payment:
+                raise ValueError(f"Payment {invoice_id} is not claimed for processing")
+            
+            user_id = payment['user_id']
+            key_id = self.add_key(user_id, host_name, client_uuid, key_email, expiry_date)
+            self.update_user_stats(user_id, price_rub, months)
+            self.log_transaction(
+                username=payment['username'] or payment['full_name'],
+                user_id=user_id,
+                status='paid',
+                amount_rub=price_rub,
+                payment_method='CryptoBot',
+                metadata={
+                    'plan_id': payment['plan_id'],
+                    'key_id': key_id,
+                    'invoice_id': invoice_id
+                }
+            )
+            
+            if referral_percentage and payment['referred_by']:
+                self.add_referral_balance(payment['referred_by'], price_rub * (referral_percentage / 100))
+            
+            cursor.execute('''
+                UPDATE crypto_payments
+                SET status = 'paid', key_id = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE invoice_id = ?
+            ''', (key_id, invoice_id))
+            return key_id
+    
+    def get_pending_payments(self, include_errors: bool = False) -> List[PaymentRow]:
+        """Ожидающие оплаты платежи; с include_errors еще и платежи, выдача ключа по которым сорвалась"""
+        statuses = "('pending', 'error')" if include_errors else "('pending')"
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT cp.*, u.username, u.full_name, p.plan_name, p.host_name
+                FROM crypto_payments cp
+                JOIN users u ON cp.user_id = u.telegram_id
+                JOIN plans p ON cp.plan_id = p.plan_id
+                WHERE cp.status IN {statuses}
+                ORDER BY cp.created_at DESC
+            ''')
+            return fetch_rows(cursor, PaymentRow)
+    
+    @report_read
+    def get_payments_by_status(self, status: str, limit: int = 100) -> List[PaymentRow]:
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT cp.*, u.username, u.full_name, p.plan_name, p.host_name
+                FROM crypto_payments cp
+                JOIN users u ON cp.user_id = u.telegram_id
+                JOIN plans p ON cp.plan_id = p.plan_id
+                WHERE cp.status = ?
+                ORDER BY cp.created_at DESC
+                LIMIT ?
+            ''', (status, limit))
+            return fetch_rows(cursor, PaymentRow)
+    
+    # === НАСТРОЙКИ ===
+    # Настройки загружаются в память при старте и обновляются при каждом изменении
+    def reload_settings(self):
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT key, value FROM settings ORDER BY key")
+            self._settings = {row[0]: row[1] for row in cursor.fetchall()}
+    
+    @cached_read
+    def get_setting(self, key: str, default: str = "") -> str:
+        value = self._settings.get(key)
+        return value if value is not None else default
     
     def update_setting(self, key: str, value: str):
         with self._get_connection() as conn:
@@ -861,17 +1919,17 @@ class Database:
                 INSERT OR REPLACE INTO settings (key, value) 
                 VALUES (?, ?)
             ''', (key, value))
+        self._settings[key] = value
     
+    @cached_read
     def get_all_settings(self) -> Dict[str, str]:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT key, value FROM settings ORDER BY key")
-            return {row[0]: row[1] for row in cursor.fetchall()}
+        return dict(sorted(self._settings.items()))
     
     def delete_setting(self, key: str):
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM settings WHERE key = ?", (key,))
+        self._settings.pop(key, None)
     
     # === SUPPORT MESSAGES ===
     def create_support_message(self, user_id: int, message: str):
@@ -883,6 +1941,7 @@ class Database:
             ''', (user_id, message))
             return cursor.lastrowid
     
+    @report_read
     def get_support_messages(self, status: str = None, limit: int = 100) -> List[Dict]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
@@ -961,6 +2020,7 @@ class Database:
                     WHERE broadcast_id = ?
                 ''', (sent, failed, broadcast_id))
     
+    @report_read
     def get_broadcasts(self, limit: int = 50) -> List[Dict]:
         with self._get_connection() as conn:
             cursor = conn.cursor()
@@ -982,113 +2042,2010 @@ class Database:
                 VALUES (?, ?, ?)
             ''', (admin_id, action, details))
     
-    def get_admin_logs(self, limit: int = 100) -> List[Dict]:
+    def clear_admin_logs(self):
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT al.*, u.username, u.full_name 
-                FROM admin_logs al
-                LEFT JOIN users u ON al.admin_id = u.telegram_id
-                ORDER BY al.created_at DESC
+            # Место вернет фоновый incremental_vacuum: полный VACUUM блокировал бы базу
+            cursor.execute("DELETE FROM admin_logs")
+    
+    # === ХРАНЕНИЕ И АРХИВ ===
+    def _prepare_archive_table(self, cursor, table: str) -> List[str]:
+        """Создает копию таблицы в архивной базе и досоздает колонки, добавленные миграциями"""
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS archive.{table} AS SELECT * FROM main.{table} WHERE 0")
+        cursor.execute(f"PRAGMA archive.table_info({table})")
+        archived = {row[1] for row in cursor.fetchall()}
+        cursor.execute(f"PRAGMA main.table_info({table})")
+        columns = cursor.fetchall()
+        for row in columns:
+            if row[1] not in archived:
+                cursor.execute(f"ALTER TABLE archive.{table} ADD COLUMN {row[1]} {row[2]}")
+        
+        # Уникальный ключ делает повторный перенос той же строки безопасным
+        keys = ', '.join(row[1] for row in columns if row[5])
+        cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_{table}_key ON {table}({keys})")
+        return [row[1] for row in columns]
+    
+    def archive_batch(self, table: str, batch_size: int = DB_ARCHIVE_BATCH_SIZE) -> int:
+        """Переносит в архив одну пачку строк старше срока хранения; возвращает число перенесенных строк"""
+        date_column, condition, days = RETENTION_POLICIES[table]
+        if days <= 0:
+            return 0
+        
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT rowid FROM main.{table}
+                WHERE {date_column} < datetime('now', ?) AND {condition}
+                ORDER BY {date_column}
                 LIMIT ?
-            ''', (limit,))
-            return [dict(row) for row in cursor.fetchall()]
+            ''', (f"-{days} days", batch_size))
+            rowids = [row[0] for row in cursor.fetchall()]
+            if not rowids:
+                return 0
+            
+            columns = ', '.join(self._prepare_archive_table(cursor, table))
+            placeholders = ', '.join('?' * len(rowids))
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO archive.{table} ({columns})
+                SELECT {columns} FROM main.{table} WHERE rowid IN ({placeholders})
+            ''', rowids)
+            cursor.execute(f"DELETE FROM main.{table} WHERE rowid IN ({placeholders})", rowids)
+            return len(rowids)
+    
+    def incremental_vacuum(self, pages: int = DB_VACUUM_STEP_PAGES) -> int:
+        """Возвращает файлу до pages свободных страниц; результат - сколько страниц освобождено"""
+        with self._get_connection() as conn:
+            before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+            return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    
+    # === ПАГИНАЦИЯ ===
+    def _fetch_page(self, select: str, where: Optional[str], params: tuple, sort_columns: Tuple[str, ...],
+                    key: Optional[tuple] = None, backward: bool = False, limit: int = PAGE_SIZE,
+                    with_user_counts: bool = False, row_type: Optional[type] = None) -> Page:
+        """Keyset-страница выборки: см. keyset_page_query"""
+        query, args, order = keyset_page_query(select, where, params, sort_columns, key, backward, limit)
+        if with_user_counts:
+            query = self._with_user_counts(query, order)
+        
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, args)
+            rows = fetch_rows(cursor, row_type) if row_type else [dict(row) for row in cursor.fetchall()]
+        return keyset_page(rows, sort_columns, key, backward, limit)
+    
+    @report_read
+    def get_users_page(self, key: Optional[tuple] = None, backward: bool = False, limit: int = PAGE_SIZE) -> Page:
+        return self._fetch_page(
+            "SELECT * FROM users", None, (),
+            ("created_ts", "telegram_id"), key, backward, limit, with_user_counts=True, row_type=UserRow
+        )
+    
+    def get_referrals_page(self, referrer_id: int, key: Optional[tuple] = None,
+                           backward: bool = False, limit: int = PAGE_SIZE) -> Page:
+        return self._fetch_page(
+            "SELECT * FROM users", "referred_by = ?", (referrer_id,),
+            ("created_ts", "telegram_id"), key, backward, limit, row_type=UserRow
+        )
+    
+    @report_read
+    def get_transactions_page(self, key: Optional[tuple] = None, backward: bool = False, limit: int = PAGE_SIZE) -> Page:
+        return self._fetch_page(
+            '''SELECT t.*, u.username, u.full_name
+               FROM transactions t
+               LEFT JOIN users u ON t.user_id = u.telegram_id''', None, (),
+            ("t.transaction_id",), key, backward, limit
+        )
+    
+    @report_read
+    def get_payments_page(self, status: str, key: Optional[tuple] = None,
+                          backward: bool = False, limit: int = PAGE_SIZE) -> Page:
+        return self._fetch_page(
+            '''SELECT cp.*, cp.rowid, u.username, u.full_name, p.plan_name, p.host_name
+               FROM crypto_payments cp
+               JOIN users u ON cp.user_id = u.telegram_id
+               LEFT JOIN plans p ON cp.plan_id = p.plan_id''', "cp.status = ?", (status,),
+            ("cp.created_ts", "cp.rowid"), key, backward, limit, row_type=PaymentRow
+        )
+    
+    @report_read
+    def get_admin_logs_page(self, key: Optional[tuple] = None, backward: bool = False, limit: int = PAGE_SIZE) -> Page:
+        return self._fetch_page(
+            '''SELECT al.*, u.username, u.full_name
+               FROM admin_logs al
+               LEFT JOIN users u ON al.admin_id = u.telegram_id''', None, (),
+            ("al.log_id",), key, backward, limit
+        )
     
     # === СТАТИСТИКА ===
-    def get_user_count(self) -> int:
+    def _get_counter(self, name: str):
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM users")
-            return cursor.fetchone()[0]
+            cursor.execute("SELECT value FROM stats_counters WHERE name = ?", (name,))
+            row = cursor.fetchone()
+            return row[0] if row else 0
+    
+    def get_user_count(self) -> int:
+        return int(self._get_counter('users'))
     
     def get_active_users_count(self) -> int:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM users WHERE is_banned = 0")
-            return cursor.fetchone()[0]
+        return self.get_user_count() - self.get_banned_users_count()
     
     def get_banned_users_count(self) -> int:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM users WHERE is_banned = 1")
-            return cursor.fetchone()[0]
+        return int(self._get_counter('banned_users'))
     
     def get_total_keys_count(self) -> int:
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM user_keys")
-            return cursor.fetchone()[0]
+        return int(self._get_counter('keys'))
     
+    @report_read
     def get_stats_summary(self) -> Dict:
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT 
-                    (SELECT COUNT(*) FROM users) as total_users,
-                    (SELECT COUNT(*) FROM users WHERE is_banned = 0) as active_users,
-                    (SELECT COUNT(*) FROM users WHERE is_banned = 1) as banned_users,
-                    (SELECT COUNT(*) FROM user_keys) as total_keys,
-                    (SELECT COUNT(*) FROM user_keys WHERE expiry_date > datetime('now')) as active_keys,
-                    (SELECT SUM(total_spent) FROM users) as total_revenue,
-                    (SELECT SUM(amount_rub) FROM transactions WHERE date(created_date) = date('now') AND status = 'paid') as today_revenue,
-                    (SELECT COUNT(*) FROM users WHERE date(created_at) = date('now')) as today_users,
-                    (SELECT COUNT(*) FROM crypto_payments WHERE status = 'pending') as pending_payments,
-                    (SELECT COUNT(*) FROM referral_withdrawals WHERE status = 'pending') as pending_withdrawals
+            cursor.execute("SELECT name, value FROM stats_counters")
+            counters = {row['name']: row['value'] for row in cursor.fetchall()}
+            
+            # Зависящие от текущего времени значения берутся диапазоном по индексам
+            cursor.execute(f'''
+                SELECT
+                    (SELECT COUNT(*) FROM user_keys WHERE expiry_ts > {SQL_NOW}) as active_keys,
+                    (SELECT SUM(amount) FROM revenue_daily WHERE day = date('now', 'localtime')) as today_revenue,
+                    (SELECT COUNT(*) FROM users WHERE created_ts >= {SQL_TODAY_START}) as today_users
             ''')
-            return dict(cursor.fetchone())
+            summary = dict(cursor.fetchone())
+            
+            summary.update({
+                'total_users': counters.get('users', 0),
+                'active_users': counters.get('users', 0) - counters.get('banned_users', 0),
+                'banned_users': counters.get('banned_users', 0),
+                'total_keys': counters.get('keys', 0),
+                'total_revenue': counters.get('total_spent', 0),
+                'pending_payments': counters.get('pending_payments', 0),
+                'pending_withdrawals': counters.get('pending_withdrawals', 0),
+                'hosts': counters.get('hosts', 0),
+                'plans': counters.get('plans', 0),
+            })
+            return summary
+    
+    # === ДИАГНОСТИКА ===
+    def explain_statements(self) -> List[Dict]:
+        """EXPLAIN QUERY PLAN всех запросов, выполненных с запуска, с параметрами их последнего вызова.
+        full_scans - таблицы, которые план читает целиком; такие запросы идут первыми"""
+        results = []
+        with self._get_connection() as conn:
+            for sql, params in query_stats.statements().items():
+                try:
+                    plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params or ()).fetchall()]
+                except sqlite3.Error as e:
+                    results.append({'sql': sql, 'plan': [], 'full_scans': [], 'error': str(e)})
+                    continue
+                results.append({'sql': sql, 'plan': plan, 'full_scans': sqlite_full_scans(plan, sql), 'error': None})
+        results.sort(key=lambda result: not result['full_scans'])
+        return results
+
+class AsyncDatabase:
+    """Асинхронный доступ к Database: запросы выполняются в отдельном пуле потоков"""
+    
+    def __init__(self, database: Database, max_workers: int = DB_EXECUTOR_WORKERS):
+        self.sync = database
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        # Отчеты админки выполняются в своем пуле, чтобы не задерживать запись покупок
+        self._report_executor = ThreadPoolExecutor(max_workers=DB_REPORT_WORKERS, thread_name_prefix="db-report")
+    
+    def __getattr__(self, name: str):
+        attr = getattr(self.sync, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        
+        if getattr(attr, 'cached_read', False):
+            # Данные уже в памяти: пул потоков только добавил бы задержку
+            @functools.wraps(attr)
+            async def method(*args, **kwargs):
+                return attr(*args, **kwargs)
+        else:
+            executor = self._report_executor if getattr(attr, 'report_read', False) else self._executor
+            
+            @functools.wraps(attr)
+            async def method(*args, **kwargs):
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(executor, functools.partial(attr, *args, **kwargs))
+        
+        # Кэшируем обертку, чтобы не создавать ее на каждый вызов
+        setattr(self, name, method)
+        return method
+    
+    async def connect(self):
+        """SQLite открывается в конструкторе Database, подключаться отдельно не нужно"""
+    
+    async def close(self):
+        self._executor.shutdown(wait=True)
+        self._report_executor.shutdown(wait=True)
+        self.sync.close()
+
+# === POSTGRESQL ===
+PG_NOW = "EXTRACT(EPOCH FROM now())::bigint"
+PG_TODAY_START = "EXTRACT(EPOCH FROM date_trunc('day', now()))::bigint"
+# Текстовые даты, как и CURRENT_TIMESTAMP в SQLite, хранятся в UTC без часового пояса
+PG_UTC_NOW = "(now() AT TIME ZONE 'utc')"
+PG_CACHE_CHANNEL = "vless_bot_cache"
+
+def pg_days_left(column: str) -> str:
+    """SQL-выражение PostgreSQL: сколько полных дней осталось до epoch в column (не меньше 0)"""
+    return f"GREATEST(0, ({column} - {PG_NOW}) / 86400)"
+
+# Строковые литералы, идентификаторы в кавычках и комментарии, внутри которых ? - не параметр
+PG_QUOTED_OR_PARAMETER = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*|\?""")
+
+def pg_placeholders(query: str) -> str:
+    """Заменяет параметры ? на нумерованные $1, $2... для asyncpg, не трогая ? в кавычках и комментариях"""
+    numbers = itertools.count(1)
+    return PG_QUOTED_OR_PARAMETER.sub(
+        lambda match: f"${next(numbers)}" if match.group(0) == '?' else match.group(0), query
+    )
+
+def pg_rowcount(status: str) -> int:
+    """Число строк из статуса команды asyncpg вида 'UPDATE 1'"""
+    return int(status.split()[-1])
+
+PG_SCHEMA = [
+    f'''
+    CREATE TABLE IF NOT EXISTS users (
+        telegram_id BIGINT PRIMARY KEY,
+        username TEXT,
+        full_name TEXT,
+        trial_used INTEGER DEFAULT 0,
+        total_spent DOUBLE PRECISION DEFAULT 0,
+        total_months INTEGER DEFAULT 0,
+        referred_by BIGINT,
+        referral_balance DOUBLE PRECISION DEFAULT 0,
+        is_banned INTEGER DEFAULT 0,
+        language TEXT DEFAULT 'ru',
+        created_at TIMESTAMP DEFAULT {PG_UTC_NOW},
+        created_ts BIGINT
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS hosts (
+        host_id BIGSERIAL PRIMARY KEY,
+        host_name TEXT UNIQUE NOT NULL,
+        host_url TEXT NOT NULL,
+        host_username TEXT NOT NULL,
+        host_pass TEXT NOT NULL,
+        host_inbound_id INTEGER NOT NULL,
+        is_active INTEGER DEFAULT 1,
+        created_at TIMESTAMP DEFAULT {PG_UTC_NOW}
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS plans (
+        plan_id BIGSERIAL PRIMARY KEY,
+        host_name TEXT NOT NULL,
+        plan_name TEXT NOT NULL,
+        months INTEGER NOT NULL,
+        price DOUBLE PRECISION NOT NULL,
+        is_active INTEGER DEFAULT 1,
+        created_at TIMESTAMP DEFAULT {PG_UTC_NOW}
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS user_keys (
+        key_id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        host_name TEXT NOT NULL,
+        xui_client_uuid TEXT NOT NULL,
+        key_email TEXT NOT NULL,
+        expiry_date TIMESTAMP NOT NULL,
+        is_active INTEGER DEFAULT 1,
+        created_date TIMESTAMP DEFAULT {PG_UTC_NOW},
+        expiry_ts BIGINT,
+        created_ts BIGINT
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS transactions (
+        transaction_id BIGSERIAL PRIMARY KEY,
+        username TEXT,
+        user_id BIGINT,
+        status TEXT,
+        amount_rub DOUBLE PRECISION,
+        payment_method TEXT,
+        metadata TEXT,
+        created_date TIMESTAMP DEFAULT {PG_UTC_NOW},
+        created_ts BIGINT
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT,
+        updated_at TIMESTAMP DEFAULT {PG_UTC_NOW}
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS crypto_payments (
+        invoice_id TEXT PRIMARY KEY,
+        user_id BIGINT,
+        plan_id BIGINT,
+        key_id BIGINT,
+        amount DOUBLE PRECISION,
+        asset TEXT,
+        status TEXT DEFAULT 'pending',
+        metadata TEXT,
+        created_at TIMESTAMP DEFAULT {PG_UTC_NOW},
+        updated_at TIMESTAMP DEFAULT {PG_UTC_NOW},
+        created_ts BIGINT,
+        payment_seq BIGSERIAL
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS referral_withdrawals (
+        withdrawal_id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT,
+        amount DOUBLE PRECISION,
+        status TEXT DEFAULT 'pending',
+        details TEXT,
+        admin_notes TEXT,
+        created_at TIMESTAMP DEFAULT {PG_UTC_NOW},
+        processed_at TIMESTAMP
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS support_messages (
+        message_id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT,
+        message TEXT,
+        status TEXT DEFAULT 'open',
+        admin_response TEXT,
+        created_at TIMESTAMP DEFAULT {PG_UTC_NOW},
+        responded_at TIMESTAMP
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS admin_logs (
+        log_id BIGSERIAL PRIMARY KEY,
+        admin_id BIGINT,
+        action TEXT,
+        details TEXT,
+        created_at TIMESTAMP DEFAULT {PG_UTC_NOW}
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        broadcast_id BIGSERIAL PRIMARY KEY,
+        admin_id BIGINT,
+        message TEXT,
+        total_users INTEGER,
+        sent_count INTEGER DEFAULT 0,
+        failed_count INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'pending',
+        created_at TIMESTAMP DEFAULT {PG_UTC_NOW},
+        completed_at TIMESTAMP
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_users_created_ts ON users(created_ts)',
+    'CREATE INDEX IF NOT EXISTS idx_users_referred_created ON users(referred_by, created_ts)',
+    'CREATE INDEX IF NOT EXISTS idx_users_banned_created ON users(is_banned, created_ts)',
+    'CREATE INDEX IF NOT EXISTS idx_user_keys_user_expiry_ts ON user_keys(user_id, expiry_ts)',
+    'CREATE INDEX IF NOT EXISTS idx_user_keys_expiry_ts ON user_keys(expiry_ts)',
+    'CREATE INDEX IF NOT EXISTS idx_user_keys_created_ts ON user_keys(created_ts)',
+    'CREATE INDEX IF NOT EXISTS idx_user_keys_host ON user_keys(host_name)',
+    'CREATE INDEX IF NOT EXISTS idx_plans_host_active ON plans(host_name, is_active)',
+    'CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions(user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions(created_date)',
+    'CREATE INDEX IF NOT EXISTS idx_transactions_status_ts ON transactions(status, created_ts)',
+    'CREATE INDEX IF NOT EXISTS idx_crypto_payments_status_ts ON crypto_payments(status, created_ts)',
+    'CREATE INDEX IF NOT EXISTS idx_crypto_payments_created ON crypto_payments(created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_withdrawals_status ON referral_withdrawals(status, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_support_messages_status ON support_messages(status, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_admin_logs_created ON admin_logs(created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_broadcasts_created ON broadcasts(created_at)',
+]
+
+# Триграммные индексы под поиск подстрокой; без pg_trgm (нет прав или расширения) поиск работает и без них
+PG_SEARCH_INDEXES = [
+    '''
+    DO $$
+    BEGIN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    EXCEPTION WHEN insufficient_privilege OR feature_not_supported OR undefined_file THEN
+        RAISE NOTICE 'pg_trgm is not available, user search runs without trigram indexes';
+    END
+    $$
+    ''',
+    '''
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+            CREATE INDEX IF NOT EXISTS idx_users_username_trgm ON users USING gin (username gin_trgm_ops);
+            CREATE INDEX IF NOT EXISTS idx_users_full_name_trgm ON users USING gin (full_name gin_trgm_ops);
+            CREATE INDEX IF NOT EXISTS idx_user_keys_email_trgm ON user_keys USING gin (key_email gin_trgm_ops);
+            CREATE INDEX IF NOT EXISTS idx_user_keys_uuid_trgm ON user_keys USING gin (xui_client_uuid gin_trgm_ops);
+        END IF;
+    END
+    $$
+    ''',
+]
+
+class SettingsView:
+    """Синхронное чтение кэша настроек: BotSettings обращается к нему вне корутин"""
+    
+    def __init__(self, settings: Dict[str, str]):
+        self._settings = settings
+    
+    def get_setting(self, key: str, default: str = "") -> str:
+        value = self._settings.get(key)
+        return value if value is not None else default
+
+@instrumented
+class PostgresDatabase:
+    """Хранилище в PostgreSQL с тем же набором методов, что у AsyncDatabase, поверх пула asyncpg.
+    С одной базой могут работать несколько экземпляров бота: кэши настроек и каталога
+    у всех обновляются через LISTEN/NOTIFY"""
+    
+    def __init__(self, dsn: str = DATABASE_URL):
+        self.dsn = dsn
+        self._pool = None
+        self._listener = None
+        self._settings: Dict[str, str] = {}
+        self._catalog: Optional[Catalog] = None
+        self._archive_ready = set()
+        self._tasks = set()
+        self.sync = SettingsView(self._settings)
+    
+    async def connect(self):
+        try:
+            import asyncpg
+        except ImportError:
+            raise RuntimeError("DB_BACKEND=postgres требует пакет asyncpg") from None
+        
+        server_settings = {'timezone': PG_TIMEZONE, 'application_name': 'vless-bot'}
+        self._pool = await asyncpg.create_pool(
+            self.dsn, min_size=PG_POOL_MIN_SIZE, max_size=PG_POOL_MAX_SIZE,
+            server_settings=server_settings, init=self._init_connection
+        )
+        await self._run_migrations()
+        await self._seed_defaults()
+        await self.reload_settings()
+        await self.reload_catalog()
+        
+        # Отдельное соединение слушает изменения настроек и каталога от других экземпляров
+        self._listener = await asyncpg.connect(self.dsn, server_settings=server_settings)
+        await self._listener.add_listener(PG_CACHE_CHANNEL, self._on_cache_notify)
+    
+    async def close(self):
+        if self._listener:
+            await self._listener.close()
+        if self._pool:
+            await self._pool.close()
+    
+    @asynccontextmanager
+    async def transaction(self):
+        """Соединение из пула с открытой транзакцией: запросы блока фиксируются вместе"""
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                yield conn
+    
+    # === МИГРАЦИИ ===
+    def _get_migrations(self) -> List[Tuple[int, str, List[str]]]:
+        """Миграции схемы по порядку версий: списки идемпотентных SQL-команд"""
+        return [
+            (1, "initial schema", PG_SCHEMA),
+            (2, "user search index", PG_SEARCH_INDEXES),
+        ]
+    
+    async def _run_migrations(self):
+        """Применяет недостающие миграции; advisory lock не дает экземплярам применять их одновременно"""
+        async with self._pool.acquire() as conn:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
+                )
+            ''')
+            for version, name, statements in self._get_migrations():
+                async with conn.transaction():
+                    await conn.execute("SELECT pg_advisory_xact_lock(hashtext('schema_version'))")
+                    if await conn.fetchval("SELECT 1 FROM schema_version WHERE version = $1", version):
+                        continue
+                    for statement in statements:
+                        await conn.execute(statement)
+                    await conn.execute("INSERT INTO schema_version (version, name) VALUES ($1, $2)", version, name)
+                logger.info(f"Применена миграция схемы PostgreSQL {version}: {name}")
+    
+    async def _seed_defaults(self):
+        async with self.transaction() as conn:
+            await conn.executemany(
+                "INSERT INTO settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING",
+                DEFAULT_SETTINGS
+            )
+            
+            # Добавляем дефолтный хост и его тарифы, если его нет
+            if DEFAULT_XUI_HOST and DEFAULT_XUI_USERNAME and DEFAULT_XUI_PASSWORD:
+                host_id = await conn.fetchval('''
+                    INSERT INTO hosts (host_name, host_url, host_username, host_pass, host_inbound_id)
+                    VALUES ($1, $2, $3, $4, $5)
+                    ON CONFLICT (host_name) DO NOTHING
+                    RETURNING host_id
+                ''', "Default Server", DEFAULT_XUI_HOST, DEFAULT_XUI_USERNAME, DEFAULT_XUI_PASSWORD,
+                    DEFAULT_XUI_INBOUND_ID)
+                if host_id:
+                    await conn.executemany(
+                        "INSERT INTO plans (host_name, plan_name, months, price) VALUES ($1, $2, $3, $4)",
+                        DEFAULT_PLANS
+                    )
+    
+    # === КЭШИ ===
+    def _on_cache_notify(self, connection, pid: int, channel: str, payload: str):
+        reload = self.reload_settings if payload == 'settings' else self.reload_catalog
+        task = asyncio.create_task(reload())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _notify(self, conn, payload: str):
+        await conn.execute("SELECT pg_notify($1, $2)", PG_CACHE_CHANNEL, payload)
+    
+    # === ПОЛЬЗОВАТЕЛИ ===
+    async def get_user(self, telegram_id: int) -> Optional[Dict]:
+        row = await self._pool.fetchrow("SELECT * FROM users WHERE telegram_id = $1", telegram_id)
+        return record_row(row, UserRow)
+    
+    async def register_user(self, telegram_id: int, username: str, full_name: str, referrer_id: int = None):
+        await self._pool.execute(f'''
+            INSERT INTO users (telegram_id, username, full_name, referred_by, created_ts)
+            VALUES ($1, $2, $3, $4, {PG_NOW})
+            ON CONFLICT (telegram_id) DO NOTHING
+        ''', telegram_id, username, full_name, referrer_id)
+    
+    async def update_user_profile(self, telegram_id: int, username: Optional[str], full_name: Optional[str]):
+        await self._pool.execute('''
+            UPDATE users SET username = $1, full_name = $2
+            WHERE telegram_id = $3 AND (username IS DISTINCT FROM $1 OR full_name IS DISTINCT FROM $2)
+        ''', username, full_name, telegram_id)
+    
+    async def _update_user_stats(self, conn, telegram_id: int, amount: float, months: int):
+        await conn.execute('''
+            UPDATE users
+            SET total_spent = total_spent + $1,
+                total_months = total_months + $2
+            WHERE telegram_id = $3
+        ''', amount, months, telegram_id)
+    
+    async def update_user_stats(self, telegram_id: int, amount: float, months: int):
+        await self._update_user_stats(self._pool, telegram_id, amount, months)
+    
+    async def set_trial_used(self, telegram_id: int):
+        await self._pool.execute("UPDATE users SET trial_used = 1 WHERE telegram_id = $1", telegram_id)
+    
+    async def ban_user(self, user_id: int):
+        await self._pool.execute("UPDATE users SET is_banned = 1 WHERE telegram_id = $1", user_id)
+    
+    async def unban_user(self, user_id: int):
+        await self._pool.execute("UPDATE users SET is_banned = 0 WHERE telegram_id = $1", user_id)
+    
+    async def _add_referral_balance(self, conn, user_id: int, amount: float):
+        await conn.execute('''
+            UPDATE users
+            SET referral_balance = referral_balance + $1
+            WHERE telegram_id = $2
+        ''', amount, user_id)
+    
+    async def add_referral_balance(self, user_id: int, amount: float):
+        await self._add_referral_balance(self._pool, user_id, amount)
+    
+    async def withdraw_referral_balance(self, user_id: int, amount: float, details: str):
+        async with self.transaction() as conn:
+            await self._add_referral_balance(conn, user_id, -amount)
+            return await conn.fetchval('''
+                INSERT INTO referral_withdrawals (user_id, amount, details)
+                VALUES ($1, $2, $3)
+                RETURNING withdrawal_id
+            ''', user_id, amount, details)
+    
+    async def get_referral_withdrawals(self, status: str = None) -> List[Dict]:
+        if status:
+            rows = await self._pool.fetch('''
+                SELECT rw.*, u.username, u.full_name
+                FROM referral_withdrawals rw
+                JOIN users u ON rw.user_id = u.telegram_id
+                WHERE rw.status = $1
+                ORDER BY rw.created_at DESC
+            ''', status)
+        else:
+            rows = await self._pool.fetch('''
+                SELECT rw.*, u.username, u.full_name
+                FROM referral_withdrawals rw
+                JOIN users u ON rw.user_id = u.telegram_id
+                ORDER BY rw.created_at DESC
+                LIMIT 100
+            ''')
+        return [dict(row) for row in rows]
+    
+    async def get_withdrawal(self, withdrawal_id: int, conn=None) -> Optional[Dict]:
+        row = await (conn or self._pool).fetchrow('''
+            SELECT rw.*, u.username, u.full_name
+            FROM referral_withdrawals rw
+            JOIN users u ON rw.user_id = u.telegram_id
+            WHERE rw.withdrawal_id = $1
+        ''', withdrawal_id)
+        return dict(row) if row else None
+    
+    async def transition_withdrawal(self, withdrawal_id: int, from_status: str, to_status: str,
+                                    admin_notes: str = None, conn=None) -> bool:
+        """Меняет статус заявки, только если она еще в from_status: повторный клик ничего не сделает"""
+        status = await (conn or self._pool).execute(f'''
+            UPDATE referral_withdrawals
+            SET status = $1, admin_notes = $2, processed_at = {PG_UTC_NOW}
+            WHERE withdrawal_id = $3 AND status = $4
+        ''', to_status, admin_notes, withdrawal_id, from_status)
+        return pg_rowcount(status) == 1
+    
+    async def reject_withdrawal(self, withdrawal_id: int, admin_notes: str) -> Optional[Dict]:
+        """Отклоняет ожидающую заявку и возвращает сумму на реферальный баланс одной транзакцией"""
+        async with self.transaction() as conn:
+            if not await self.transition_withdrawal(withdrawal_id, 'pending', 'rejected', admin_notes, conn=conn):
+                return None
+            withdrawal = await self.get_withdrawal(withdrawal_id, conn=conn)
+            await self._add_referral_balance(conn, withdrawal['user_id'], withdrawal['amount'])
+            return withdrawal
+    
+    async def get_referrals(self, referrer_id: int) -> List[UserRow]:
+        rows = await self._pool.fetch('''
+            SELECT * FROM users
+            WHERE referred_by = $1
+            ORDER BY created_at DESC
+        ''', referrer_id)
+        return record_rows(rows, UserRow)
+    
+    async def search_users(self, query: str, limit: int = 20) -> List[UserRow]:
+        """Поиск по ID, username, имени, email или UUID ключа (в том числе внутри вставленного конфига)"""
+        query = query.strip().lstrip('@')
+        
+        if query.isdigit():
+            rows = await self._pool.fetch("SELECT * FROM users WHERE telegram_id = $1", int(query))
+            if rows:
+                return record_rows(rows, UserRow)
+        
+        uuid_match = UUID_PATTERN.search(query)
+        if uuid_match:
+            query = uuid_match.group(0).lower()
+        
+        escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        if len(query) < 3:
+            rows = await self._pool.fetch(
+                "SELECT * FROM users WHERE username ILIKE $1 OR full_name ILIKE $1 LIMIT $2",
+                f"{escaped}%", limit
+            )
+            return record_rows(rows, UserRow)
+        
+        # Подстрока ищется по триграммным индексам; совпадения в username и имени выше, чем в ключах
+        rows = await self._pool.fetch('''
+            SELECT u.*
+            FROM users u
+            WHERE u.username ILIKE $1 OR u.full_name ILIKE $1
+            OR EXISTS (
+                SELECT 1 FROM user_keys uk
+                WHERE uk.user_id = u.telegram_id
+                AND (uk.key_email ILIKE $1 OR uk.xui_client_uuid ILIKE $1)
+            )
+            ORDER BY u.username ILIKE $1 DESC, u.full_name ILIKE $1 DESC, u.created_ts DESC
+            LIMIT $2
+        ''', f"%{escaped}%", limit)
+        return record_rows(rows, UserRow)
+    
+    def _with_user_counts(self, users_query: str, order: str) -> str:
+        """Дополняет выборку пользователей числом ключей, активных ключей и рефералов"""
+        return f'''
+            WITH page AS ({users_query}),
+            key_counts AS (
+                SELECT uk.user_id,
+                    COUNT(*) as key_count,
+                    COUNT(*) FILTER (WHERE uk.expiry_ts > {PG_NOW}) as active_key_count
+                FROM page
+                JOIN user_keys uk ON uk.user_id = page.telegram_id
+                GROUP BY uk.user_id
+            ),
+            referral_counts AS (
+                SELECT r.referred_by as user_id, COUNT(*) as referral_count
+                FROM page
+                JOIN users r ON r.referred_by = page.telegram_id
+                GROUP BY r.referred_by
+            )
+            SELECT page.*,
+                COALESCE(kc.key_count, 0) as key_count,
+                COALESCE(kc.active_key_count, 0) as active_key_count,
+                COALESCE(rc.referral_count, 0) as referral_count
+            FROM page
+            LEFT JOIN key_counts kc ON kc.user_id = page.telegram_id
+            LEFT JOIN referral_counts rc ON rc.user_id = page.telegram_id
+            ORDER BY {order}
+        '''
+    
+    async def get_user_with_counts(self, telegram_id: int) -> Optional[Dict]:
+        row = await self._pool.fetchrow(
+            self._with_user_counts("SELECT * FROM users WHERE telegram_id = $1", "telegram_id"),
+            telegram_id
+        )
+        return record_row(row, UserRow)
+    
+    async def get_recent_users_with_counts(self, limit: int = 20) -> List[UserRow]:
+        rows = await self._pool.fetch(
+            self._with_user_counts(
+                "SELECT * FROM users ORDER BY created_ts DESC, telegram_id DESC LIMIT $1",
+                "created_ts DESC, telegram_id DESC"
+            ),
+            limit
+        )
+        return record_rows(rows, UserRow)
+    
+    async def get_referral_count(self, referrer_id: int) -> int:
+        return await self._pool.fetchval("SELECT COUNT(*) FROM users WHERE referred_by = $1", referrer_id)
+    
+    async def get_all_users(self, limit: int = 1000) -> List[UserRow]:
+        rows = await self._pool.fetch("SELECT * FROM users ORDER BY created_ts DESC LIMIT $1", limit)
+        return record_rows(rows, UserRow)
+    
+    async def get_all_users_count(self) -> int:
+        return await self.get_user_count()
+    
+    async def get_active_users(self) -> List[UserRow]:
+        rows = await self._pool.fetch("SELECT * FROM users WHERE is_banned = 0 ORDER BY created_ts DESC")
+        return record_rows(rows, UserRow)
+    
+    async def get_banned_users(self) -> List[UserRow]:
+        rows = await self._pool.fetch("SELECT * FROM users WHERE is_banned = 1 ORDER BY created_ts DESC")
+        return record_rows(rows, UserRow)
+    
+    async def get_today_users(self) -> int:
+        return await self._pool.fetchval(f"SELECT COUNT(*) FROM users WHERE created_ts >= {PG_TODAY_START}")
+    
+    async def get_user_context(self, telegram_id: int) -> Dict:
+        async with self._pool.acquire() as conn:
+            row = await conn.fetchrow("SELECT * FROM users WHERE telegram_id = $1", telegram_id)
+            context = dict(await conn.fetchrow(f'''
+                SELECT
+                    COUNT(*) as key_count,
+                    COUNT(*) FILTER (WHERE expiry_ts > {PG_NOW}) as active_key_count,
+                    MAX(expiry_ts) as latest_expiry_ts,
+                    CASE WHEN COUNT(*) > 0 THEN GREATEST(0, MAX(expiry_ts) - {PG_NOW}) END as seconds_left
+                FROM user_keys
+                WHERE user_id = $1
+            ''', telegram_id))
+        context['user'] = record_row(row, UserRow)
+        return context
+    
+    async def get_user_activity_stats(self, days: int = 7) -> Dict:
+        row = await self._pool.fetchrow(f'''
+            SELECT
+                COUNT(DISTINCT user_id) as active_users,
+                COUNT(*) as total_keys_created
+            FROM user_keys
+            WHERE created_ts >= {PG_NOW} - $1
+        ''', days * 86400)
+        return dict(row)
+    
+    # === КЛЮЧИ ===
+    async def _add_key(self, conn, user_id: int, host_name: str, xui_client_uuid: str,
+                       key_email: str, expiry_date: datetime) -> int:
+        return await conn.fetchval(f'''
+            INSERT INTO user_keys
+            (user_id, host_name, xui_client_uuid, key_email, expiry_date, expiry_ts, created_ts)
+            VALUES ($1, $2, $3, $4, $5, $6, {PG_NOW})
+            RETURNING key_id
+        ''', user_id, host_name, xui_client_uuid, key_email, expiry_date, int(expiry_date.timestamp()))
+    
+    async def add_key(self, user_id: int, host_name: str, xui_client_uuid: str,
+                      key_email: str, expiry_date: datetime) -> int:
+        return await self._add_key(self._pool, user_id, host_name, xui_client_uuid, key_email, expiry_date)
+    
+    async def get_user_keys(self, user_id: int, limit: int = -1) -> List[KeyRow]:
+        rows = await self._pool.fetch(f'''
+            SELECT *,
+                {pg_days_left('expiry_ts')} as days_left,
+                (expiry_ts <= {PG_NOW})::int as is_expired
+            FROM user_keys
+            WHERE user_id = $1
+            ORDER BY created_ts DESC
+            LIMIT $2
+        ''', user_id, limit if limit >= 0 else None)
+        return record_rows(rows, KeyRow)
+    
+    async def get_key_by_id(self, key_id: int) -> Optional[Dict]:
+        row = await self._pool.fetchrow(f'''
+            SELECT *,
+                {pg_days_left('expiry_ts')} as days_left,
+                (expiry_ts <= {PG_NOW})::int as is_expired
+            FROM user_keys
+            WHERE key_id = $1
+        ''', key_id)
+        return record_row(row, KeyRow)
+    
+    async def get_active_user_keys(self, user_id: int) -> List[KeyRow]:
+        rows = await self._pool.fetch(f'''
+            SELECT *, {pg_days_left('expiry_ts')} as days_left
+            FROM user_keys
+            WHERE user_id = $1 AND expiry_ts > {PG_NOW}
+            ORDER BY expiry_ts DESC
+        ''', user_id)
+        return record_rows(rows, KeyRow)
+    
+    async def update_key_expiry(self, key_id: int, expiry_date: datetime):
+        await self._pool.execute(
+            "UPDATE user_keys SET expiry_date = $1, expiry_ts = $2 WHERE key_id = $3",
+            expiry_date, int(expiry_date.timestamp()), key_id
+        )
+    
+    async def delete_key(self, key_id: int):
+        await self._pool.execute("DELETE FROM user_keys WHERE key_id = $1", key_id)
+    
+    async def delete_user_keys(self, user_id: int):
+        await self._pool.execute("DELETE FROM user_keys WHERE user_id = $1", user_id)
+    
+    async def get_next_key_number(self, user_id: int) -> int:
+        return await self._pool.fetchval("SELECT COUNT(*) FROM user_keys WHERE user_id = $1", user_id) + 1
+    
+    async def get_active_keys_count(self) -> int:
+        return await self._pool.fetchval(
+            f"SELECT COUNT(*) FROM user_keys WHERE expiry_ts > {PG_NOW} AND is_active = 1"
+        )
+    
+    async def get_expiring_keys(self, days: int = 7) -> List[KeyRow]:
+        rows = await self._pool.fetch(f'''
+            SELECT uk.*, u.username, u.full_name,
+                {pg_days_left('uk.expiry_ts')} as days_left
+            FROM user_keys uk
+            JOIN users u ON uk.user_id = u.telegram_id
+            WHERE uk.expiry_ts BETWEEN {PG_NOW} AND {PG_NOW} + $1
+            AND uk.is_active = 1
+            ORDER BY uk.expiry_ts ASC
+        ''', days * 86400)
+        return record_rows(rows, KeyRow)
+    
+    # === ХОСТЫ И ТАРИФЫ ===
+    # Как и в SQLite, покупки читают каталог из снимка в памяти
+    async def reload_catalog(self):
+        async with self._pool.acquire() as conn:
+            hosts = record_rows(await conn.fetch("SELECT * FROM hosts ORDER BY host_name"), HostRow)
+            plans = record_rows(await conn.fetch("SELECT * FROM plans ORDER BY host_name, price, plan_id"), PlanRow)
+        version = self._catalog.version + 1 if self._catalog else 1
+        self._catalog = build_catalog(version, hosts, plans)
+    
+    async def _catalog_changed(self):
+        await self._notify(self._pool, 'catalog')
+        await self.reload_catalog()
+    
+    async def add_host(self, name: str, url: str, username: str, password: str, inbound_id: int):
+        await self._pool.execute(f'''
+            INSERT INTO hosts (host_name, host_url, host_username, host_pass, host_inbound_id)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (host_name) DO UPDATE
+            SET host_url = EXCLUDED.host_url, host_username = EXCLUDED.host_username,
+                host_pass = EXCLUDED.host_pass, host_inbound_id = EXCLUDED.host_inbound_id,
+                is_active = 1, created_at = {PG_UTC_NOW}
+        ''', name, url, username, password, inbound_id)
+        await self._catalog_changed()
+    
+    async def get_all_hosts(self) -> List[HostRow]:
+        return list(self._catalog.active_hosts)
+    
+    async def get_host(self, host_name: str) -> Optional[HostRow]:
+        return self._catalog.hosts.get(host_name)
+    
+    async def get_host_by_id(self, host_id: int) -> Optional[HostRow]:
+        return self._catalog.hosts_by_id.get(host_id)
+    
+    async def update_host(self, host_name: str, **kwargs):
+        set_clause = ', '.join(f"{key} = ${number}" for number, key in enumerate(kwargs, 1))
+        await self._pool.execute(
+            f"UPDATE hosts SET {set_clause} WHERE host_name = ${len(kwargs) + 1}",
+            *kwargs.values(), host_name
+        )
+        await self._catalog_changed()
+    
+    async def delete_host(self, host_name: str):
+        async with self.transaction() as conn:
+            await conn.execute("UPDATE hosts SET is_active = 0 WHERE host_name = $1", host_name)
+            await conn.execute("UPDATE plans SET is_active = 0 WHERE host_name = $1", host_name)
+        await self._catalog_changed()
+    
+    async def get_hosts_count(self) -> int:
+        return len(self._catalog.active_hosts)
+    
+    async def add_plan(self, host_name: str, plan_name: str, months: int, price: float):
+        await self._pool.execute('''
+            INSERT INTO plans (host_name, plan_name, months, price)
+            VALUES ($1, $2, $3, $4)
+        ''', host_name, plan_name, months, price)
+        await self._catalog_changed()
+    
+    async def get_plans_for_host(self, host_name: str) -> List[PlanRow]:
+        return list(self._catalog.plans_by_host.get(host_name, ()))
+    
+    async def get_plan_by_id(self, plan_id: int) -> Optional[PlanRow]:
+        return self._catalog.plans.get(plan_id)
+    
+    async def get_all_plans(self) -> List[PlanRow]:
+        return list(self._catalog.active_plans)
+    
+    async def update_plan(self, plan_id: int, **kwargs):
+        set_clause = ', '.join(f"{key} = ${number}" for number, key in enumerate(kwargs, 1))
+        await self._pool.execute(
+            f"UPDATE plans SET {set_clause} WHERE plan_id = ${len(kwargs) + 1}",
+            *kwargs.values(), plan_id
+        )
+        await self._catalog_changed()
+    
+    async def delete_plan(self, plan_id: int):
+        await self._pool.execute("UPDATE plans SET is_active = 0 WHERE plan_id = $1", plan_id)
+        await self._catalog_changed()
+    
+    async def get_plans_count(self) -> int:
+        return len(self._catalog.active_plans)
+    
+    # === ТРАНЗАКЦИИ ===
+    async def _log_transaction(self, conn, username: str, user_id: int, status: str,
+                               amount_rub: float, payment_method: str, metadata: dict):
+        await conn.execute(f'''
+            INSERT INTO transactions
+            (username, user_id, status, amount_rub, payment_method, metadata, created_ts)
+            VALUES ($1, $2, $3, $4, $5, $6, {PG_NOW})
+        ''', username, user_id, status, amount_rub, payment_method, json.dumps(metadata))
+    
+    async def log_transaction(self, username: str, user_id: int, status: str,
+                              amount_rub: float, payment_method: str, metadata: dict):
+        await self._log_transaction(self._pool, username, user_id, status, amount_rub, payment_method, metadata)
+    
+    async def get_user_transactions(self, user_id: int, limit: int = 50) -> List[Dict]:
+        rows = await self._pool.fetch('''
+            SELECT * FROM transactions
+            WHERE user_id = $1
+            ORDER BY created_ts DESC
+            LIMIT $2
+        ''', user_id, limit)
+        return [dict(row) for row in rows]
+    
+    # Выручка считается по индексу transactions(status, created_ts) без отдельной сводки,
+    # поэтому срок хранения транзакций должен быть больше окна отчетов
+    async def _get_revenue_for_days(self, days: int) -> float:
+        """Выручка за последние days календарных дней, включая сегодняшний"""
+        result = await self._pool.fetchval('''
+            SELECT SUM(amount_rub) FROM transactions
+            WHERE status = 'paid'
+            AND created_ts >= EXTRACT(EPOCH FROM date_trunc('day', now()) - make_interval(days => $1))::bigint
+        ''', days - 1)
+        return result if result else 0.0
+    
+    async def get_today_revenue(self) -> float:
+        return await self._get_revenue_for_days(1)
+    
+    async def get_week_revenue(self) -> float:
+        return await self._get_revenue_for_days(7)
+    
+    async def get_month_revenue(self) -> float:
+        return await self._get_revenue_for_days(30)
+    
+    async def get_total_revenue(self) -> float:
+        return await self._pool.fetchval("SELECT COALESCE(SUM(total_spent), 0) FROM users")
+    
+    async def get_revenue_stats(self, days: int = 30) -> List[Dict]:
+        rows = await self._pool.fetch('''
+            SELECT
+                to_char(to_timestamp(created_ts), 'YYYY-MM-DD') as date,
+                COUNT(*) as transactions,
+                SUM(amount_rub) as revenue
+            FROM transactions
+            WHERE status = 'paid'
+            AND created_ts >= EXTRACT(EPOCH FROM date_trunc('day', now()) - make_interval(days => $1))::bigint
+            GROUP BY 1
+            ORDER BY 1 DESC
+        ''', days - 1)
+        return [dict(row) for row in rows]
+    
+    async def rebuild_revenue_daily(self):
+        """Дневной сводки в PostgreSQL нет, пересобирать нечего"""
+    
+    # === CRYPTO PAYMENTS ===
+    async def create_crypto_payment(self, invoice_id: str, user_id: int, plan_id: int,
+                                    amount: float, asset: str, metadata: dict, key_id: int = None):
+        await self._pool.execute(f'''
+            INSERT INTO crypto_payments
+            (invoice_id, user_id, plan_id, key_id, amount, asset, metadata, created_ts)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, {PG_NOW})
+            ON CONFLICT (invoice_id) DO UPDATE
+            SET user_id = EXCLUDED.user_id, plan_id = EXCLUDED.plan_id, key_id = EXCLUDED.key_id,
+                amount = EXCLUDED.amount, asset = EXCLUDED.asset, metadata = EXCLUDED.metadata,
+                status = 'pending', created_at = {PG_UTC_NOW}, updated_at = {PG_UTC_NOW},
+                created_ts = EXCLUDED.created_ts
+        ''', invoice_id, user_id, plan_id, key_id, amount, asset, json.dumps(metadata))
+    
+    async def get_crypto_payment(self, invoice_id: str) -> Optional[Dict]:
+        row = await self._pool.fetchrow("SELECT * FROM crypto_payments WHERE invoice_id = $1", invoice_id)
+        return record_row(row, PaymentRow)
+    
+    async def update_crypto_payment_status(self, invoice_id: str, status: str):
+        await self._pool.execute(f'''
+            UPDATE crypto_payments
+            SET status = $1, updated_at = {PG_UTC_NOW}
+            WHERE invoice_id = $2
+        ''', status, invoice_id)
+    
+    async def update_crypto_payment_metadata(self, invoice_id: str, metadata: dict):
+        await self._pool.execute(f'''
+            UPDATE crypto_payments
+            SET metadata = $1, updated_at = {PG_UTC_NOW}
+            WHERE invoice_id = $2
+        ''', json.dumps(metadata), invoice_id)
+    
+    async def claim_crypto_payment(self, invoice_id: str) -> bool:
+        """Забирает платеж в обработку, чтобы один счет не выдал два ключа даже на разных экземплярах"""
+        status = await self._pool.execute(f'''
+            UPDATE crypto_payments
+            SET status = 'processing', updated_at = {PG_UTC_NOW}
+            WHERE invoice_id = $1 AND status IN ('pending', 'error')
+        ''', invoice_id)
+        return pg_rowcount(status) == 1
+    
+    async def release_interrupted_crypto_payments(self, older_than_sec: int = 600) -> int:
+        """Возвращает в очередь зависшие платежи. Свежие не трогаются: их может обрабатывать
+        другой экземпляр бота"""
+        status = await self._pool.execute(f'''
+            UPDATE crypto_payments
+            SET status = 'pending', updated_at = {PG_UTC_NOW}
+            WHERE status = 'processing' AND updated_at < {PG_UTC_NOW} - make_interval(secs => $1)
+        ''', older_than_sec)
+        return pg_rowcount(status)
+    
+    async def fulfill_crypto_payment(self, invoice_id: str, host_name: str, client_uuid: str, key_email: str,
+                                     expiry_date: datetime, months: int, price_rub: float,
+                                     referral_percentage: float = 0) -> int:
+        """Все записи по оплаченному счету одной транзакцией: ключ, статистика,
+        транзакция, бонус реферера и статус платежа. Возвращает key_id"""
+        async with self.transaction() as conn:
+            payment = await conn.fetchrow('''
+                SELECT cp.user_id, cp.plan_id, u.username, u.full_name, u.referred_by
+                FROM crypto_payments cp
+                JOIN users u ON cp.user_id = u.telegram_id
+                WHERE cp.invoice_id = $1 AND cp.status = 'processing'
+                FOR UPDATE OF cp
+            ''', invoice_id)
+            if not payment:
+                raise ValueError(f"Payment {invoice_id} is not claimed for processing")
+            
+            user_id = payment['user_id']
+            key_id = await self._add_key(conn, user_id, host_name, client_uuid, key_email, expiry_date)
+            await self._update_user_stats(conn, user_id, price_rub, months)
+            await self._log_transaction(
+                conn,
+                username=payment['username'] or payment['full_name'],
+                user_id=user_id,
+                status='paid',
+                amount_rub=price_rub,
+                payment_method='CryptoBot',
+                metadata={
+                    'plan_id': payment['plan_id'],
+                    'key_id': key_id,
+                    'invoice_id': invoice_id
+                }
+            )
+            
+            if referral_percentage and payment['referred_by']:
+                await self._add_referral_balance(conn, payment['referred_by'], price_rub * (referral_percentage / 100))
+            
+            await conn.execute(f'''
+                UPDATE crypto_payments
+                SET status = 'paid', key_id = $1, updated_at = {PG_UTC_NOW}
+                WHERE invoice_id = $2
+            ''', key_id, invoice_id)
+            return key_id
+    
+    async def get_pending_payments(self, include_errors: bool = False) -> List[PaymentRow]:
+        statuses = "('pending', 'error')" if include_errors else "('pending')"
+        rows = await self._pool.fetch(f'''
+            SELECT cp.*, u.username, u.full_name, p.plan_name, p.host_name
+            FROM crypto_payments cp
+            JOIN users u ON cp.user_id = u.telegram_id
+            JOIN plans p ON cp.plan_id = p.plan_id
+            WHERE cp.status IN {statuses}
+            ORDER BY cp.created_at DESC
+        ''')
+        return record_rows(rows, PaymentRow)
+    
+    async def get_payments_by_status(self, status: str, limit: int = 100) -> List[PaymentRow]:
+        rows = await self._pool.fetch('''
+            SELECT cp.*, u.username, u.full_name, p.plan_name, p.host_name
+            FROM crypto_payments cp
+            JOIN users u ON cp.user_id = u.telegram_id
+            JOIN plans p ON cp.plan_id = p.plan_id
+            WHERE cp.status = $1
+            ORDER BY cp.created_at DESC
+            LIMIT $2
+        ''', status, limit)
+        return record_rows(rows, PaymentRow)
+    
+    # === НАСТРОЙКИ ===
+    async def reload_settings(self):
+        rows = await self._pool.fetch("SELECT key, value FROM settings ORDER BY key")
+        settings = {row['key']: row['value'] for row in rows}
+        # Словарь меняется на месте: его же читает SettingsView
+        self._settings.clear()
+        self._settings.update(settings)
+    
+    async def get_setting(self, key: str, default: str = "") -> str:
+        return self.sync.get_setting(key, default)
+    
+    async def update_setting(self, key: str, value: str):
+        await self._pool.execute(f'''
+            INSERT INTO settings (key, value) VALUES ($1, $2)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = {PG_UTC_NOW}
+        ''', key, value)
+        self._settings[key] = value
+        await self._notify(self._pool, 'settings')
+    
+    async def get_all_settings(self) -> Dict[str, str]:
+        return dict(sorted(self._settings.items()))
+    
+    async def delete_setting(self, key: str):
+        await self._pool.execute("DELETE FROM settings WHERE key = $1", key)
+        self._settings.pop(key, None)
+        await self._notify(self._pool, 'settings')
+    
+    # === SUPPORT MESSAGES ===
+    async def create_support_message(self, user_id: int, message: str):
+        return await self._pool.fetchval('''
+            INSERT INTO support_messages (user_id, message)
+            VALUES ($1, $2)
+            RETURNING message_id
+        ''', user_id, message)
+    
+    async def get_support_messages(self, status: str = None, limit: int = 100) -> List[Dict]:
+        if status:
+            rows = await self._pool.fetch('''
+                SELECT sm.*, u.username, u.full_name
+                FROM support_messages sm
+                JOIN users u ON sm.user_id = u.telegram_id
+                WHERE sm.status = $1
+                ORDER BY sm.created_at DESC
+                LIMIT $2
+            ''', status, limit)
+        else:
+            rows = await self._pool.fetch('''
+                SELECT sm.*, u.username, u.full_name
+                FROM support_messages sm
+                JOIN users u ON sm.user_id = u.telegram_id
+                ORDER BY sm.created_at DESC
+                LIMIT $1
+            ''', limit)
+        return [dict(row) for row in rows]
+    
+    async def update_support_message(self, message_id: int, status: str, admin_response: str = None):
+        if status == 'closed':
+            await self._pool.execute(f'''
+                UPDATE support_messages
+                SET status = $1, admin_response = $2, responded_at = {PG_UTC_NOW}
+                WHERE message_id = $3
+            ''', status, admin_response, message_id)
+        else:
+            await self._pool.execute('''
+                UPDATE support_messages
+                SET status = $1, admin_response = $2
+                WHERE message_id = $3
+            ''', status, admin_response, message_id)
+    
+    # === BROADCASTS ===
+    async def create_broadcast(self, admin_id: int, message: str, total_users: int):
+        return await self._pool.fetchval('''
+            INSERT INTO broadcasts (admin_id, message, total_users)
+            VALUES ($1, $2, $3)
+            RETURNING broadcast_id
+        ''', admin_id, message, total_users)
+    
+    async def update_broadcast_stats(self, broadcast_id: int, sent: int = 0, failed: int = 0,
+                                     status: str = None):
+        await self._pool.execute(f'''
+            UPDATE broadcasts
+            SET sent_count = sent_count + $1,
+                failed_count = failed_count + $2,
+                status = COALESCE($3, status),
+                completed_at = CASE WHEN $3 = 'completed' THEN {PG_UTC_NOW} ELSE completed_at END
+            WHERE broadcast_id = $4
+        ''', sent, failed, status, broadcast_id)
+    
+    async def get_broadcasts(self, limit: int = 50) -> List[Dict]:
+        rows = await self._pool.fetch('''
+            SELECT b.*, u.username as admin_username
+            FROM broadcasts b
+            LEFT JOIN users u ON b.admin_id = u.telegram_id
+            ORDER BY b.created_at DESC
+            LIMIT $1
+        ''', limit)
+        return [dict(row) for row in rows]
+    
+    # === ADMIN LOGS ===
+    async def log_admin_action(self, admin_id: int, action: str, details: str):
+        await self._pool.execute('''
+            INSERT INTO admin_logs (admin_id, action, details)
+            VALUES ($1, $2, $3)
+        ''', admin_id, action, details)
+    
+    async def clear_admin_logs(self):
+        await self._pool.execute("DELETE FROM admin_logs")
+    
+    # === ХРАНЕНИЕ И АРХИВ ===
+    async def _prepare_archive_table(self, conn, table: str) -> List[str]:
+        """Создает копию таблицы в схеме archive и досоздает колонки, добавленные миграциями"""
+        columns_query = '''
+            SELECT column_name, data_type FROM information_schema.columns
+            WHERE table_schema = $1 AND table_name = $2
+            ORDER BY ordinal_position
+        '''
+        schema = await conn.fetchval("SELECT current_schema()")
+        columns = await conn.fetch(columns_query, schema, table)
+        if table in self._archive_ready:
+            return [row['column_name'] for row in columns]
+        
+        await conn.execute("CREATE SCHEMA IF NOT EXISTS archive")
+        await conn.execute(f"CREATE TABLE IF NOT EXISTS archive.{table} (LIKE {table})")
+        archived = {row['column_name'] for row in await conn.fetch(columns_query, 'archive', table)}
+        for row in columns:
+            if row['column_name'] not in archived:
+                await conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {row['column_name']} {row['data_type']}")
+        
+        # Уникальный ключ делает повторный перенос той же строки безопасным
+        keys = await conn.fetch('''
+            SELECT a.attname FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+            WHERE i.indrelid = $1::text::regclass AND i.indisprimary
+        ''', table)
+        await conn.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_key ON archive.{table} "
+            f"({', '.join(row['attname'] for row in keys)})"
+        )
+        self._archive_ready.add(table)
+        return [row['column_name'] for row in columns]
+    
+    async def archive_batch(self, table: str, batch_size: int = DB_ARCHIVE_BATCH_SIZE) -> int:
+        """Переносит в архив одну пачку строк старше срока хранения; возвращает число перенесенных строк"""
+        date_column, condition, days = RETENTION_POLICIES[table]
+        if days <= 0:
+            return 0
+        
+        async with self._pool.acquire() as conn:
+            columns = ', '.join(await self._prepare_archive_table(conn, table))
+            # Удаление и вставка в архив - одна команда, а SKIP LOCKED не дает экземплярам мешать друг другу
+            return await conn.fetchval(f'''
+                WITH moved AS (
+                    DELETE FROM {table} WHERE ctid IN (
+                        SELECT ctid FROM {table}
+                        WHERE {date_column} < {PG_UTC_NOW} - make_interval(days => $1) AND {condition}
+                        ORDER BY {date_column}
+                        LIMIT $2
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING *
+                ), archived AS (
+                    INSERT INTO archive.{table} ({columns})
+                    SELECT {columns} FROM moved
+                    ON CONFLICT DO NOTHING
+                )
+                SELECT COUNT(*) FROM moved
+            ''', days, batch_size)
+    
+    async def incremental_vacuum(self, pages: int = DB_VACUUM_STEP_PAGES) -> int:
+        """Место в PostgreSQL возвращает autovacuum, шаги не нужны"""
+        return 0
+    
+    # === ПАГИНАЦИЯ ===
+    async def _fetch_page(self, select: str, where: Optional[str], params: tuple, sort_columns: Tuple[str, ...],
+                          key: Optional[tuple] = None, backward: bool = False, limit: int = PAGE_SIZE,
+                          with_user_counts: bool = False, row_type: Optional[type] = None) -> Page:
+        """Keyset-страница выборки: см. keyset_page_query"""
+        query, args, order = keyset_page_query(select, where, params, sort_columns, key, backward, limit)
+        if with_user_counts:
+            query = self._with_user_counts(query, order)
+        rows = await self._pool.fetch(pg_placeholders(query), *args)
+        rows = record_rows(rows, row_type) if row_type else [dict(row) for row in rows]
+        return keyset_page(rows, sort_columns, key, backward, limit)
+    
+    async def get_users_page(self, key: Optional[tuple] = None, backward: bool = False, limit: int = PAGE_SIZE) -> Page:
+        return await self._fetch_page(
+            "SELECT * FROM users", None, (),
+            ("created_ts", "telegram_id"), key, backward, limit, with_user_counts=True, row_type=UserRow
+        )
+    
+    async def get_referrals_page(self, referrer_id: int, key: Optional[tuple] = None,
+                                 backward: bool = False, limit: int = PAGE_SIZE) -> Page:
+        return await self._fetch_page(
+            "SELECT * FROM users", "referred_by = ?", (referrer_id,),
+            ("created_ts", "telegram_id"), key, backward, limit, row_type=UserRow
+        )
+    
+    async def get_transactions_page(self, key: Optional[tuple] = None, backward: bool = False,
+                                    limit: int = PAGE_SIZE) -> Page:
+        return await self._fetch_page(
+            '''SELECT t.*, u.username, u.full_name
+               FROM transactions t
+               LEFT JOIN users u ON t.user_id = u.telegram_id''', None, (),
+            ("t.transaction_id",), key, backward, limit
+        )
+    
+    async def get_payments_page(self, status: str, key: Optional[tuple] = None,
+                                backward: bool = False, limit: int = PAGE_SIZE) -> Page:
+        return await self._fetch_page(
+            '''SELECT cp.*, u.username, u.full_name, p.plan_name, p.host_name
+               FROM crypto_payments cp
+               JOIN users u ON cp.user_id = u.telegram_id
+               LEFT JOIN plans p ON cp.plan_id = p.plan_id''', "cp.status = ?", (status,),
+            ("cp.created_ts", "cp.payment_seq"), key, backward, limit, row_type=PaymentRow
+        )
+    
+    async def get_admin_logs_page(self, key: Optional[tuple] = None, backward: bool = False,
+                                  limit: int = PAGE_SIZE) -> Page:
+        return await self._fetch_page(
+            '''SELECT al.*, u.username, u.full_name
+               FROM admin_logs al
+               LEFT JOIN users u ON al.admin_id = u.telegram_id''', None, (),
+            ("al.log_id",), key, backward, limit
+        )
+    
+    # === СТАТИСТИКА ===
+    async def get_user_count(self) -> int:
+        return await self._pool.fetchval("SELECT COUNT(*) FROM users")
+    
+    async def get_active_users_count(self) -> int:
+        return await self._pool.fetchval("SELECT COUNT(*) FROM users WHERE is_banned = 0")
+    
+    async def get_banned_users_count(self) -> int:
+        return await self._pool.fetchval("SELECT COUNT(*) FROM users WHERE is_banned = 1")
+    
+    async def get_total_keys_count(self) -> int:
+        return await self._pool.fetchval("SELECT COUNT(*) FROM user_keys")
+    
+    async def get_stats_summary(self) -> Dict:
+        row = await self._pool.fetchrow(f'''
+            SELECT
+                (SELECT COUNT(*) FROM users) as total_users,
+                (SELECT COUNT(*) FROM users WHERE is_banned = 1) as banned_users,
+                (SELECT COALESCE(SUM(total_spent), 0) FROM users) as total_revenue,
+                (SELECT COUNT(*) FROM user_keys) as total_keys,
+                (SELECT COUNT(*) FROM user_keys WHERE expiry_ts > {PG_NOW}) as active_keys,
+                (SELECT SUM(amount_rub) FROM transactions
+                 WHERE status = 'paid' AND created_ts >= {PG_TODAY_START}) as today_revenue,
+                (SELECT COUNT(*) FROM users WHERE created_ts >= {PG_TODAY_START}) as today_users,
+                (SELECT COUNT(*) FROM crypto_payments WHERE status = 'pending') as pending_payments,
+                (SELECT COUNT(*) FROM referral_withdrawals WHERE status = 'pending') as pending_withdrawals
+        ''')
+        summary = dict(row)
+        summary.update({
+            'active_users': summary['total_users'] - summary['banned_users'],
+            'hosts': len(self._catalog.active_hosts),
+            'plans': len(self._catalog.active_plans),
+        })
+        return summary
+    
+    # === ДИАГНОСТИКА ===
+    async def _init_connection(self, conn):
+        conn.add_query_logger(self._log_query)
+    
+    def _log_query(self, record):
+        # Несколько команд в одной строке (так asyncpg сбрасывает соединение при возврате в пул)
+        # EXPLAIN не принимает, а медленными они не бывают
+        if ';' in record.query.strip().rstrip(';'):
+            return
+        query_stats.record_query(record.query, record.args, record.elapsed)
+    
+    async def explain_statements(self) -> List[Dict]:
+        """EXPLAIN всех запросов, выполненных с запуска; full_scans - таблицы с Seq Scan"""
+        results = []
+        async with self._pool.acquire() as conn:
+            for sql, params in query_stats.statements().items():
+                try:
+                    plan = [row[0] for row in await conn.fetch(f"EXPLAIN {sql}", *(params or ()))]
+                except Exception as e:
+                    results.append({'sql': sql, 'plan': [], 'full_scans': [], 'error': str(e)})
+                    continue
+                full_scans = re.findall(r'Seq Scan on (\S+)', '\n'.join(plan))
+                results.append({'sql': sql, 'plan': plan, 'full_scans': full_scans, 'error': None})
+        results.sort(key=lambda result: not result['full_scans'])
+        return results
+
+def storage_interface() -> List[str]:
+    """Публичные методы Database - контракт, который повторяет любой бэкенд хранилища"""
+    return sorted(
+        name for name, member in vars(Database).items()
+        if callable(member) and not name.startswith('_') and name not in ('transaction', 'close')
+    )
+
+def create_storage():
+    """Хранилище по DB_BACKEND: sqlite (по умолчанию) или postgres"""
+    if DB_BACKEND == "sqlite":
+        return AsyncDatabase(Database(DB_PATH))
+    if DB_BACKEND != "postgres":
+        raise RuntimeError(f"Неизвестный DB_BACKEND: {DB_BACKEND}")
+    if not DATABASE_URL:
+        raise RuntimeError("Для DB_BACKEND=postgres нужен DATABASE_URL")
+
+    missing = [name for name in storage_interface() if not hasattr(PostgresDatabase, name)]
+    if missing:
+        raise RuntimeError(f"PostgresDatabase не реализует: {', '.join(missing)}")
+    return PostgresDatabase(DATABASE_URL)
+
+# === ПРОВЕРКА ПЛАНОВ ЗАПРОСОВ ===
+# Значения аргументов методов хранилища для прогона на пустой базе (python bot.py explain)
+EXPLAIN_SAMPLE_ARGS = {
+    'telegram_id': 1, 'user_id': 1, 'referrer_id': 1, 'admin_id': 1, 'host_id': 1, 'plan_id': 1,
+    'key_id': 1, 'withdrawal_id': 1, 'broadcast_id': 1, 'message_id': 1, 'inbound_id': 1,
+    'name': 'explain', 'host_name': 'explain', 'plan_name': 'explain', 'url': 'https://panel.example:54321',
+    'username': 'explain', 'password': 'explain', 'full_name': 'Explain', 'query': 'expl',
+    'xui_client_uuid': '00000000-0000-0000-0000-000000000000',
+    'client_uuid': '00000000-0000-0000-0000-000000000000', 'key_email': 'explain@example.vpn',
+    'expiry_date': datetime(2030, 1, 1), 'months': 1, 'price': 100.0, 'price_rub': 100.0,
+    'amount': 1.0, 'amount_rub': 100.0, 'asset': 'USDT', 'metadata': {}, 'invoice_id': 'explain-1',
+    'status': 'pending', 'from_status': 'pending', 'to_status': 'rejected', 'payment_method': 'explain',
+    'message': 'explain', 'total_users': 1, 'key': 'explain', 'value': '1', 'details': 'explain',
+    'action': 'explain', 'admin_notes': 'explain', 'amount_to_add': 1.0,
+}
+EXPLAIN_SAMPLE_KWARGS = {'update_host': {'host_url': 'https://panel.example:54321'}, 'update_plan': {'price': 100.0}}
+# Методы, которые не выполняют запросов приложения или выполняются отдельно
+EXPLAIN_SKIP_METHODS = ('explain_statements', 'incremental_vacuum', 'archive_batch')
+# Таблицы ограниченного размера, которые читаются целиком по замыслу
+EXPLAIN_ALLOWED_SCANS = ('stats_counters', 'schema_version', 'sqlite_master', 'archive.sqlite_master')
+
+def sample_seed_calls() -> List[Tuple[str, tuple, Dict]]:
+    """Вызовы (метод, args, kwargs), которые заполняют пустое хранилище образцовыми данными
+    под EXPLAIN_SAMPLE_ARGS. Две записи каждого вида: иначе у страниц не будет ключа следующей"""
+    calls = [('register_user', (number, f'explain{number}', 'Explain'), {'referrer_id': 1 if number > 1 else None})
+             for number in (1, 2, 3)]
+    calls.append(('add_host', ('explain', 'https://panel.example:54321', 'explain', 'explain', 1), {}))
+    calls.append(('add_plan', ('explain', 'explain', 1, 100.0), {}))
+    for number in (1, 2):
+        calls.append(('add_key', (1, 'explain', f'uuid-{number}', f'explain{number}@example.vpn', datetime(2030, 1, 1)), {}))
+        calls.append(('create_crypto_payment', (f'explain-{number}', 1, 1, 1.0, 'USDT', {}), {}))
+        calls.append(('log_transaction', ('explain', 1, 'paid', 100.0, 'explain', {}), {}))
+        calls.append(('log_admin_action', (1, 'explain', 'explain'), {}))
+    return calls
+
+def storage_calls() -> List[Tuple[str, Dict]]:
+    """Вызовы (метод, kwargs) каждого метода хранилища с аргументами из EXPLAIN_SAMPLE_ARGS
+    в порядке прогона: сначала создающие записи, чтобы claim_crypto_payment шел после
+    create_crypto_payment, удаляющие последними. Аргумент без образца - KeyError с его именем"""
+    names = [name for name in storage_interface() if name not in EXPLAIN_SKIP_METHODS]
+    names.sort(key=lambda name: (name.startswith(('delete_', 'clear_', 'ban_')),
+                                 not name.startswith(('add_', 'create_', 'register_'))))
+    calls = [(name, {}) for name in names]
+    calls += [('archive_batch', {'table': table}) for table in RETENTION_POLICIES]
+    
+    for name, arguments in calls:
+        for parameter in list(inspect.signature(getattr(Database, name)).parameters.values())[1:]:
+            if parameter.name in arguments or parameter.kind == parameter.VAR_KEYWORD:
+                continue
+            if parameter.default is parameter.empty or parameter.name in ('referrer_id', 'status'):
+                arguments[parameter.name] = EXPLAIN_SAMPLE_ARGS[parameter.name]
+        arguments.update(EXPLAIN_SAMPLE_KWARGS.get(name, {}))
+    return calls
+
+def is_page_method(method) -> bool:
+    parameters = inspect.signature(method).parameters
+    return 'key' in parameters and 'backward' in parameters
+
+def collect_query_plans(scratch_dir: str) -> Tuple[List[Dict], List[str]]:
+    """Прогоняет каждый метод хранилища на временной базе в scratch_dir, чтобы реестр запросов
+    содержал весь SQL приложения, и возвращает (explain_statements(), ошибки вызовов).
+    В каждом результате method - метод, который первым выполнил запрос; запросы миграций
+    и заполнения базы в реестр не попадают. Постраничные методы вызываются еще раз
+    с ключом соседней страницы"""
+    try:
+        calls = storage_calls()
+    except KeyError as e:
+        return [], [f"нет значения в EXPLAIN_SAMPLE_ARGS для аргумента {e.args[0]}"]
+    
+    database = Database(os.path.join(scratch_dir, 'explain.db'), os.path.join(scratch_dir, 'explain_archive.db'))
+    try:
+        for name, args, kwargs in sample_seed_calls():
+            getattr(database, name)(*args, **kwargs)
+        query_stats.clear_statements()
+        
+        errors = []
+        origins = {}
+        for name, arguments in calls:
+            method = getattr(database, name)
+            known = set(query_stats.statements())
+            try:
+                if is_page_method(method):
+                    page = method(**arguments, limit=1)
+                    if page.next_key:
+                        method(**arguments, key=page.next_key, limit=1)
+                        method(**arguments, key=page.next_key, backward=True, limit=1)
+                else:
+                    method(**arguments)
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+            for sql in set(query_stats.statements()) - known:
+                origins[sql] = name
+        results = database.explain_statements()
+        for result in results:
+            result['method'] = origins.get(result['sql'])
+        return results, errors
+    finally:
+        database.close()
+
+# === ОБСЛУЖИВАНИЕ SQLITE ===
+def enable_incremental_vacuum(db_path: str = DB_PATH) -> bool:
+    """Однократный перевод существующей базы в auto_vacuum=INCREMENTAL полным VACUUM.
+    VACUUM держит базу заблокированной до конца, поэтому запускается при остановленном боте.
+    Возвращает False, если база уже переведена"""
+    conn = sqlite3.connect(db_path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    finally:
+        conn.close()
+
+# === РЕЗЕРВНЫЕ КОПИИ SQLITE ===
+def check_integrity(path: str) -> List[str]:
+    """PRAGMA integrity_check файла базы: пустой список, если ошибок нет"""
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True)
+    try:
+        problems = [row[0] for row in conn.execute("PRAGMA integrity_check").fetchall()]
+    finally:
+        conn.close()
+    return [] if problems == ['ok'] else problems
+
+def decompress_backup(backup_path: str, target_path: str):
+    with gzip.open(backup_path, 'rb') as source, open(target_path, 'wb') as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+
+def backup_companion(backup_path: str) -> str:
+    """Архив архивной базы (DB_ARCHIVE_PATH) из того же набора, что и архив основной базы"""
+    return backup_path[:-len('.db.gz')] + '.archive.db.gz'
+
+def backup_size(backup_path: str) -> int:
+    """Размер набора копий в байтах"""
+    return sum(os.path.getsize(path) for path in (backup_path, backup_companion(backup_path)) if os.path.exists(path))
+
+def list_backups(backup_dir: str = DB_BACKUP_DIR, db_path: str = DB_PATH) -> List[str]:
+    """Архивы копий основной базы db_path от старых к новым; архивная база набора - backup_companion()"""
+    if not os.path.isdir(backup_dir):
+        return []
+    prefix = os.path.splitext(os.path.basename(db_path))[0] + '-'
+    return sorted(
+        os.path.join(backup_dir, name) for name in os.listdir(backup_dir)
+        if name.startswith(prefix) and name.endswith('.db.gz') and not name.endswith('.archive.db.gz')
+    )
+
+def create_backup(db_path: str = DB_PATH, archive_path: str = DB_ARCHIVE_PATH,
+                  backup_dir: str = DB_BACKUP_DIR, keep: int = DB_BACKUP_KEEP) -> str:
+    """Онлайн-копия основной и архивной базы одним набором. Обе копируются backup API за один
+    шаг (pages=-1) внутри одной читающей транзакции: снимок согласован между файлами, а читатель
+    WAL не блокирует запись и не начинает копирование заново из-за нее. Копии проверяются
+    integrity_check и сжимаются gzip, наборы сверх keep удаляются. Возвращает путь к архиву
+    основной базы"""
+    os.makedirs(backup_dir, exist_ok=True)
+    name = f"{os.path.splitext(os.path.basename(db_path))[0]}-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    backup_path = os.path.join(backup_dir, name + '.db.gz')
+    # Архив основной базы пишется последним: list_backups видит только полные наборы
+    parts = [('main', backup_path)]
+    if os.path.exists(archive_path):
+        parts.insert(0, ('archive', backup_companion(backup_path)))
+    temp_paths = [path + suffix for _, path in parts for suffix in ('.copy', '.part')]
+    
+    try:
+        source = sqlite3.connect(f"file:{quote(os.path.abspath(db_path))}?mode=ro", uri=True,
+                                 timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        try:
+            if len(parts) > 1:
+                source.execute("ATTACH DATABASE ? AS archive",
+                               (f"file:{quote(os.path.abspath(archive_path))}?mode=ro",))
+            # Снимок каждой базы фиксируется первым чтением в транзакции
+            source.execute("BEGIN")
+            for schema, _ in parts:
+                source.execute(f"SELECT COUNT(*) FROM {schema}.sqlite_master").fetchone()
+            
+            for schema, path in parts:
+                target = sqlite3.connect(path + '.copy')
+                try:
+                    source.backup(target, pages=-1, name=schema)
+                    # Копия - один самодостаточный файл без -wal
+                    target.execute("PRAGMA journal_mode = DELETE")
+                finally:
+                    target.close()
+        finally:
+            source.close()
+        
+        for _, path in parts:
+            problems = check_integrity(path + '.copy')
+            if problems:
+                raise RuntimeError(f"Копия базы не прошла integrity_check: {problems[0]}")
+        
+        for _, path in parts:
+            with open(path + '.copy', 'rb') as raw, gzip.open(path + '.part', 'wb', compresslevel=6) as packed:
+                shutil.copyfileobj(raw, packed, 1024 * 1024)
+            os.replace(path + '.part', path)
+    finally:
+        for path in temp_paths:
+            if os.path.exists(path):
+                os.remove(path)
+    
+    for old_backup in list_backups(backup_dir, db_path)[:-keep]:
+        for path in (backup_companion(old_backup), old_backup):
+            if os.path.exists(path):
+                os.remove(path)
+    return backup_path
+
+def verify_backup(backup_path: str) -> List[str]:
+    """Распаковывает архивы набора во временные файлы и проверяет их integrity_check"""
+    problems = []
+    for path in (backup_path, backup_companion(backup_path)):
+        if path != backup_path and not os.path.exists(path):
+            continue
+        copy_path = path + '.verify'
+        try:
+            decompress_backup(path, copy_path)
+            problems += [f"{os.path.basename(path)}: {problem}" for problem in check_integrity(copy_path)]
+        finally:
+            if os.path.exists(copy_path):
+                os.remove(copy_path)
+    return problems
+
+def restore_backup(backup_path: str, db_path: str = DB_PATH, archive_path: str = DB_ARCHIVE_PATH) -> str:
+    """Заменяет основную и архивную базу копиями из набора. Бот должен быть остановлен.
+    Текущие базы вместе с -wal переносятся в файлы .before-restore; возвращает путь для основной.
+    Набор без архивной базы (снятый до ее включения в копии) оставляет архивную базу как есть"""
+    companion_path = backup_companion(backup_path)
+    parts = [(backup_path, db_path)]
+    if os.path.exists(companion_path):
+        parts.append((companion_path, archive_path))
+    else:
+        logger.warning(f"В наборе нет копии архивной базы, {archive_path} не восстанавливается")
+    
+    try:
+        for path, target_path in parts:
+            decompress_backup(path, target_path + '.restore')
+            problems = check_integrity(target_path + '.restore')
+            if problems:
+                raise RuntimeError(f"Копия {os.path.basename(path)} не прошла integrity_check: {problems[0]}")
+        
+        for _, target_path in parts:
+            # WAL старой базы не должен примениться к восстановленной
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(target_path + suffix):
+                    os.replace(target_path + suffix, target_path + '.before-restore' + suffix)
+            os.replace(target_path + '.restore', target_path)
+    finally:
+        for _, target_path in parts:
+            if os.path.exists(target_path + '.restore'):
+                os.remove(target_path + '.restore')
+    return db_path + '.before-restore'
+
+class BotSettings:
+    """Типизированные настройки бота поверх кэша таблицы settings"""
+    
+    def __init__(self, database: Database):
+        self.database = database
+    
+    def _str(self, key: str, default: str) -> str:
+        return self.database.get_setting(key, default)
+    
+    def _bool(self, key: str, default: bool) -> bool:
+        value = self.database.get_setting(key, "")
+        return value.lower() == "true" if value else default
+    
+    def _int(self, key: str, default: int) -> int:
+        try:
+            return int(self.database.get_setting(key, str(default)))
+        except ValueError:
+            return default
+    
+    def _float(self, key: str, default: float) -> float:
+        try:
+            return float(self.database.get_setting(key, str(default)))
+        except ValueError:
+            return default
+    
+    @property
+    def trial_enabled(self) -> bool:
+        return self._bool("trial_enabled", TRIAL_ENABLED)
+    
+    @property
+    def trial_duration_days(self) -> int:
+        return self._int("trial_duration_days", TRIAL_DURATION_DAYS)
+    
+    @property
+    def enable_referrals(self) -> bool:
+        return self._bool("enable_referrals", ENABLE_REFERRALS)
+    
+    @property
+    def referral_percentage(self) -> float:
+        return self._float("referral_percentage", REFERRAL_PERCENTAGE)
+    
+    @property
+    def referral_discount(self) -> float:
+        return self._float("referral_discount", REFERRAL_DISCOUNT)
+    
+    @property
+    def minimum_withdrawal(self) -> float:
+        return self._float("minimum_withdrawal", MINIMUM_WITHDRAWAL)
+    
+    @property
+    def about_text(self) -> str:
+        return self._str("about_text", ABOUT_TEXT)
+    
+    @property
+    def support_text(self) -> str:
+        return self._str("support_text", SUPPORT_TEXT)
+    
+    @property
+    def support_user(self) -> str:
+        return self._str("support_user", SUPPORT_USER)
+    
+    @property
+    def channel_url(self) -> str:
+        return self._str("channel_url", CHANNEL_URL)
+    
+    @property
+    def terms_url(self) -> str:
+        return self._str("terms_url", TERMS_URL)
+    
+    @property
+    def privacy_url(self) -> str:
+        return self._str("privacy_url", PRIVACY_URL)
+    
+    @property
+    def android_url(self) -> str:
+        return self._str("android_url", ANDROID_URL)
+    
+    @property
+    def ios_url(self) -> str:
+        return self._str("ios_url", IOS_URL)
+    
+    @property
+    def windows_url(self) -> str:
+        return self._str("windows_url", WINDOWS_URL)
+    
+    @property
+    def linux_url(self) -> str:
+        return self._str("linux_url", LINUX_URL)
 
 # === X-UI API ===
+@dataclass(slots=True)
+class ClientWrite:
+    """Изменение клиента инбаунда, ожидающее записи"""
+    action: str  # add | extend | delete
+    client_uuid: str
+    email: str = ""
+    days: int = 0
+    flow: str = "xtls-rprx-vision"
+    future: Optional[asyncio.Future] = None
+
+class InboundWriter:
+    """Очередь изменений клиентов одного инбаунда. Пишет одна задача, поэтому
+    изменения не перетирают друг друга; все, что накопилось за XUI_WRITE_FLUSH_MS,
+    уходит одной пачкой, а каждый вызывающий получает свой результат"""
+    
+    def __init__(self, api: 'XUIAPI'):
+        self.api = api
+        self.host_data: Optional[HostRow] = None
+        self.pending: List[ClientWrite] = []
+        self.task: Optional[asyncio.Task] = None
+    
+    def submit(self, host_data: HostRow, write: ClientWrite) -> asyncio.Future:
+        write.future = asyncio.get_running_loop().create_future()
+        # Пачка пишется с последними данными хоста (логин и пароль могли смениться)
+        self.host_data = host_data
+        self.pending.append(write)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return write.future
+    
+    async def _run(self):
+        while self.pending:
+            await asyncio.sleep(XUI_WRITE_FLUSH_MS / 1000)
+            batch, self.pending = self.pending, []
+            try:
+                await self.api._apply_writes(self.host_data, batch)
+            except Exception as e:
+                logging.error(f"X-UI write batch error: {e}")
+                self.api._resolve(batch, [{"error": str(e)}] * len(batch))
+    
+    async def drain(self):
+        """Дожидается записи всех поставленных изменений"""
+        if self.task and not self.task.done():
+            await self.task
+
 class XUIAPI:
+    HEADERS = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+        'Accept': 'application/json',
+        'Content-Type': 'application/json',
+        # С этим заголовком 3x-ui отвечает 401 вместо редиректа на страницу входа
+        'X-Requested-With': 'XMLHttpRequest'
+    }
+    # Ответы, после которых нужен повторный вход: 401/403 и редирект на страницу входа.
+    # 404 новые версии 3x-ui отдают неавторизованным на /panel/api, но так же отвечают
+    # на несуществующий id или метод, поэтому 404 считается отказом в доступе только
+    # на маршруте, который еще ни разу не ответил с действующей кукой
+    AUTH_REQUIRED_STATUSES = (301, 302, 303, 307, 308, 401, 403)
+    
     def __init__(self):
-        self.sessions = {}
+        # Долгоживущие сессии по одной на панель (scheme://host:port): соединения
+        # переиспользуются через keep-alive, DNS кэшируется коннектором
+        self.sessions: Dict[str, aiohttp.ClientSession] = {}
+        # host_url -> (номер входа, когда считать куку истекшей); сама кука в cookie jar сессии
+        self._logins: Dict[str, Tuple[int, float]] = {}
+        self._login_locks: Dict[str, asyncio.Lock] = {}
+        self._login_counter = 0
+        # (host_url, метод и путь с {id}) маршрутов, уже ответивших с действующей кукой
+        self._answered_routes: Set[Tuple[str, str]] = set()
+        # (host_url, inbound_id) -> очередь записи клиентов инбаунда
+        self._writers: Dict[Tuple[str, int], InboundWriter] = {}
+        # (host_url, inbound_id) -> (метаданные инбаунда, время загрузки) и текущие загрузки
+        self._inbounds: Dict[Tuple[str, int], Tuple[Dict, float]] = {}
+        self._inbound_loads: Dict[Tuple[str, int], asyncio.Task] = {}
+    
+    @staticmethod
+    def _origin(url: str) -> str:
+        parsed = urlparse(url)
+        return f"{parsed.scheme}://{parsed.netloc}".lower()
+    
+    @staticmethod
+    def _panel_key(host_url: str) -> str:
+        return host_url.strip().rstrip('/')
+    
+    def _get_session(self, url: str) -> aiohttp.ClientSession:
+        """Сессия панели, создается при первом обращении"""
+        origin = self._origin(url)
+        session = self.sessions.get(origin)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=XUI_CONN_LIMIT_PER_HOST,
+                limit_per_host=XUI_CONN_LIMIT_PER_HOST,
+                keepalive_timeout=XUI_KEEPALIVE_SEC,
+                ttl_dns_cache=XUI_DNS_CACHE_TTL_SEC,
+                ssl=False
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.HEADERS,
+                # Панели часто открыты по IP, а такие куки cookie jar по умолчанию отбрасывает
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                timeout=aiohttp.ClientTimeout(total=XUI_REQUEST_TIMEOUT_SEC)
+            )
+            self.sessions[origin] = session
+        return session
+    
+    def invalidate_inbounds(self, host_url: str):
+        """Сброс кэша метаданных инбаундов панели (после изменения хоста админом)"""
+        key = self._panel_key(host_url)
+        for cached in [cached for cached in self._inbounds if cached[0] == key]:
+            del self._inbounds[cached]
+    
+    async def close_session(self, host_url: str):
+        """Закрытие сессии панели (после изменения или удаления хоста)"""
+        self.invalidate_inbounds(host_url)
+        origin = self._origin(host_url)
+        for key in [key for key in self._logins if self._origin(key) == origin]:
+            del self._logins[key]
+        self._answered_routes = {route for route in self._answered_routes if self._origin(route[0]) != origin}
+        session = self.sessions.pop(origin, None)
+        if session and not session.closed:
+            await session.close()
     
-    async def _make_request(self, url: str, method: str = "GET", data: Dict = None, 
+    async def close(self):
+        """Запись накопленных изменений клиентов и закрытие всех сессий"""
+        for writer in list(self._writers.values()):
+            await writer.drain()
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        self._logins.clear()
+        self._answered_routes.clear()
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+    
+    async def _send(self, url: str, method: str, data: Dict = None) -> Tuple[int, Any, Any]:
+        """Один HTTP запрос без обработки ошибок: (статус, JSON или текст ответа, выданные куки)"""
+        session = self._get_session(url)
+        json_data = data if method != "GET" else None
+        
+        async with session.request(method, url, json=json_data, allow_redirects=False) as response:
+            try:
+                return response.status, await response.json(content_type=None), response.cookies
+            except:
+                return response.status, await response.text(), response.cookies
+    
+    def _has_cookie(self, url: str) -> bool:
+        """Есть ли в сессии панели неистекшая кука для url"""
+        return bool(self._get_session(url).cookie_jar.filter_cookies(URL(url)))
+    
+    def _current_login(self, key: str, stale_login: Optional[int]) -> Optional[int]:
+        login = self._logins.get(key)
+        if login and login[0] != stale_login and login[1] > time.monotonic():
+            return login[0]
+        return None
+    
+    async def _login(self, host_url: str, username: str, password: str,
+                     stale_login: Optional[int] = None) -> Tuple[bool, Any]:
+        """Вход в панель через POST /login. Кука остается в сессии панели.
+        Одновременные запросы ждут одного входа; stale_login - номер входа,
+        с которым запрос получил отказ, его кука считается недействительной.
+        Возвращает (успех, номер входа или текст ошибки)"""
+        key = self._panel_key(host_url)
+        current = self._current_login(key, stale_login)
+        if current:
+            return True, current
+        
+        async with self._login_locks.setdefault(key, asyncio.Lock()):
+            current = self._current_login(key, stale_login)
+            if current:
+                return True, current
+            
+            self._logins.pop(key, None)
+            started = time.perf_counter()
+            try:
+                status, result, cookies = await self._send(f"{key}/login", "POST",
+                                                           {"username": username, "password": password})
+            except Exception:
+                xui_stats.observe("login", time.perf_counter() - started, failed=True)
+                raise
+            
+            success = status == 200 and isinstance(result, dict) and result.get('success')
+            xui_stats.observe("login", time.perf_counter() - started, failed=not success)
+            if not success:
+                if isinstance(result, dict):
+                    return False, result.get('msg') or "Invalid credentials"
+                return False, f"HTTP {status}: {str(result)[:200]}"
+            
+            # Кука обновляется заранее, до Max-Age, который выставила панель
+            lifetime = XUI_SESSION_TTL_SEC
+            for morsel in cookies.values():
+                if str(morsel['max-age']).isdigit():
+                    max_age = int(morsel['max-age'])
+                    lifetime = min(lifetime, max(max_age - 60, max_age // 2))
+            
+            self._login_counter += 1
+            self._logins[key] = (self._login_counter, time.monotonic() + lifetime)
+            return True, self._login_counter
+    
+    async def _make_request(self, host_url: str, path: str, method: str = "GET", data: Dict = None, 
                           username: str = None, password: str = None) -> Tuple[bool, Any]:
-        """Универсальный метод для запросов к X-UI"""
+        """Универсальный метод для запросов к X-UI. С логином и паролем запрос идет
+        под кукой сессии; при отказе в доступе вход повторяется один раз"""
+        method = method.upper()
+        if method not in ("GET", "POST", "PUT"):
+            return False, f"Unsupported method: {method}"
+        
+        url = f"{self._panel_key(host_url)}{path}"
+        # Для статистики и учета маршрутов id и email в пути заменяются шаблоном: /get/5 -> /get/{id}
+        endpoint = f"{method} {re.sub(r'/[^/]*[0-9@%][^/]*', '/{id}', path)}"
+        route = (self._panel_key(host_url), endpoint)
+        authorized = bool(username and password)
+        login = None
+        
         try:
-            timeout = aiohttp.ClientTimeout(total=30)
-            
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                auth = aiohttp.BasicAuth(username, password) if username and password else None
-                
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                    'Accept': 'application/json',
-                    'Content-Type': 'application/json'
-                }
+            for attempt in range(2 if authorized else 1):
+                if authorized:
+                    logged_in, login = await self._login(host_url, username, password, stale_login=login)
+                    if not logged_in:
+                        return False, f"Login failed: {login}"
                 
-                if method.upper() == "GET":
-                    async with session.get(url, auth=auth, headers=headers, ssl=False) as response:
-                        if response.status == 200:
-                            try:
-                                return True, await response.json()
-                            except:
-                                return True, await response.text()
-                        else:
-                            return False, f"HTTP {response.status}: {await response.text()}"
-                
-                elif method.upper() == "POST":
-                    async with session.post(url, json=data, auth=auth, headers=headers, ssl=False) as response:
-                        if response.status == 200:
-                            try:
-                                return True, await response.json()
-                            except:
-                                return True, await response.text()
-                        else:
-                            return False, f"HTTP {response.status}: {await response.text()}"
-                
-                elif method.upper() == "PUT":
-                    async with session.put(url, json=data, auth=auth, headers=headers, ssl=False) as response:
-                        if response.status == 200:
-                            try:
-                                return True, await response.json()
-                            except:
-                                return True, await response.text()
-                        else:
-                            return False, f"HTTP {response.status}: {await response.text()}"
+                started = time.perf_counter()
+                status, result, _ = await self._send(url, method, data)
+                xui_stats.observe(endpoint, time.perf_counter() - started, failed=status != 200)
+                if not authorized:
+                    break
+                if status in self.AUTH_REQUIRED_STATUSES:
+                    continue
                 
-                else:
-                    return False, f"Unsupported method: {method}"
+                # 404 настоящий (маршрут или id на панели отсутствует), если пришел сразу после
+                # нового входа или на знакомом маршруте, пока кука сессии не истекла
+                if status != 404 or attempt or (route in self._answered_routes and self._has_cookie(url)):
+                    self._answered_routes.add(route)
+                    break
+            
+            if status == 200:
+                return True, result
+            return False, f"HTTP {status}: {result}"
                     
         except asyncio.TimeoutError:
             return False, "Request timeout"
@@ -1096,18 +4053,12 @@ class XUIAPI:
             return False, f"Connection error: {str(e)}"
     
     async def test_connection(self, host_url: str, username: str, password: str) -> Tuple[bool, str]:
-        """Тестирование подключения к X-UI"""
+        """Тестирование подключения к X-UI: вход и список инбаундов тем же путем, что и рабочие запросы"""
         try:
-            # Проверяем доступность панели
-            login_url = f"{host_url}/login"
-            success, result = await self._make_request(login_url, "GET")
-            
-            if not success:
-                return False, f"Panel not accessible: {result}"
-            
-            # Пробуем получить список инбаундов
-            inbounds_url = f"{host_url}/panel/api/inbounds"
-            success, result = await self._make_request(inbounds_url, "GET", username=username, password=password)
+            # Всегда входим заново, чтобы проверить именно переданные логин и пароль
+            self._logins.pop(self._panel_key(host_url), None)
+            success, result = await self._make_request(host_url, "/panel/api/inbounds/list",
+                                                       username=username, password=password)
             
             if success:
                 # Проверяем наличие success поля в ответе
@@ -1121,15 +4072,15 @@ class XUIAPI:
         except Exception as e:
             return False, f"Connection error: {str(e)}"
     
-    async def get_inbounds(self, host_data: Dict) -> Dict:
+    async def get_inbounds(self, host_data: HostRow) -> Dict:
         """Получение списка инбаундов"""
         try:
-            host_url = host_data['host_url']
-            username = host_data['host_username']
-            password = host_data['host_pass']
+            host_url = host_data.host_url
+            username = host_data.host_username
+            password = host_data.host_pass
             
-            inbounds_url = f"{host_url}/panel/api/inbounds"
-            success, result = await self._make_request(inbounds_url, "GET", username=username, password=password)
+            success, result = await self._make_request(host_url, "/panel/api/inbounds/list",
+                                                       username=username, password=password)
             
             if success:
                 if isinstance(result, dict) and result.get('success'):
@@ -1143,220 +4094,293 @@ class XUIAPI:
             logging.error(f"X-UI get inbounds error: {e}")
             return {"error": str(e)}
     
-    async def create_client(self, host_data: Dict, email: str, days: int, flow: str = "xtls-rprx-vision") -> Dict:
+    @staticmethod
+    def _client_payload(inbound_id: int, clients: List[Dict]) -> Dict:
+        """Тело addClient/updateClient: только передаваемые клиенты, а не весь список инбаунда"""
+        return {"id": inbound_id, "settings": json.dumps({"clients": clients})}
+    
+    @staticmethod
+    def _client_settings(client_uuid: str, email: str, expiry_time: int,
+                         flow: str = "xtls-rprx-vision") -> Dict:
+        """Настройки нового клиента для addClient"""
+        return {
+            "id": client_uuid,
+            "email": email,
+            "enable": True,
+            "flow": flow,
+            "totalGB": 0,
+            "expiryTime": expiry_time,
+            "limitIp": 0,
+            "fingerprint": "chrome",
+            "tgId": "",
+            "subId": ""
+        }
+    
+    @staticmethod
+    def _api_error(success: bool, result: Any) -> Optional[str]:
+        """Текст ошибки ответа панели или None, если операция выполнена"""
+        if not success:
+            return str(result)
+        if isinstance(result, dict) and not result.get('success'):
+            return result.get('msg') or "Operation failed"
+        return None
+    
+    @staticmethod
+    def _resolve(writes: List[ClientWrite], results: List[Dict]):
+        for write, result in zip(writes, results):
+            # Вызывающий мог быть отменен, пока изменение ждало записи
+            if not write.future.done():
+                write.future.set_result(result)
+    
+    async def _get_inbound(self, host_data: HostRow) -> Tuple[Optional[Dict], Optional[str]]:
+        """Инбаунд хоста: (obj, None) или (None, ошибка)"""
+        success, result = await self._make_request(
+            host_data.host_url, f"/panel/api/inbounds/get/{host_data.host_inbound_id}",
+            username=host_data.host_username, password=host_data.host_pass
+        )
+        if not success:
+            return None, f"Failed to get inbound: {result}"
+        if not isinstance(result, dict) or not result.get('success'):
+            return None, "Invalid inbound response"
+        return result.get('obj', {}), None
+    
+    async def _get_clients(self, host_data: HostRow) -> Tuple[Dict[str, Dict], Optional[str]]:
+        """Текущие клиенты инбаунда по uuid: ({uuid: клиент}, None) или ({}, ошибка)"""
+        inbound_obj, error = await self._get_inbound(host_data)
+        if error:
+            return {}, error
+        settings = inbound_obj.get('settings') or {}
+        if isinstance(settings, str):
+            try:
+                settings = json.loads(settings)
+            except ValueError:
+                return {}, "Invalid inbound settings"
+        return {client.get('id'): client for client in settings.get('clients', [])}, None
+    
+    @staticmethod
+    def _inbound_meta(inbound_obj: Dict) -> Dict:
+        """Из инбаунда нужны только порт, протокол и streamSettings (приходит JSON строкой)"""
+        stream_settings = inbound_obj.get('streamSettings') or {}
+        if isinstance(stream_settings, str):
+            try:
+                stream_settings = json.loads(stream_settings)
+            except ValueError:
+                stream_settings = {}
+        return {
+            "port": inbound_obj.get('port', 443),
+            "protocol": inbound_obj.get('protocol', 'vless'),
+            "streamSettings": stream_settings
+        }
+    
+    async def _load_inbound_meta(self, host_data: HostRow, key: Tuple[str, int]) -> Tuple[Optional[Dict], Optional[str]]:
+        try:
+            inbound_obj, error = await self._get_inbound(host_data)
+            if error:
+                return None, error
+            meta = self._inbound_meta(inbound_obj)
+            self._inbounds[key] = (meta, time.monotonic())
+            return meta, None
+        finally:
+            self._inbound_loads.pop(key, None)
+    
+    async def get_inbound_meta(self, host_data: HostRow) -> Tuple[Optional[Dict], Optional[str]]:
+        """Метаданные инбаунда из кэша: (meta, None) или (None, ошибка).
+        Устаревшая запись отдается сразу и обновляется в фоне; одновременные
+        промахи ждут одной загрузки"""
+        key = (self._panel_key(host_data.host_url), host_data.host_inbound_id)
+        load = self._inbound_loads.get(key)
+        cached = self._inbounds.get(key)
+        
+        if cached:
+            meta, loaded_at = cached
+            if load is None and time.monotonic() - loaded_at > XUI_INBOUND_CACHE_TTL_SEC:
+                self._inbound_loads[key] = asyncio.create_task(self._load_inbound_meta(host_data, key))
+            return meta, None
+        
+        if load is None:
+            load = self._inbound_loads[key] = asyncio.create_task(self._load_inbound_meta(host_data, key))
+        return await asyncio.shield(load)
+    
+    async def get_connection_string(self, host_data: HostRow, client_uuid: str, email: str) -> str:
+        """Connection string существующего ключа; при наличии кэша без запросов к X-UI"""
+        meta, error = await self.get_inbound_meta(host_data)
+        if error:
+            logging.warning(f"X-UI inbound metadata for {host_data.host_name} unavailable: {error}")
+        return await self._generate_connection_string(host_data, client_uuid, email, meta or {})
+    
+    async def _submit_write(self, host_data: HostRow, write: ClientWrite) -> Dict:
+        key = (self._panel_key(host_data.host_url), host_data.host_inbound_id)
+        writer = self._writers.get(key)
+        if writer is None:
+            writer = self._writers[key] = InboundWriter(self)
+        return await writer.submit(host_data, write)
+    
+    async def create_client(self, host_data: HostRow, email: str, days: int, flow: str = "xtls-rprx-vision") -> Dict:
         """Создание нового клиента в X-UI"""
+        return await self._submit_write(host_data, ClientWrite("add", str(uuid.uuid4()), email, days, flow))
+    
+    async def update_client_expiry(self, host_data: HostRow, client_id: str, email: str, days_to_add: int) -> Dict:
+        """Обновление срока действия клиента"""
+        return await self._submit_write(host_data, ClientWrite("extend", client_id, email, days_to_add))
+    
+    async def delete_client(self, host_data: HostRow, client_id: str) -> Dict:
+        """Удаление клиента из X-UI"""
+        return await self._submit_write(host_data, ClientWrite("delete", client_id))
+    
+    async def _apply_writes(self, host_data: HostRow, batch: List[ClientWrite]):
+        """Запись пачки изменений одного инбаунда. Все новые клиенты уходят одним addClient;
+        продления одного клиента складываются, удаление отменяет его продления. Для
+        продлений инбаунд запрашивается один раз на пачку"""
+        adds = [write for write in batch if write.action == "add"]
+        extends: Dict[str, List[ClientWrite]] = {}
+        deletes: Dict[str, List[ClientWrite]] = {}
+        for write in batch:
+            if write.action == "extend":
+                extends.setdefault(write.client_uuid, []).append(write)
+            elif write.action == "delete":
+                deletes.setdefault(write.client_uuid, []).append(write)
+        
+        if adds:
+            await self._apply_adds(host_data, adds)
+        
+        if extends:
+            clients, error = await self._get_clients(host_data)
+            for client_id, writes in extends.items():
+                if client_id in deletes:
+                    result = {"error": "Client deleted"}
+                elif error:
+                    result = {"error": f"Failed to get client: {error}"}
+                else:
+                    result = await self._extend_client(host_data, clients.get(client_id),
+                                                       sum(write.days for write in writes))
+                self._resolve(writes, [result] * len(writes))
+        
+        for client_id, writes in deletes.items():
+            result = await self._delete_client(host_data, client_id)
+            self._resolve(writes, [result] * len(writes))
+    
+    async def _apply_adds(self, host_data: HostRow, adds: List[ClientWrite]):
         try:
-            host_url = host_data['host_url']
-            username = host_data['host_username']
-            password = host_data['host_pass']
-            inbound_id = host_data['host_inbound_id']
-            
-            # Получаем текущий инбаунд
-            inbound_url = f"{host_url}/panel/api/inbounds/get/{inbound_id}"
-            success, inbound_result = await self._make_request(inbound_url, "GET", username=username, password=password)
-            
-            if not success:
-                return {"error": f"Failed to get inbound: {inbound_result}"}
-            
-            # Парсим настройки инбаунда
-            if not isinstance(inbound_result, dict) or not inbound_result.get('success'):
-                return {"error": "Invalid inbound response"}
-            
-            inbound_obj = inbound_result.get('obj', {})
-            inbound_settings = inbound_obj.get('settings', '{}')
-            
-            try:
-                settings_dict = json.loads(inbound_settings) if isinstance(inbound_settings, str) else inbound_settings
-            except:
-                settings_dict = {}
-            
-            clients = settings_dict.get('clients', [])
-            
-            # Генерируем UUID для клиента
-            client_uuid = str(uuid.uuid4())
+            # Порт и streamSettings нужны для connection string
+            inbound_meta, error = await self.get_inbound_meta(host_data)
+            if error:
+                self._resolve(adds, [{"error": error}] * len(adds))
+                return
             
             # Рассчитываем время истечения (в миллисекундах)
-            expiry_time = int((datetime.now() + timedelta(days=days)).timestamp() * 1000)
-            
-            # Создаем нового клиента
-            new_client = {
-                "id": client_uuid,
-                "email": email,
-                "enable": True,
-                "flow": flow,
-                "totalGB": 0,
-                "expiryTime": expiry_time,
-                "limitIp": 0,
-                "fingerprint": "chrome",
-                "tgId": "",
-                "subId": ""
-            }
-            
-            # Добавляем клиента в список
-            clients.append(new_client)
-            
-            # Обновляем настройки инбаунда
-            settings_dict['clients'] = clients
-            
-            # Подготавливаем данные для обновления
-            update_data = {
-                "settings": json.dumps(settings_dict)
-            }
+            now = datetime.now()
+            clients = [
+                self._client_settings(write.client_uuid, write.email,
+                                      int((now + timedelta(days=write.days)).timestamp() * 1000), write.flow)
+                for write in adds
+            ]
             
-            # Обновляем инбаунд
-            update_url = f"{host_url}/panel/api/inbounds/update/{inbound_id}"
-            success, update_result = await self._make_request(update_url, "POST", data=update_data, 
-                                                            username=username, password=password)
+            error = await self._add_clients(host_data, clients)
+            if error and len(adds) > 1:
+                # Панель отклоняет addClient целиком (например, из-за занятого email),
+                # поэтому при ошибке пачки каждый клиент добавляется отдельно со своим результатом
+                errors = [await self._add_clients(host_data, [client]) for client in clients]
+            else:
+                errors = [error] * len(adds)
             
-            if success:
+            results = []
+            for write, client, error in zip(adds, clients, errors):
+                if error:
+                    results.append({"error": f"Failed to add client: {error}"})
+                    continue
+                
                 # Генерируем connection string
                 connection_string = await self._generate_connection_string(
-                    host_data, client_uuid, email, inbound_obj
+                    host_data, write.client_uuid, write.email, inbound_meta
                 )
-                
-                return {
+                results.append({
                     "success": True,
-                    "client_uuid": client_uuid,
-                    "email": email,
-                    "expiry_date": datetime.fromtimestamp(expiry_time / 1000),
+                    "client_uuid": write.client_uuid,
+                    "email": write.email,
+                    "expiry_date": datetime.fromtimestamp(client['expiryTime'] / 1000),
                     "connection_string": connection_string,
-                    "host_name": host_data['host_name']
-                }
-            else:
-                return {"error": f"Failed to update inbound: {update_result}"}
+                    "host_name": host_data.host_name
+                })
+            self._resolve(adds, results)
                 
         except Exception as e:
             logging.error(f"X-UI create client error: {e}")
-            return {"error": str(e)}
+            self._resolve(adds, [{"error": str(e)}] * len(adds))
     
-    async def update_client_expiry(self, host_data: Dict, client_id: str, days_to_add: int) -> Dict:
-        """Обновление срока действия клиента"""
+    async def _add_clients(self, host_data: HostRow, clients: List[Dict]) -> Optional[str]:
+        success, add_result = await self._make_request(
+            host_data.host_url, "/panel/api/inbounds/addClient", "POST",
+            data=self._client_payload(host_data.host_inbound_id, clients),
+            username=host_data.host_username, password=host_data.host_pass
+        )
+        return self._api_error(success, add_result)
+    
+    async def _extend_client(self, host_data: HostRow, client: Optional[Dict], days_to_add: int) -> Dict:
+        """Продление клиента по его текущей записи из инбаунда"""
+        if not client:
+            return {"error": "Client not found"}
+        
         try:
-            host_url = host_data['host_url']
-            username = host_data['host_username']
-            password = host_data['host_pass']
-            inbound_id = host_data['host_inbound_id']
-            
-            # Получаем текущий инбаунд
-            inbound_url = f"{host_url}/panel/api/inbounds/get/{inbound_id}"
-            success, inbound_result = await self._make_request(inbound_url, "GET", username=username, password=password)
-            
-            if not success:
-                return {"error": f"Failed to get inbound: {inbound_result}"}
-            
-            inbound_obj = inbound_result.get('obj', {})
-            inbound_settings = inbound_obj.get('settings', '{}')
-            
-            try:
-                settings_dict = json.loads(inbound_settings) if isinstance(inbound_settings, str) else inbound_settings
-            except:
-                settings_dict = {}
-            
-            clients = settings_dict.get('clients', [])
-            
-            # Ищем клиента по ID
-            client_found = None
-            client_index = -1
-            
-            for i, client in enumerate(clients):
-                if client.get('id') == client_id:
-                    client_found = client
-                    client_index = i
-                    break
-            
-            if not client_found:
-                return {"error": "Client not found"}
+            client_id = client['id']
+            now_ms = int(datetime.now().timestamp() * 1000)
             
             # Обновляем срок действия
-            current_expiry = client_found.get('expiryTime', 0)
+            current_expiry = client.get('expiryTime', 0)
             if current_expiry > 0:
                 new_expiry = current_expiry + (days_to_add * 24 * 60 * 60 * 1000)
             else:
                 new_expiry = int((datetime.now() + timedelta(days=days_to_add)).timestamp() * 1000)
             
-            clients[client_index]['expiryTime'] = new_expiry
+            # updateClient заменяет клиента целиком, поэтому отправляется текущая запись
+            # с новым сроком: flow, лимиты, tgId и subId сохраняются. Отключенный вручную
+            # клиент остается отключенным; включается только тот, кого панель отключила
+            # по истечении срока
+            client = {**client, "expiryTime": new_expiry}
+            if 0 < current_expiry <= now_ms:
+                client["enable"] = True
+            success, update_result = await self._make_request(
+                host_data.host_url, f"/panel/api/inbounds/updateClient/{client_id}", "POST",
+                data=self._client_payload(host_data.host_inbound_id, [client]),
+                username=host_data.host_username, password=host_data.host_pass
+            )
             
-            # Обновляем настройки
-            settings_dict['clients'] = clients
+            error = self._api_error(success, update_result)
+            if error:
+                return {"error": f"Failed to update client: {error}"}
             
-            update_data = {
-                "settings": json.dumps(settings_dict)
+            return {
+                "success": True,
+                "client_uuid": client_id,
+                "expiry_date": datetime.fromtimestamp(new_expiry / 1000)
             }
-            
-            update_url = f"{host_url}/panel/api/inbounds/update/{inbound_id}"
-            success, update_result = await self._make_request(update_url, "POST", data=update_data, 
-                                                            username=username, password=password)
-            
-            if success:
-                return {
-                    "success": True,
-                    "client_uuid": client_id,
-                    "expiry_date": datetime.fromtimestamp(new_expiry / 1000)
-                }
-            else:
-                return {"error": f"Failed to update client: {update_result}"}
                 
-        except Exception as e:
-            logging.error(f"X-UI update client error: {e}")
-            return {"error": str(e)}
-    
-    async def delete_client(self, host_data: Dict, client_id: str) -> Dict:
-        """Удаление клиента из X-UI"""
-        try:
-            host_url = host_data['host_url']
-            username = host_data['host_username']
-            password = host_data['host_pass']
-            inbound_id = host_data['host_inbound_id']
-            
-            # Получаем инбаунд
-            inbound_url = f"{host_url}/panel/api/inbounds/get/{inbound_id}"
-            success, inbound_result = await self._make_request(inbound_url, "GET", username=username, password=password)
-            
-            if not success:
-                return {"error": f"Failed to get inbound: {inbound_result}"}
-            
-            inbound_obj = inbound_result.get('obj', {})
-            inbound_settings = inbound_obj.get('settings', '{}')
-            
-            try:
-                settings_dict = json.loads(inbound_settings) if isinstance(inbound_settings, str) else inbound_settings
-            except:
-                settings_dict = {}
-            
-            clients = settings_dict.get('clients', [])
-            
-            # Удаляем клиента по ID
-            filtered_clients = [c for c in clients if c.get('id') != client_id]
-            
-            if len(filtered_clients) == len(clients):
-                return {"error": "Client not found"}
-            
-            # Обновляем настройки
-            settings_dict['clients'] = filtered_clients
-            
-            update_data = {
-                "settings": json.dumps(settings_dict)
-            }
+        except Exception as e:
+            logging.error(f"X-UI update client error: {e}")
+            return {"error": str(e)}
+    
+    async def _delete_client(self, host_data: HostRow, client_id: str) -> Dict:
+        try:
+            success, delete_result = await self._make_request(
+                host_data.host_url, f"/panel/api/inbounds/{host_data.host_inbound_id}/delClient/{client_id}", "POST",
+                username=host_data.host_username, password=host_data.host_pass
+            )
             
-            update_url = f"{host_url}/panel/api/inbounds/update/{inbound_id}"
-            success, update_result = await self._make_request(update_url, "POST", data=update_data, 
-                                                            username=username, password=password)
+            error = self._api_error(success, delete_result)
+            if error:
+                return {"error": f"Failed to delete client: {error}"}
             
-            if success:
-                return {"success": True, "message": "Client deleted successfully"}
-            else:
-                return {"error": f"Failed to delete client: {update_result}"}
+            return {"success": True, "message": "Client deleted successfully"}
                 
         except Exception as e:
             logging.error(f"X-UI delete client error: {e}")
             return {"error": str(e)}
     
-    async def _generate_connection_string(self, host_data: Dict, client_uuid: str, 
+    async def _generate_connection_string(self, host_data: HostRow, client_uuid: str, 
                                         email: str, inbound_data: Dict) -> str:
-        """Генерация VLESS connection string"""
+        """Генерация VLESS connection string по метаданным инбаунда (см. _inbound_meta)"""
         try:
-            host_url = host_data['host_url']
-            host_name = host_data['host_name']
+            host_url = host_data.host_url
+            host_name = host_data.host_name
             
             # Парсим URL хоста
             parsed_url = urlparse(host_url)
@@ -1376,10 +4400,12 @@ class XUIAPI:
             
             if security == 'reality':
                 reality_settings = stream_settings.get('realitySettings', {})
-                public_key = reality_settings.get('publicKey', '')
+                # 3x-ui хранит publicKey и fingerprint во вложенном settings
+                client_settings = reality_settings.get('settings', {})
+                public_key = reality_settings.get('publicKey') or client_settings.get('publicKey', '')
                 server_names = reality_settings.get('serverNames', [])
                 short_ids = reality_settings.get('shortIds', [])
-                fingerprint = reality_settings.get('fingerprint', 'chrome')
+                fingerprint = reality_settings.get('fingerprint') or client_settings.get('fingerprint', 'chrome')
                 
                 if public_key and server_names and short_ids:
                     sni = server_names[0] if server_names else hostname
@@ -1415,18 +4441,18 @@ class XUIAPI:
             # Возвращаем базовую строку
             return f"vless://{client_uuid}@{hostname}:443?type=tcp&security=tls&flow=xtls-rprx-vision#{quote(host_name)}"
     
-    async def get_inbound_stats(self, host_data: Dict, inbound_id: int = None) -> Dict:
+    async def get_inbound_stats(self, host_data: HostRow, inbound_id: int = None) -> Dict:
         """Получение статистики инбаунда"""
         try:
-            host_url = host_data['host_url']
-            username = host_data['host_username']
-            password = host_data['host_pass']
+            host_url = host_data.host_url
+            username = host_data.host_username
+            password = host_data.host_pass
             
             if not inbound_id:
                 inbound_id = host_data.get('host_inbound_id', 1)
             
-            stats_url = f"{host_url}/panel/api/inbounds/getClientTraffics/{inbound_id}"
-            success, result = await self._make_request(stats_url, "GET", username=username, password=password)
+            success, result = await self._make_request(host_url, f"/panel/api/inbounds/getClientTraffics/{inbound_id}",
+                                                       username=username, password=password)
             
             if success:
                 if isinstance(result, dict) and result.get('success'):
@@ -1561,7 +4587,8 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Инициализация компонентов
-db = Database()
+db = create_storage()
+bot_settings = BotSettings(db.sync)
 xui_api = XUIAPI()
 crypto_bot = CryptoBotAPI(CRYPTOBOT_TOKEN) if CRYPTOBOT_TOKEN else None
 
@@ -1571,6 +4598,59 @@ dp = Dispatcher(storage=storage)
 router = Router()
 dp.include_router(router)
 
+# === КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ ===
+@dataclass
+class UserContext:
+    """Пользователь и сводка по его ключам, загруженные один раз на апдейт"""
+    user: Optional[UserRow]
+    key_count: int = 0
+    active_key_count: int = 0
+    latest_expiry_ts: Optional[int] = None
+    seconds_left: int = 0
+    
+    @property
+    def is_banned(self) -> bool:
+        return bool(self.user and self.user.is_banned)
+    
+    @property
+    def trial_used(self) -> bool:
+        return bool(self.user and self.user.trial_used)
+
+async def load_user_context(user_id: int) -> UserContext:
+    """Загрузка контекста пользователя одним обращением к базе"""
+    context = await db.get_user_context(user_id)
+    return UserContext(
+        user=context['user'],
+        key_count=context['key_count'],
+        active_key_count=context['active_key_count'],
+        latest_expiry_ts=context['latest_expiry_ts'],
+        seconds_left=context['seconds_left'] or 0
+    )
+
+class UserContextMiddleware(BaseMiddleware):
+    """Передает UserContext обработчикам, которые объявили аргумент user_ctx"""
+    
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        from_user = data.get('event_from_user')
+        
+        if from_user and handler_object and 'user_ctx' in handler_object.params:
+            user_ctx = data['user_ctx'] = await load_user_context(from_user.id)
+            
+            # Держим username и имя актуальными для поиска: пишем только при изменении
+            # (username без @username заполняется именем, как при регистрации в cmd_start)
+            user = user_ctx.user
+            username = from_user.username or from_user.full_name
+            if user and (user.username, user.full_name) != (username, from_user.full_name):
+                await db.update_user_profile(from_user.id, username, from_user.full_name)
+                user.username = username
+                user.full_name = from_user.full_name
+        
+        return await handler(event, data)
+
+dp.message.middleware(UserContextMiddleware())
+dp.callback_query.middleware(UserContextMiddleware())
+
 # === УТИЛИТЫ ===
 def create_qr_code(connection_string: str) -> BytesIO:
     """Создание QR-кода"""
@@ -1596,6 +4676,8 @@ def format_date(date_str_or_dt):
             dt = datetime.fromisoformat(date_str_or_dt.replace('Z', '+00:00'))
         except:
             dt = datetime.now()
+    elif isinstance(date_str_or_dt, (int, float)):
+        dt = datetime.fromtimestamp(date_str_or_dt)
     else:
         dt = date_str_or_dt
     
@@ -1608,28 +4690,13 @@ def format_date_short(date_str_or_dt):
             dt = datetime.fromisoformat(date_str_or_dt.replace('Z', '+00:00'))
         except:
             dt = datetime.now()
+    elif isinstance(date_str_or_dt, (int, float)):
+        dt = datetime.fromtimestamp(date_str_or_dt)
     else:
         dt = date_str_or_dt
     
     return dt.strftime('%d.%m.%Y')
 
-def calculate_days_left(expiry_date):
-    """Расчет оставшихся дней"""
-    if isinstance(expiry_date, str):
-        try:
-            expiry = datetime.fromisoformat(expiry_date.replace('Z', '+00:00'))
-        except:
-            expiry = datetime.now()
-    else:
-        expiry = expiry_date
-    
-    now = datetime.now()
-    if expiry < now:
-        return 0
-    
-    delta = expiry - now
-    return delta.days
-
 def format_price(price: float) -> str:
     """Форматирование цены"""
     if price.is_integer():
@@ -1654,17 +4721,15 @@ def create_admin_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
 # === КЛАВИАТУРЫ ===
-def create_main_menu(user_id: int) -> InlineKeyboardMarkup:
+def create_main_menu(user_id: int, user_ctx: UserContext) -> InlineKeyboardMarkup:
     """Создание главного меню"""
-    user_data = db.get_user(user_id)
-    user_keys = db.get_user_keys(user_id)
-    trial_available = TRIAL_ENABLED and (not user_data or not user_data.get('trial_used'))
+    trial_available = bot_settings.trial_enabled and not user_ctx.trial_used
     is_admin = user_id == ADMIN_ID
     
     builder = InlineKeyboardBuilder()
     
     builder.button(text="👤 Мой профиль", callback_data="show_profile")
-    builder.button(text=f"🔑 Мои ключи ({len(user_keys)})", callback_data="manage_keys")
+    builder.button(text=f"🔑 Мои ключи ({user_ctx.key_count})", callback_data="manage_keys")
     
     if trial_available:
         builder.button(text="🎁 Попробовать бесплатно", callback_data="get_trial")
@@ -1686,26 +4751,26 @@ def create_back_button(target: str = "back_to_main_menu") -> InlineKeyboardMarku
     builder.button(text="⬅️ Назад", callback_data=target)
     return builder.as_markup()
 
-def create_hosts_menu(hosts: List[Dict], action_prefix: str = "select_host_") -> InlineKeyboardMarkup:
+def create_hosts_menu(hosts: List[HostRow], action_prefix: str = "select_host_") -> InlineKeyboardMarkup:
     """Создание меню выбора хоста"""
     builder = InlineKeyboardBuilder()
     
     for host in hosts:
-        builder.button(text=host['host_name'], callback_data=f"{action_prefix}{host['host_name']}")
+        builder.button(text=host.host_name, callback_data=f"{action_prefix}{host.host_name}")
     
     builder.button(text="⬅️ Назад", callback_data="buy_new_key")
     builder.adjust(1)
     return builder.as_markup()
 
-def create_plans_menu(plans: List[Dict]) -> InlineKeyboardMarkup:
+def create_plans_menu(plans: List[PlanRow]) -> InlineKeyboardMarkup:
     """Создание меню выбора тарифа"""
     builder = InlineKeyboardBuilder()
     
     for plan in plans:
-        price_text = f"{int(plan['price'])}₽" if plan['price'].is_integer() else f"{plan['price']:.2f}₽"
+        price_text = f"{int(plan.price)}₽" if plan.price.is_integer() else f"{plan.price:.2f}₽"
         builder.button(
-            text=f"{plan['plan_name']} - {price_text}",
-            callback_data=f"select_plan_{plan['plan_id']}"
+            text=f"{plan.plan_name} - {price_text}",
+            callback_data=f"select_plan_{plan.plan_id}"
         )
     
     builder.button(text="⬅️ Назад", callback_data="buy_new_key")
@@ -1732,32 +4797,56 @@ def create_admin_main_menu() -> InlineKeyboardMarkup:
     builder.adjust(2, 2, 2, 2, 2, 1)
     return builder.as_markup()
 
+def page_callback_filter(prefix: str):
+    """Фильтр callback для списка: первая страница (prefix) и переходы (prefix:n:ключ / prefix:p:ключ)"""
+    return F.data.regexp(rf"^{prefix}(:[np]:[0-9.]+)?$")
+
+def parse_page_callback(data: str) -> Tuple[Optional[tuple], bool]:
+    """Ключ страницы и направление (True - назад) из callback_data"""
+    parts = data.split(":")
+    if len(parts) != 3:
+        return None, False
+    return tuple(int(value) for value in parts[2].split(".")), parts[1] == "p"
+
+def add_page_navigation(builder: InlineKeyboardBuilder, prefix: str, page: Page):
+    """Добавляет отдельным рядом кнопки перехода к соседним страницам"""
+    buttons = []
+    if page.prev_key:
+        prev_key = ".".join(map(str, page.prev_key))
+        buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"{prefix}:p:{prev_key}"))
+    if page.next_key:
+        next_key = ".".join(map(str, page.next_key))
+        buttons.append(InlineKeyboardButton(text="Вперед ▶️", callback_data=f"{prefix}:n:{next_key}"))
+    if buttons:
+        builder.row(*buttons)
+
 # === ОСНОВНЫЕ ОБРАБОТЧИКИ ===
 @dp.message(CommandStart())
-async def cmd_start(message: types.Message):
+async def cmd_start(message: types.Message, user_ctx: UserContext):
     """Обработчик команды /start"""
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.full_name
     full_name = message.from_user.full_name
     
-    # Парсим реферальный код
-    referrer_id = None
-    if message.text and len(message.text.split()) > 1:
-        args = message.text.split()[1]
-        if args.startswith('ref_'):
-            try:
-                referrer_id = int(args.split('_')[1])
-                referrer_data = db.get_user(referrer_id)
-                if not referrer_data:
+    if user_ctx.user is None:
+        # Парсим реферальный код
+        referrer_id = None
+        if message.text and len(message.text.split()) > 1:
+            args = message.text.split()[1]
+            if args.startswith('ref_'):
+                try:
+                    referrer_id = int(args.split('_')[1])
+                    referrer_data = await db.get_user(referrer_id)
+                    if not referrer_data:
+                        referrer_id = None
+                except:
                     referrer_id = None
-            except:
-                referrer_id = None
-    
-    db.register_user(user_id, username, full_name, referrer_id)
+        
+        await db.register_user(user_id, username, full_name, referrer_id)
+        user_ctx = await load_user_context(user_id)
     
     # Проверка блокировки
-    user_data = db.get_user(user_id)
-    if user_data and user_data.get('is_banned'):
+    if user_ctx.is_banned:
         await message.answer("❌ Вы заблокированы в системе.")
         return
     
@@ -1770,19 +4859,18 @@ async def cmd_start(message: types.Message):
         "Выберите действие:"
     )
     
-    await message.answer(welcome_text, reply_markup=create_main_menu(user_id))
+    await message.answer(welcome_text, reply_markup=create_main_menu(user_id, user_ctx))
 
 @dp.message(Command("menu"))
-async def cmd_menu(message: types.Message):
+async def cmd_menu(message: types.Message, user_ctx: UserContext):
     """Обработчик команды /menu"""
     user_id = message.from_user.id
-    user_data = db.get_user(user_id)
     
-    if user_data and user_data.get('is_banned'):
+    if user_ctx.is_banned:
         await message.answer("❌ Вы заблокированы")
         return
     
-    await message.answer("Главное меню:", reply_markup=create_main_menu(user_id))
+    await message.answer("Главное меню:", reply_markup=create_main_menu(user_id, user_ctx))
 
 @dp.message(Command("admin"))
 async def cmd_admin(message: types.Message):
@@ -1799,58 +4887,131 @@ async def cmd_admin(message: types.Message):
         reply_markup=create_admin_main_menu()
     )
 
+def format_method_stats(methods: List[MethodStats]) -> str:
+    text = ""
+    for stats in methods:
+        text += (
+            f"<code>{html.escape(stats.name)}</code>\n"
+            f"   {stats.calls} выз. | ср. {stats.total_ms / stats.calls:.1f} мс | "
+            f"p95 ≤ {stats.percentile(0.95):.0f} мс | макс. {stats.max_ms:.0f} мс"
+        )
+        if stats.errors:
+            text += f" | ошибок: {stats.errors}"
+        text += "\n"
+    return text
+
+@dp.message(Command("dbstats"))
+async def cmd_dbstats(message: types.Message):
+    """Время и число вызовов методов базы с момента запуска"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    methods = query_stats.methods()
+    if not methods:
+        await message.answer("📈 Вызовов базы пока не было")
+        return
+    
+    await message.answer("📈 <b>Методы базы</b> (по суммарному времени)\n\n" + format_method_stats(methods[:20]))
+
+@dp.message(Command("xuistats"))
+async def cmd_xuistats(message: types.Message):
+    """Время входа и запросов к X-UI панелям с момента запуска"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    methods = xui_stats.methods()
+    if not methods:
+        await message.answer("📈 Запросов к X-UI пока не было")
+        return
+    
+    await message.answer("📈 <b>Запросы к X-UI</b> (по суммарному времени)\n\n" + format_method_stats(methods[:20]))
+
+@dp.message(Command("explain"))
+async def cmd_explain(message: types.Message):
+    """Планы выполненных запросов: показывает те, что читают таблицы целиком"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    results = await db.explain_statements()
+    flagged = [result for result in results if result['full_scans']]
+    errors = sum(1 for result in results if result['error'])
+    
+    text = (
+        f"🔍 <b>EXPLAIN</b>\n\n"
+        f"Запросов: {len(results)} | с полным сканированием: {len(flagged)} | ошибок: {errors}\n\n"
+    )
+    for result in flagged[:8]:
+        sql = ' '.join(result['sql'].split())
+        text += f"⚠️ <b>{html.escape(', '.join(dict.fromkeys(result['full_scans'])))}</b>\n"
+        text += f"<code>{html.escape(sql[:300])}</code>\n\n"
+    if len(flagged) > 8:
+        text += f"... и еще {len(flagged) - 8}"
+    
+    await message.answer(text)
+
+@dp.message(Command("backup"))
+async def cmd_backup(message: types.Message):
+    """Внеочередная резервная копия базы"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    if DB_BACKEND != "sqlite":
+        await message.answer("❌ Резервные копии бот делает только для SQLite")
+        return
+    
+    await message.answer("💾 Создаю резервную копию...")
+    try:
+        backup_path = await run_backup()
+    except Exception as e:
+        logger.error(f"Error creating backup: {e}")
+        await message.answer(f"❌ Ошибка резервного копирования: {str(e)[:200]}")
+        return
+    
+    backups = list_backups()
+    await message.answer(
+        f"✅ Копия создана: <code>{html.escape(os.path.basename(backup_path))}</code>\n"
+        f"📦 Размер: {backup_size(backup_path) / 1024 / 1024:.1f} МБ\n"
+        f"🗂 Хранится копий: {len(backups)}"
+    )
+
 # === ОБРАБОТЧИКИ CALLBACK ===
 @dp.callback_query(F.data == "back_to_main_menu")
-async def back_to_main_menu_handler(callback: types.CallbackQuery):
+async def back_to_main_menu_handler(callback: types.CallbackQuery, user_ctx: UserContext):
     """Обработчик кнопки Назад в главное меню"""
     await callback.message.edit_text(
         "Главное меню:", 
-        reply_markup=create_main_menu(callback.from_user.id)
+        reply_markup=create_main_menu(callback.from_user.id, user_ctx)
     )
     await callback.answer()
 
 @dp.callback_query(F.data == "show_profile")
-async def show_profile_handler(callback: types.CallbackQuery):
+async def show_profile_handler(callback: types.CallbackQuery, user_ctx: UserContext):
     """Показать профиль пользователя"""
-    user_id = callback.from_user.id
-    user_data = db.get_user(user_id)
-    user_keys = db.get_user_keys(user_id)
+    user_data = user_ctx.user
     
     if not user_data:
         await callback.answer("Ошибка получения данных", show_alert=True)
         return
     
-    now = datetime.now()
-    active_keys = []
-    for key in user_keys:
-        expiry_date = datetime.fromisoformat(key['expiry_date']) if isinstance(key['expiry_date'], str) else key['expiry_date']
-        if expiry_date > now:
-            active_keys.append(key)
-    
-    if active_keys:
-        latest = max(active_keys, key=lambda k: datetime.fromisoformat(k['expiry_date']) if isinstance(k['expiry_date'], str) else k['expiry_date'])
-        expiry = datetime.fromisoformat(latest['expiry_date']) if isinstance(latest['expiry_date'], str) else latest['expiry_date']
-        time_left = expiry - now
-        days_left = time_left.days
-        hours_left = time_left.seconds // 3600
+    if user_ctx.active_key_count:
+        days_left, remainder = divmod(user_ctx.seconds_left, 86400)
+        hours_left = remainder // 3600
         vpn_status = f"✅ <b>Статус VPN:</b> Активен\n⏳ <b>Осталось:</b> {days_left} д. {hours_left} ч."
-    elif user_keys:
+    elif user_ctx.key_count:
         vpn_status = "❌ <b>Статус VPN:</b> Неактивен (срок истек)"
     else:
         vpn_status = "ℹ️ <b>Статус VPN:</b> У вас пока нет активных ключей."
     
-    created_date = datetime.fromisoformat(user_data['created_at']) if isinstance(user_data.get('created_at'), str) else user_data.get('created_at', datetime.now())
-    
     profile_text = (
         f"👤 <b>Профиль пользователя</b>\n\n"
-        f"🆔 ID: <code>{user_data['telegram_id']}</code>\n"
-        f"👤 Имя: {user_data['full_name'] or user_data['username']}\n"
-        f"📅 Регистрация: {created_date.strftime('%d.%m.%Y')}\n\n"
-        f"💰 <b>Потрачено всего:</b> {user_data['total_spent']:.0f} RUB\n"
-        f"📅 <b>Приобретено месяцев:</b> {user_data['total_months']}\n"
-        f"🎁 <b>Пробный период:</b> {'Использован' if user_data.get('trial_used') else 'Доступен'}\n\n"
+        f"🆔 ID: <code>{user_data.telegram_id}</code>\n"
+        f"👤 Имя: {user_data.full_name or user_data.username}\n"
+        f"📅 Регистрация: {format_date_short(user_data.created_ts)}\n\n"
+        f"💰 <b>Потрачено всего:</b> {user_data.total_spent:.0f} RUB\n"
+        f"📅 <b>Приобретено месяцев:</b> {user_data.total_months}\n"
+        f"🎁 <b>Пробный период:</b> {'Использован' if user_data.trial_used else 'Доступен'}\n\n"
         f"{vpn_status}\n\n"
-        f"🔑 <b>Всего ключей:</b> {len(user_keys)}"
+        f"🔑 <b>Всего ключей:</b> {user_ctx.key_count}"
     )
     
     builder = InlineKeyboardBuilder()
@@ -1862,42 +5023,39 @@ async def show_profile_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 @dp.callback_query(F.data == "manage_keys")
-async def manage_keys_handler(callback: types.CallbackQuery):
+async def manage_keys_handler(callback: types.CallbackQuery, user_ctx: UserContext):
     """Управление ключами пользователя"""
     user_id = callback.from_user.id
-    user_keys = db.get_user_keys(user_id)
+    user_keys = await db.get_user_keys(user_id)
     
     if not user_keys:
         text = "🔑 У вас пока нет ключей VPN.\n\nНажмите кнопку ниже, чтобы приобрести ключ:"
         builder = InlineKeyboardBuilder()
         builder.button(text="🛒 Купить VPN", callback_data="buy_new_key")
-        if TRIAL_ENABLED and not db.get_user(user_id).get('trial_used'):
+        if bot_settings.trial_enabled and not user_ctx.trial_used:
             builder.button(text="🎁 Попробовать бесплатно", callback_data="get_trial")
         builder.button(text="⬅️ Назад", callback_data="back_to_main_menu")
         builder.adjust(1)
     else:
-        now = datetime.now()
         text = "🔑 <b>Ваши ключи VPN:</b>\n\n"
         
         builder = InlineKeyboardBuilder()
         
         for i, key in enumerate(user_keys[:10], 1):
-            expiry_date = datetime.fromisoformat(key['expiry_date']) if isinstance(key['expiry_date'], str) else key['expiry_date']
-            is_active = expiry_date > now
+            is_active = not key.is_expired
             
             status_icon = "✅" if is_active else "❌"
-            expiry_str = expiry_date.strftime('%d.%m.%Y')
+            expiry_str = format_date_short(key.expiry_ts)
             
-            text += f"{i}. {status_icon} <b>{key['host_name']}</b>\n"
+            text += f"{i}. {status_icon} <b>{key.host_name}</b>\n"
             text += f"   📅 Срок: {expiry_str}\n"
             
             if is_active:
-                days_left = (expiry_date - now).days
-                text += f"   ⏳ Осталось: {days_left} д.\n"
+                text += f"   ⏳ Осталось: {key.days_left} д.\n"
             
             text += "\n"
             
-            builder.button(text=f"#{key['key_id']} - {key['host_name']}", callback_data=f"view_key_{key['key_id']}")
+            builder.button(text=f"#{key.key_id} - {key.host_name}", callback_data=f"view_key_{key.key_id}")
         
         if len(user_keys) > 10:
             text += f"\n... и еще {len(user_keys) - 10} ключей"
@@ -1913,49 +5071,35 @@ async def view_key_handler(callback: types.CallbackQuery):
     """Просмотр конкретного ключа"""
     try:
         key_id = int(callback.data.split("_")[2])
-        key_data = db.get_key_by_id(key_id)
+        key_data = await db.get_key_by_id(key_id)
         
-        if not key_data or key_data['user_id'] != callback.from_user.id:
+        if not key_data or key_data.user_id != callback.from_user.id:
             await callback.answer("Ключ не найден", show_alert=True)
             return
         
-        host_data = db.get_host(key_data['host_name'])
+        host_data = await db.get_host(key_data.host_name)
         if not host_data:
             await callback.answer("Хост не найден", show_alert=True)
             return
         
-        # Получаем актуальную информацию от X-UI
-        result = await xui_api.create_client(
-            host_data,
-            key_data['key_email'],
-            1  # Тест на 1 день для генерации строки
+        connection_string = await xui_api.get_connection_string(
+            host_data, key_data.xui_client_uuid, key_data.key_email
         )
         
-        if result.get('error'):
-            # Если ошибка, генерируем базовую строку
-            host_url = host_data['host_url'].replace('https://', '').replace('http://', '').split(':')[0]
-            connection_string = f"vless://{key_data['xui_client_uuid']}@{host_url}:443?type=tcp&security=tls&flow=xtls-rprx-vision#{quote(key_data['host_name'])}"
-        else:
-            connection_string = result['connection_string'].replace(key_data['xui_client_uuid'], key_data['xui_client_uuid'])
-        
-        expiry_date = datetime.fromisoformat(key_data['expiry_date']) if isinstance(key_data['expiry_date'], str) else key_data['expiry_date']
-        now = datetime.now()
-        is_active = expiry_date > now
-        
+        is_active = not key_data.is_expired
         status_text = "✅ Активен" if is_active else "❌ Истек"
-        time_left = expiry_date - now if is_active else timedelta(0)
         
         text = (
-            f"🔑 <b>Ключ #{key_data['key_id']}</b>\n\n"
-            f"🖥️ <b>Сервер:</b> {key_data['host_name']}\n"
-            f"📧 <b>Email:</b> {key_data['key_email']}\n"
-            f"📅 <b>Создан:</b> {key_data['created_date'][:10] if isinstance(key_data['created_date'], str) else key_data['created_date'].strftime('%d.%m.%Y')}\n"
-            f"📅 <b>Действует до:</b> {expiry_date.strftime('%d.%m.%Y %H:%M')}\n"
+            f"🔑 <b>Ключ #{key_data.key_id}</b>\n\n"
+            f"🖥️ <b>Сервер:</b> {key_data.host_name}\n"
+            f"📧 <b>Email:</b> {key_data.key_email}\n"
+            f"📅 <b>Создан:</b> {format_date_short(key_data.created_ts)}\n"
+            f"📅 <b>Действует до:</b> {format_date(key_data.expiry_ts)}\n"
             f"📊 <b>Статус:</b> {status_text}\n"
         )
         
         if is_active:
-            text += f"⏳ <b>Осталось:</b> {time_left.days} дней\n\n"
+            text += f"⏳ <b>Осталось:</b> {key_data.days_left} дней\n\n"
         
         text += f"<code>{connection_string}</code>"
         
@@ -1981,36 +5125,28 @@ async def qr_handler(callback: types.CallbackQuery):
     """Генерация QR-кода"""
     try:
         key_id = int(callback.data.split("_")[1])
-        key_data = db.get_key_by_id(key_id)
+        key_data = await db.get_key_by_id(key_id)
         
-        if not key_data or key_data['user_id'] != callback.from_user.id:
+        if not key_data or key_data.user_id != callback.from_user.id:
             await callback.answer("Ключ не найден", show_alert=True)
             return
         
-        host_data = db.get_host(key_data['host_name'])
+        host_data = await db.get_host(key_data.host_name)
         if not host_data:
             await callback.answer("Хост не найден", show_alert=True)
             return
         
         # Генерируем connection string
-        result = await xui_api.create_client(
-            host_data,
-            key_data['key_email'],
-            1
+        connection_string = await xui_api.get_connection_string(
+            host_data, key_data.xui_client_uuid, key_data.key_email
         )
         
-        if result.get('error'):
-            host_url = host_data['host_url'].replace('https://', '').replace('http://', '').split(':')[0]
-            connection_string = f"vless://{key_data['xui_client_uuid']}@{host_url}:443?type=tcp&security=tls&flow=xtls-rprx-vision#{quote(key_data['host_name'])}"
-        else:
-            connection_string = result['connection_string'].replace(key_data['xui_client_uuid'], key_data['xui_client_uuid'])
-        
         qr_image = create_qr_code(connection_string)
         
         text = (
             f"📱 <b>QR-код для ключа #{key_id}</b>\n\n"
-            f"🖥️ Сервер: {key_data['host_name']}\n"
-            f"📅 Действует до: {key_data['expiry_date'][:10] if isinstance(key_data['expiry_date'], str) else key_data['expiry_date'].strftime('%d.%m.%Y')}\n\n"
+            f"🖥️ Сервер: {key_data.host_name}\n"
+            f"📅 Действует до: {format_date_short(key_data.expiry_ts)}\n\n"
             "Отсканируйте QR-код в приложении V2Ray/VLESS."
         )
         
@@ -2033,9 +5169,9 @@ async def delete_key_handler(callback: types.CallbackQuery):
     """Удаление ключа"""
     try:
         key_id = int(callback.data.split("_")[2])
-        key_data = db.get_key_by_id(key_id)
+        key_data = await db.get_key_by_id(key_id)
         
-        if not key_data or key_data['user_id'] != callback.from_user.id:
+        if not key_data or key_data.user_id != callback.from_user.id:
             await callback.answer("Ключ не найден", show_alert=True)
             return
         
@@ -2045,7 +5181,7 @@ async def delete_key_handler(callback: types.CallbackQuery):
         
         await callback.message.edit_text(
             f"🗑️ <b>Удаление ключа #{key_id}</b>\n\n"
-            f"Вы уверены, что хотите удалить ключ для сервера {key_data['host_name']}?\n"
+            f"Вы уверены, что хотите удалить ключ для сервера {key_data.host_name}?\n"
             f"⚠️ Это действие нельзя отменить.",
             reply_markup=builder.as_markup()
         )
@@ -2056,52 +5192,52 @@ async def delete_key_handler(callback: types.CallbackQuery):
         await callback.answer("Ошибка", show_alert=True)
 
 @dp.callback_query(F.data.startswith("confirm_delete_key_"))
-async def confirm_delete_key_handler(callback: types.CallbackQuery):
+async def confirm_delete_key_handler(callback: types.CallbackQuery, user_ctx: UserContext):
     """Подтверждение удаления ключа"""
     try:
         key_id = int(callback.data.split("_")[3])
-        key_data = db.get_key_by_id(key_id)
+        key_data = await db.get_key_by_id(key_id)
         
-        if not key_data or key_data['user_id'] != callback.from_user.id:
+        if not key_data or key_data.user_id != callback.from_user.id:
             await callback.answer("Ключ не найден", show_alert=True)
             return
         
         # Удаляем клиента из X-UI
-        host_data = db.get_host(key_data['host_name'])
+        host_data = await db.get_host(key_data.host_name)
         if host_data:
-            await xui_api.delete_client(host_data, key_data['xui_client_uuid'])
+            await xui_api.delete_client(host_data, key_data.xui_client_uuid)
         
         # Удаляем из базы данных
-        db.delete_key(key_id)
+        await db.delete_key(key_id)
         
         await callback.answer("✅ Ключ удален", show_alert=True)
-        await manage_keys_handler(callback)
+        await manage_keys_handler(callback, user_ctx)
         
     except Exception as e:
         logger.error(f"Error confirming delete: {e}")
         await callback.answer("Ошибка", show_alert=True)
 
 @dp.callback_query(F.data == "get_trial")
-async def get_trial_handler(callback: types.CallbackQuery):
+async def get_trial_handler(callback: types.CallbackQuery, user_ctx: UserContext):
     """Получение пробного ключа"""
     user_id = callback.from_user.id
-    user_data = db.get_user(user_id)
+    user_data = user_ctx.user
     
-    if not TRIAL_ENABLED:
+    if not bot_settings.trial_enabled:
         await callback.answer("Пробный период отключен", show_alert=True)
         return
     
-    if user_data and user_data.get('trial_used'):
+    if user_data and user_data.trial_used:
         await callback.answer("Вы уже использовали пробный период", show_alert=True)
         return
     
-    hosts = db.get_all_hosts()
+    hosts = await db.get_all_hosts()
     if not hosts:
         await callback.message.edit_text("❌ Нет доступных серверов")
         return
     
     host = hosts[0]
-    email = f"user{user_id}-trial@{host['host_name'].replace(' ', '').lower()}.bot"
+    email = f"user{user_id}-trial@{host.host_name.replace(' ', '').lower()}.bot"
     
     await callback.message.edit_text("🔄 Создаю пробный ключ...")
     
@@ -2109,7 +5245,7 @@ async def get_trial_handler(callback: types.CallbackQuery):
     result = await xui_api.create_client(
         host,
         email,
-        TRIAL_DURATION_DAYS
+        bot_settings.trial_duration_days
     )
     
     if result.get('error'):
@@ -2117,22 +5253,22 @@ async def get_trial_handler(callback: types.CallbackQuery):
         return
     
     # Сохраняем ключ в базу данных
-    key_id = db.add_key(
+    key_id = await db.add_key(
         user_id,
-        host['host_name'],
+        host.host_name,
         result['client_uuid'],
         email,
         result['expiry_date']
     )
     
     # Помечаем пробный период как использованный
-    db.set_trial_used(user_id)
+    await db.set_trial_used(user_id)
     
     # Начисляем реферальный бонус если есть реферер
-    if user_data and user_data.get('referred_by'):
-        referrer_id = user_data['referred_by']
+    if user_data and user_data.referred_by:
+        referrer_id = user_data.referred_by
         bonus_amount = 50  # Бонус за реферала
-        db.add_referral_balance(referrer_id, bonus_amount)
+        await db.add_referral_balance(referrer_id, bonus_amount)
     
     expiry_date = result['expiry_date']
     expiry_formatted = expiry_date.strftime('%d.%m.%Y в %H:%M')
@@ -2140,8 +5276,8 @@ async def get_trial_handler(callback: types.CallbackQuery):
     success_text = (
         f"🎉 <b>Ваш пробный ключ готов!</b>\n\n"
         f"⏳ <b>Действует до:</b> {expiry_formatted}\n"
-        f"🖥️ <b>Сервер:</b> {host['host_name']}\n"
-        f"📅 <b>Длительность:</b> {TRIAL_DURATION_DAYS} дней\n\n"
+        f"🖥️ <b>Сервер:</b> {host.host_name}\n"
+        f"📅 <b>Длительность:</b> {bot_settings.trial_duration_days} дней\n\n"
         f"<code>{result['connection_string']}</code>"
     )
     
@@ -2157,7 +5293,7 @@ async def get_trial_handler(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "buy_new_key")
 async def buy_new_key_handler(callback: types.CallbackQuery):
     """Покупка нового ключа"""
-    hosts = db.get_all_hosts()
+    hosts = await db.get_all_hosts()
     
     if not hosts:
         await callback.message.edit_text("❌ Нет доступных серверов")
@@ -2172,7 +5308,7 @@ async def buy_new_key_handler(callback: types.CallbackQuery):
 async def select_host_handler(callback: types.CallbackQuery):
     """Выбор хоста"""
     host_name = callback.data.split("_")[2]
-    plans = db.get_plans_for_host(host_name)
+    plans = await db.get_plans_for_host(host_name)
     
     if not plans:
         await callback.message.edit_text(f"❌ Нет тарифов для {host_name}")
@@ -2184,27 +5320,25 @@ async def select_host_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("select_plan_"))
-async def select_plan_handler(callback: types.CallbackQuery):
+async def select_plan_handler(callback: types.CallbackQuery, user_ctx: UserContext):
     """Выбор тарифного плана"""
     plan_id = int(callback.data.split("_")[2])
-    plan = db.get_plan_by_id(plan_id)
+    plan = await db.get_plan_by_id(plan_id)
     
     if not plan:
         await callback.answer("Ошибка: план не найден", show_alert=True)
         return
     
-    user_id = callback.from_user.id
-    user_data = db.get_user(user_id)
+    user_data = user_ctx.user
     
     # Применяем реферальную скидку если есть
-    price = float(plan['price'])
+    price = float(plan.price)
     discount = 0
     
-    if ENABLE_REFERRALS and user_data and user_data.get('referred_by'):
+    if bot_settings.enable_referrals and user_data and user_data.referred_by:
         # Реферал получает скидку на первую покупку
-        user_keys = db.get_user_keys(user_id)
-        if len(user_keys) == 0:  # Первая покупка
-            discount = price * (REFERRAL_DISCOUNT / 100)
+        if user_ctx.key_count == 0:  # Первая покупка
+            discount = price * (bot_settings.referral_discount / 100)
             price -= discount
     
     builder = InlineKeyboardBuilder()
@@ -2213,21 +5347,21 @@ async def select_plan_handler(callback: types.CallbackQuery):
     if crypto_bot:
         builder.button(text="🤖 CryptoBot (USDT)", callback_data=f"pay_cryptobot_{plan_id}")
     
-    builder.button(text="⬅️ Назад", callback_data=f"select_host_{plan['host_name']}")
+    builder.button(text="⬅️ Назад", callback_data=f"select_host_{plan.host_name}")
     builder.adjust(1)
     
     if discount > 0:
         original_price = price + discount
-        price_text = f"<s>{original_price:.2f}₽</s> <b>{price:.2f}₽</b> (-{REFERRAL_DISCOUNT}%)"
+        price_text = f"<s>{original_price:.2f}₽</s> <b>{price:.2f}₽</b> (-{bot_settings.referral_discount}%)"
     else:
         price_text = f"<b>{price:.2f}₽</b>"
     
     await callback.message.edit_text(
         f"🛒 <b>Оформление заказа</b>\n\n"
-        f"📋 <b>План:</b> {plan['plan_name']}\n"
+        f"📋 <b>План:</b> {plan.plan_name}\n"
         f"💰 <b>Цена:</b> {price_text}\n"
-        f"📅 <b>Срок:</b> {plan['months']} месяцев\n"
-        f"🖥️ <b>Сервер:</b> {plan['host_name']}\n\n"
+        f"📅 <b>Срок:</b> {plan.months} месяцев\n"
+        f"🖥️ <b>Сервер:</b> {plan.host_name}\n\n"
         "Выберите способ оплаты:",
         reply_markup=builder.as_markup()
     )
@@ -2235,13 +5369,13 @@ async def select_plan_handler(callback: types.CallbackQuery):
 
 # === ОПЛАТА CRYPTOBOT ===
 @dp.callback_query(F.data.startswith("pay_cryptobot_"))
-async def pay_cryptobot_handler(callback: types.CallbackQuery):
+async def pay_cryptobot_handler(callback: types.CallbackQuery, user_ctx: UserContext):
     """Обработка оплаты через CryptoBot"""
     try:
         plan_id = int(callback.data.split("_")[2])
-        plan = db.get_plan_by_id(plan_id)
+        plan = await db.get_plan_by_id(plan_id)
         user_id = callback.from_user.id
-        user_data = db.get_user(user_id)
+        user_data = user_ctx.user
         
         if not plan:
             await callback.answer("Ошибка: план не найден", show_alert=True)
@@ -2252,13 +5386,12 @@ async def pay_cryptobot_handler(callback: types.CallbackQuery):
             return
         
         # Рассчитываем цену с учетом скидки
-        price = float(plan['price'])
+        price = float(plan.price)
         discount = 0
         
-        if ENABLE_REFERRALS and user_data and user_data.get('referred_by'):
-            user_keys = db.get_user_keys(user_id)
-            if len(user_keys) == 0:  # Первая покупка
-                discount = price * (REFERRAL_DISCOUNT / 100)
+        if bot_settings.enable_referrals and user_data and user_data.referred_by:
+            if user_ctx.key_count == 0:  # Первая покупка
+                discount = price * (bot_settings.referral_discount / 100)
                 price -= discount
         
         # Получаем курс USDT к RUB
@@ -2285,7 +5418,7 @@ async def pay_cryptobot_handler(callback: types.CallbackQuery):
         result = await crypto_bot.create_invoice(
             amount=amount_usdt,
             asset="USDT",
-            description=f"VPN Plan: {plan['plan_name']} for {plan['months']} months",
+            description=f"VPN Plan: {plan.plan_name} for {plan.months} months",
             hidden_message="Thank you for purchasing VPN service!"
         )
         
@@ -2298,16 +5431,16 @@ async def pay_cryptobot_handler(callback: types.CallbackQuery):
         # Сохраняем платеж в базу данных
         metadata = {
             "plan_id": plan_id,
-            "host_name": plan['host_name'],
-            "plan_name": plan['plan_name'],
-            "months": plan['months'],
+            "host_name": plan.host_name,
+            "plan_name": plan.plan_name,
+            "months": plan.months,
             "price_rub": price,
             "price_usdt": amount_usdt,
             "discount": discount,
             "exchange_rate": usdt_rate
         }
         
-        db.create_crypto_payment(
+        await db.create_crypto_payment(
             invoice_id=invoice['invoice_id'],
             user_id=user_id,
             plan_id=plan_id,
@@ -2325,8 +5458,8 @@ async def pay_cryptobot_handler(callback: types.CallbackQuery):
         await callback.message.edit_text(
             f"🤖 <b>Счет CryptoBot создан!</b>\n\n"
             f"💰 <b>Сумма:</b> {amount_usdt:.2f} USDT (~{price:.0f}₽)\n"
-            f"📅 <b>Срок:</b> {plan['months']} месяцев\n"
-            f"🖥️ <b>Сервер:</b> {plan['host_name']}\n\n"
+            f"📅 <b>Срок:</b> {plan.months} месяцев\n"
+            f"🖥️ <b>Сервер:</b> {plan.host_name}\n\n"
             "Нажмите кнопку для оплаты. После оплаты нажмите 'Проверить оплату'.\n\n"
             f"<i>Счет действителен 1 час</i>",
             reply_markup=builder.as_markup()
@@ -2346,7 +5479,7 @@ async def check_crypto_payment_handler(callback: types.CallbackQuery):
     
     try:
         # Получаем информацию о платеже из базы данных
-        payment_data = db.get_crypto_payment(invoice_id)
+        payment_data = await db.get_crypto_payment(invoice_id)
         
         if not payment_data:
             await callback.answer("Платеж не найден", show_alert=True)
@@ -2369,83 +5502,40 @@ async def check_crypto_payment_handler(callback: types.CallbackQuery):
         status = invoice['status']
         
         if status == 'paid':
-            # Обновляем статус в базе данных
-            db.update_crypto_payment_status(invoice_id, 'paid')
+            # Забираем платеж в обработку: фоновая проверка могла уже выдать по нему ключ
+            if not await db.claim_crypto_payment(invoice_id):
+                await callback.answer("Этот платеж уже обработан", show_alert=True)
+                return
             
             # Создаем ключ VPN
-            user_id = payment_data['user_id']
-            plan_id = payment_data['plan_id']
-            plan = db.get_plan_by_id(plan_id)
+            user_id = payment_data.user_id
+            plan_id = payment_data.plan_id
+            plan = await db.get_plan_by_id(plan_id)
             
             if not plan:
+                await db.update_crypto_payment_status(invoice_id, 'error')
                 await callback.answer("Ошибка: план не найден", show_alert=True)
                 return
             
-            host_data = db.get_host(plan['host_name'])
+            host_data = await db.get_host(plan.host_name)
             if not host_data:
+                await db.update_crypto_payment_status(invoice_id, 'error')
                 await callback.answer("Ошибка: сервер не найден", show_alert=True)
                 return
             
-            # Генерируем email для ключа
-            user_data = db.get_user(user_id)
-            email = f"user{user_id}-{plan_id}@{host_data['host_name'].replace(' ', '').lower()}.vpn"
-            
-            # Создаем ключ в X-UI
-            result = await xui_api.create_client(
-                host_data,
-                email,
-                plan['months'] * 30  # Переводим месяцы в дни
-            )
+            # Создаем ключ в X-UI (или берем созданный при прошлой попытке)
+            result = await provision_payment_key(payment_data, plan, host_data)
             
             if result.get('error'):
+                await db.update_crypto_payment_status(invoice_id, 'error')
                 await callback.answer(f"Ошибка создания ключа: {result['error']}", show_alert=True)
                 return
             
-            # Сохраняем ключ в базу данных
-            key_id = db.add_key(
-                user_id,
-                host_data['host_name'],
-                result['client_uuid'],
-                email,
-                result['expiry_date']
-            )
-            
-            # Обновляем статистику пользователя
-            metadata = json.loads(payment_data['metadata'])
-            price_rub = metadata.get('price_rub', 0)
-            
-            db.update_user_stats(user_id, price_rub, plan['months'])
-            
-            # Логируем транзакцию
-            db.log_transaction(
-                username=user_data.get('username') or user_data.get('full_name'),
-                user_id=user_id,
-                status='paid',
-                amount_rub=price_rub,
-                payment_method='CryptoBot',
-                metadata={
-                    'plan_id': plan_id,
-                    'key_id': key_id,
-                    'invoice_id': invoice_id
-                }
-            )
-            
-            # Начисляем реферальный бонус
-            if ENABLE_REFERRALS and user_data and user_data.get('referred_by'):
-                referrer_id = user_data['referred_by']
-                bonus_amount = price_rub * (REFERRAL_PERCENTAGE / 100)
-                db.add_referral_balance(referrer_id, bonus_amount)
-            
-            # Обновляем payment с key_id
-            db.create_crypto_payment(
-                invoice_id=invoice_id,
-                user_id=user_id,
-                plan_id=plan_id,
-                amount=payment_data['amount'],
-                asset=payment_data['asset'],
-                metadata=metadata,
-                key_id=key_id
-            )
+            # Ключ, статистика, транзакция и бонус реферера - одной транзакцией
+            key_id = await fulfill_payment_key(payment_data, plan, host_data, result)
+            if key_id is None:
+                await callback.answer("Ошибка сохранения ключа, попробуйте проверить оплату еще раз", show_alert=True)
+                return
             
             # Отправляем ключ пользователю
             expiry_date = result['expiry_date']
@@ -2454,9 +5544,9 @@ async def check_crypto_payment_handler(callback: types.CallbackQuery):
             success_text = (
                 f"🎉 <b>Оплата подтверждена!</b>\n\n"
                 f"✅ <b>Ваш VPN ключ создан:</b>\n"
-                f"🖥️ <b>Сервер:</b> {host_data['host_name']}\n"
+                f"🖥️ <b>Сервер:</b> {host_data.host_name}\n"
                 f"📅 <b>Действует до:</b> {expiry_formatted}\n"
-                f"📅 <b>Срок:</b> {plan['months']} месяцев\n\n"
+                f"📅 <b>Срок:</b> {plan.months} месяцев\n\n"
                 f"<code>{result['connection_string']}</code>"
             )
             
@@ -2479,16 +5569,16 @@ async def check_crypto_payment_handler(callback: types.CallbackQuery):
 
 # === РЕФЕРАЛЬНАЯ СИСТЕМА ===
 @dp.callback_query(F.data == "show_referrals")
-async def show_referrals_handler(callback: types.CallbackQuery):
+async def show_referrals_handler(callback: types.CallbackQuery, user_ctx: UserContext):
     """Показать реферальную программу"""
     user_id = callback.from_user.id
-    user_data = db.get_user(user_id)
+    user_data = user_ctx.user
     
     if not user_data:
         await callback.answer("Ошибка", show_alert=True)
         return
     
-    referrals = db.get_referrals(user_id)
+    referral_count = await db.get_referral_count(user_id)
     bot_username = TELEGRAM_BOT_USERNAME or (await bot.get_me()).username
     referral_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
     
@@ -2496,22 +5586,22 @@ async def show_referrals_handler(callback: types.CallbackQuery):
         f"🤝 <b>Реферальная программа</b>\n\n"
         f"💎 <b>Ваша ссылка:</b>\n<code>{referral_link}</code>\n\n"
         f"📊 <b>Статистика:</b>\n"
-        f"• Рефералов: {len(referrals)}\n"
+        f"• Рефералов: {referral_count}\n"
         f"• Баланс: {user_data.get('referral_balance', 0):.2f}₽\n"
-        f"• Минимальный вывод: {MINIMUM_WITHDRAWAL}₽\n\n"
+        f"• Минимальный вывод: {bot_settings.minimum_withdrawal}₽\n\n"
         f"🎁 <b>Бонусы:</b>\n"
-        f"• Вы получаете {REFERRAL_PERCENTAGE}% от покупок рефералов\n"
-        f"• Реферал получает {REFERRAL_DISCOUNT}% скидку на первую покупку\n\n"
+        f"• Вы получаете {bot_settings.referral_percentage}% от покупок рефералов\n"
+        f"• Реферал получает {bot_settings.referral_discount}% скидку на первую покупку\n\n"
         f"💸 <b>Вывод средств:</b>\n"
-        f"Доступен при достижении {MINIMUM_WITHDRAWAL}₽ на балансе"
+        f"Доступен при достижении {bot_settings.minimum_withdrawal}₽ на балансе"
     )
     
     builder = InlineKeyboardBuilder()
     
-    if referrals:
+    if referral_count:
         builder.button(text="👥 Список рефералов", callback_data="show_referrals_list")
     
-    if user_data.get('referral_balance', 0) >= MINIMUM_WITHDRAWAL:
+    if user_data.get('referral_balance', 0) >= bot_settings.minimum_withdrawal:
         builder.button(text="💰 Вывести средства", callback_data="withdraw_referral")
     
     builder.button(text="📋 Как работает", callback_data="referral_help")
@@ -2521,11 +5611,33 @@ async def show_referrals_handler(callback: types.CallbackQuery):
     await callback.message.edit_text(text, reply_markup=builder.as_markup())
     await callback.answer()
 
+@dp.callback_query(page_callback_filter("show_referrals_list"))
+async def show_referrals_list_handler(callback: types.CallbackQuery):
+    """Список рефералов пользователя"""
+    key, backward = parse_page_callback(callback.data)
+    page = await db.get_referrals_page(callback.from_user.id, key, backward)
+    
+    text = "👥 <b>Ваши рефералы</b>\n\n"
+    
+    if not page.items:
+        text += "Рефералов пока нет."
+    
+    for referral in page.items:
+        name = referral.full_name or referral.username or f"ID: {referral.telegram_id}"
+        text += f"• {name} | 📅 {format_date_short(referral.created_ts)}\n"
+    
+    builder = InlineKeyboardBuilder()
+    add_page_navigation(builder, "show_referrals_list", page)
+    builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="show_referrals"))
+    
+    await callback.message.edit_text(text, reply_markup=builder.as_markup())
+    await callback.answer()
+
 @dp.callback_query(F.data == "withdraw_referral")
-async def withdraw_referral_handler(callback: types.CallbackQuery, state: FSMContext):
+async def withdraw_referral_handler(callback: types.CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Вывод реферальных средств"""
     user_id = callback.from_user.id
-    user_data = db.get_user(user_id)
+    user_data = user_ctx.user
     
     if not user_data:
         await callback.answer("Ошибка", show_alert=True)
@@ -2533,9 +5645,9 @@ async def withdraw_referral_handler(callback: types.CallbackQuery, state: FSMCon
     
     balance = user_data.get('referral_balance', 0)
     
-    if balance < MINIMUM_WITHDRAWAL:
+    if balance < bot_settings.minimum_withdrawal:
         await callback.answer(
-            f"Минимальная сумма для вывода: {MINIMUM_WITHDRAWAL}₽\n"
+            f"Минимальная сумма для вывода: {bot_settings.minimum_withdrawal}₽\n"
             f"Ваш баланс: {balance:.2f}₽",
             show_alert=True
         )
@@ -2547,7 +5659,7 @@ async def withdraw_referral_handler(callback: types.CallbackQuery, state: FSMCon
     await callback.message.edit_text(
         f"💰 <b>Вывод реферальных средств</b>\n\n"
         f"💎 <b>Доступно для вывода:</b> {balance:.2f}₽\n"
-        f"💳 <b>Минимальная сумма:</b> {MINIMUM_WITHDRAWAL}₽\n\n"
+        f"💳 <b>Минимальная сумма:</b> {bot_settings.minimum_withdrawal}₽\n\n"
         f"📝 <b>Укажите:</b>\n"
         f"1. Сумму вывода (не более {balance:.2f}₽)\n"
         f"2. Реквизиты для перевода\n\n"
@@ -2592,8 +5704,8 @@ async def process_withdrawal_details(message: Message, state: FSMContext):
             await message.answer("❌ Неверный формат суммы. Укажите число.")
             return
         
-        if amount < MINIMUM_WITHDRAWAL:
-            await message.answer(f"❌ Минимальная сумма для вывода: {MINIMUM_WITHDRAWAL}₽")
+        if amount < bot_settings.minimum_withdrawal:
+            await message.answer(f"❌ Минимальная сумма для вывода: {bot_settings.minimum_withdrawal}₽")
             return
         
         if amount > balance:
@@ -2601,10 +5713,10 @@ async def process_withdrawal_details(message: Message, state: FSMContext):
             return
         
         # Создаем заявку на вывод
-        withdrawal_id = db.withdraw_referral_balance(user_id, amount, details)
+        withdrawal_id = await db.withdraw_referral_balance(user_id, amount, details)
         
-        user_data = db.get_user(user_id)
-        username = user_data.get('username') or user_data.get('full_name')
+        user_data = await db.get_user(user_id)
+        username = user_data.username or user_data.full_name
         
         # Отправляем уведомление админу
         admin_text = (
@@ -2647,8 +5759,9 @@ async def process_withdrawal_details(message: Message, state: FSMContext):
 @dp.callback_query(F.data == "show_help")
 async def show_help_handler(callback: types.CallbackQuery, state: FSMContext):
     """Показать помощь"""
-    support_user = SUPPORT_USER if SUPPORT_USER else "администратору"
-    support_text = SUPPORT_TEXT if SUPPORT_TEXT else "Напишите нам в поддержку"
+    support_contact = bot_settings.support_user
+    support_user = support_contact if support_contact else "администратору"
+    support_text = bot_settings.support_text or "Напишите нам в поддержку"
     
     text = (
         f"🆘 <b>Поддержка</b>\n\n"
@@ -2664,19 +5777,19 @@ async def show_help_handler(callback: types.CallbackQuery, state: FSMContext):
         f"• <b>Как продлить ключ?</b>\n"
         f"Купите новый ключ на тот же сервер\n\n"
         f"<b>Приложения для подключения:</b>\n"
-        f"• Android: {ANDROID_URL}\n"
-        f"• iOS: {IOS_URL}\n"
-        f"• Windows: {WINDOWS_URL}\n"
-        f"• Linux: {LINUX_URL}\n\n"
+        f"• Android: {bot_settings.android_url}\n"
+        f"• iOS: {bot_settings.ios_url}\n"
+        f"• Windows: {bot_settings.windows_url}\n"
+        f"• Linux: {bot_settings.linux_url}\n\n"
         f"Нажмите кнопку ниже чтобы написать в поддержку:"
     )
     
     builder = InlineKeyboardBuilder()
     
-    if SUPPORT_USER.startswith('@'):
-        builder.button(text="💬 Написать в поддержку", url=f"https://t.me/{SUPPORT_USER.replace('@', '')}")
-    elif SUPPORT_USER.isdigit():
-        builder.button(text="💬 Написать в поддержку", url=f"tg://user?id={SUPPORT_USER}")
+    if support_contact.startswith('@'):
+        builder.button(text="💬 Написать в поддержку", url=f"https://t.me/{support_contact.replace('@', '')}")
+    elif support_contact.isdigit():
+        builder.button(text="💬 Написать в поддержку", url=f"tg://user?id={support_contact}")
     
     builder.button(text="📝 Отправить сообщение", callback_data="send_support_message")
     builder.button(text="⬅️ Назад", callback_data="back_to_main_menu")
@@ -2707,15 +5820,15 @@ async def send_support_message_handler(callback: types.CallbackQuery, state: FSM
     await callback.answer()
 
 @dp.message(Form.waiting_for_support_message)
-async def process_support_message(message: Message, state: FSMContext):
+async def process_support_message(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка сообщения в поддержку"""
     try:
         user_id = message.from_user.id
-        user_data = db.get_user(user_id)
-        username = user_data.get('username') or user_data.get('full_name') or f"ID: {user_id}"
+        user_data = user_ctx.user
+        username = (user_data and (user_data.username or user_data.full_name)) or f"ID: {user_id}"
         
         # Сохраняем сообщение в базе данных
-        message_id = db.create_support_message(user_id, message.text)
+        message_id = await db.create_support_message(user_id, message.text)
         
         # Отправляем уведомление админу
         admin_text = (
@@ -2748,7 +5861,10 @@ async def process_support_message(message: Message, state: FSMContext):
 @dp.callback_query(F.data == "show_about")
 async def show_about_handler(callback: types.CallbackQuery):
     """Показать информацию о проекте"""
-    about_text = ABOUT_TEXT if ABOUT_TEXT else "VPN сервис для безопасного и свободного интернета"
+    about_text = bot_settings.about_text or "VPN сервис для безопасного и свободного интернета"
+    terms_url = bot_settings.terms_url
+    privacy_url = bot_settings.privacy_url
+    channel_url = bot_settings.channel_url
     
     text = (
         f"ℹ️ <b>О проекте</b>\n\n"
@@ -2765,21 +5881,21 @@ async def show_about_handler(callback: types.CallbackQuery):
         f"• Глобальная сеть серверов\n\n"
     )
     
-    if TERMS_URL:
-        text += f"📄 <a href='{TERMS_URL}'>Пользовательское соглашение</a>\n"
-    if PRIVACY_URL:
-        text += f"🔒 <a href='{PRIVACY_URL}'>Политика конфиденциальности</a>\n"
-    if CHANNEL_URL:
-        text += f"📢 <a href='{CHANNEL_URL}'>Наш канал</a>\n"
+    if terms_url:
+        text += f"📄 <a href='{terms_url}'>Пользовательское соглашение</a>\n"
+    if privacy_url:
+        text += f"🔒 <a href='{privacy_url}'>Политика конфиденциальности</a>\n"
+    if channel_url:
+        text += f"📢 <a href='{channel_url}'>Наш канал</a>\n"
     
     builder = InlineKeyboardBuilder()
     
-    if TERMS_URL:
-        builder.button(text="📄 Соглашение", url=TERMS_URL)
-    if PRIVACY_URL:
-        builder.button(text="🔒 Конфиденциальность", url=PRIVACY_URL)
-    if CHANNEL_URL:
-        builder.button(text="📢 Канал", url=CHANNEL_URL)
+    if terms_url:
+        builder.button(text="📄 Соглашение", url=terms_url)
+    if privacy_url:
+        builder.button(text="🔒 Конфиденциальность", url=privacy_url)
+    if channel_url:
+        builder.button(text="📢 Канал", url=channel_url)
     
     builder.button(text="⬅️ Назад", callback_data="back_to_main_menu")
     
@@ -2812,7 +5928,7 @@ async def admin_stats_handler(callback: types.CallbackQuery):
         return
     
     try:
-        stats = db.get_stats_summary()
+        stats = await db.get_stats_summary()
         
         today_revenue = stats.get('today_revenue', 0) or 0
         total_revenue = stats.get('total_revenue', 0) or 0
@@ -2835,8 +5951,8 @@ async def admin_stats_handler(callback: types.CallbackQuery):
             f"• Платежей: {stats.get('pending_payments', 0)}\n"
             f"• Заявок на вывод: {stats.get('pending_withdrawals', 0)}\n\n"
             f"🖥️ <b>Инфраструктура:</b>\n"
-            f"• Серверов: {db.get_hosts_count()}\n"
-            f"• Тарифов: {db.get_plans_count()}"
+            f"• Серверов: {stats.get('hosts', 0)}\n"
+            f"• Тарифов: {stats.get('plans', 0)}"
         )
         
         builder = InlineKeyboardBuilder()
@@ -2860,10 +5976,10 @@ async def admin_detailed_stats_handler(callback: types.CallbackQuery):
         return
     
     try:
-        week_revenue = db.get_week_revenue()
-        month_revenue = db.get_month_revenue()
-        expiring_keys = db.get_expiring_keys(3)
-        activity_stats = db.get_user_activity_stats(7)
+        week_revenue = await db.get_week_revenue()
+        month_revenue = await db.get_month_revenue()
+        expiring_keys = await db.get_expiring_keys(3)
+        activity_stats = await db.get_user_activity_stats(7)
         
         text = (
             f"📈 <b>Подробная статистика</b>\n\n"
@@ -2879,10 +5995,8 @@ async def admin_detailed_stats_handler(callback: types.CallbackQuery):
         if expiring_keys:
             text += "\nСписок истекающих ключей:\n"
             for key in expiring_keys[:5]:
-                username = key.get('username') or key.get('full_name') or f"ID: {key['user_id']}"
-                expiry_date = datetime.fromisoformat(key['expiry_date']) if isinstance(key['expiry_date'], str) else key['expiry_date']
-                days_left = calculate_days_left(expiry_date)
-                text += f"• {username} - {key['host_name']} (осталось {days_left} д.)\n"
+                username = key.username or key.full_name or f"ID: {key.user_id}"
+                text += f"• {username} - {key.host_name} (осталось {key.days_left} д.)\n"
             
             if len(expiring_keys) > 5:
                 text += f"... и еще {len(expiring_keys) - 5} ключей\n"
@@ -2906,17 +6020,17 @@ async def admin_users_handler(callback: types.CallbackQuery):
         await callback.answer("⛔ Нет прав доступа", show_alert=True)
         return
     
-    users = db.get_all_users(20)
+    users = await db.get_recent_users_with_counts(20)
     
     text = f"👥 <b>Пользователи</b> (последние {len(users)})\n\n"
     
     builder = InlineKeyboardBuilder()
     
     for user in users:
-        user_id = user['telegram_id']
-        username = user['username'] or user['full_name'] or f"ID: {user_id}"
-        status = "🚫" if user.get('is_banned') else "✅"
-        created_at = user['created_at']
+        user_id = user.telegram_id
+        username = user.username or user.full_name or f"ID: {user_id}"
+        status = "🚫" if user.is_banned else "✅"
+        created_at = user.created_at
         if isinstance(created_at, str):
             date_str = created_at[:10]
         else:
@@ -2924,9 +6038,9 @@ async def admin_users_handler(callback: types.CallbackQuery):
         
         text += f"{status} <b>{username}</b>\n"
         text += f"   🆔 {user_id} | 📅 {date_str}\n"
-        text += f"   💰 {user['total_spent']:.0f}₽ | 🔑 {len(db.get_user_keys(user_id))}\n"
+        text += f"   💰 {user.total_spent:.0f}₽ | 🔑 {user.active_key_count}/{user.key_count} | 👥 {user.referral_count}\n"
         
-        if user.get('is_banned'):
+        if user.is_banned:
             text += "   🚫 Заблокирован\n"
         
         text += "\n"
@@ -2941,6 +6055,39 @@ async def admin_users_handler(callback: types.CallbackQuery):
     await callback.message.edit_text(text, reply_markup=builder.as_markup())
     await callback.answer()
 
+@dp.callback_query(page_callback_filter("admin_all_users"))
+async def admin_all_users_handler(callback: types.CallbackQuery):
+    """Все пользователи постранично"""
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("⛔ Нет прав доступа", show_alert=True)
+        return
+    
+    key, backward = parse_page_callback(callback.data)
+    page = await db.get_users_page(key, backward)
+    total_users = await db.get_user_count()
+    
+    text = f"📋 <b>Все пользователи</b> (всего {total_users})\n\n"
+    
+    builder = InlineKeyboardBuilder()
+    
+    for user in page.items:
+        user_id = user.telegram_id
+        username = user.username or user.full_name or f"ID: {user_id}"
+        status = "🚫" if user.is_banned else "✅"
+        
+        text += f"{status} <b>{username}</b>\n"
+        text += f"   🆔 {user_id} | 📅 {format_date_short(user.created_ts)} | 💰 {user.total_spent:.0f}₽\n"
+        text += f"   🔑 {user.active_key_count}/{user.key_count} | 👥 {user.referral_count}\n\n"
+        
+        builder.button(text=f"👤 {user_id}", callback_data=f"admin_view_user_{user_id}")
+    
+    builder.adjust(3)
+    add_page_navigation(builder, "admin_all_users", page)
+    builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_users"))
+    
+    await callback.message.edit_text(text, reply_markup=builder.as_markup())
+    await callback.answer()
+
 @dp.callback_query(F.data == "admin_search_user")
 async def admin_search_user_handler(callback: types.CallbackQuery, state: FSMContext):
     """Поиск пользователя"""
@@ -2951,7 +6098,8 @@ async def admin_search_user_handler(callback: types.CallbackQuery, state: FSMCon
     await state.set_state(Form.waiting_for_user_search)
     await callback.message.edit_text(
         "🔍 <b>Поиск пользователя</b>\n\n"
-        "Введите ID пользователя, username или имя:\n\n"
+        "Введите ID пользователя, username, имя, email или UUID ключа "
+        "(можно вставить ссылку vless:// целиком):\n\n"
         "Или нажмите кнопку для отмены:",
         parse_mode="HTML"
     )
@@ -2974,7 +6122,7 @@ async def process_user_search(message: Message, state: FSMContext):
         await message.answer("❌ Введите поисковый запрос.")
         return
     
-    users = db.search_users(query)
+    users = await db.search_users(query)
     
     if not users:
         await message.answer(f"❌ Пользователи по запросу '{query}' не найдены.")
@@ -2985,12 +6133,12 @@ async def process_user_search(message: Message, state: FSMContext):
     builder = InlineKeyboardBuilder()
     
     for user in users[:15]:
-        user_id = user['telegram_id']
-        username = user['username'] or user['full_name'] or f"ID: {user_id}"
-        status = "🚫" if user.get('is_banned') else "✅"
+        user_id = user.telegram_id
+        username = user.username or user.full_name or f"ID: {user_id}"
+        status = "🚫" if user.is_banned else "✅"
         
         text += f"{status} <b>{username}</b>\n"
-        text += f"   🆔 {user_id} | 💰 {user['total_spent']:.0f}₽\n\n"
+        text += f"   🆔 {user_id} | 💰 {user.total_spent:.0f}₽\n\n"
         
         builder.button(text=f"👤 {user_id}", callback_data=f"admin_view_user_{user_id}")
     
@@ -3012,56 +6160,43 @@ async def admin_view_user_handler(callback: types.CallbackQuery):
     
     try:
         user_id = int(callback.data.split("_")[3])
-        user_data = db.get_user(user_id)
+        user_data = await db.get_user_with_counts(user_id)
         
         if not user_data:
             await callback.answer("❌ Пользователь не найден", show_alert=True)
             return
         
-        user_keys = db.get_user_keys(user_id)
-        referrals = db.get_referrals(user_id)
-        
-        created_at = user_data['created_at']
-        if isinstance(created_at, str):
-            created_date = datetime.fromisoformat(created_at[:19]) if 'T' in created_at else datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
-        else:
-            created_date = created_at
+        user_keys = await db.get_user_keys(user_id, limit=5)
         
         text = (
             f"👤 <b>Пользователь #{user_id}</b>\n\n"
             f"📝 <b>Информация:</b>\n"
-            f"• Имя: {user_data['full_name'] or 'Не указано'}\n"
-            f"• Username: @{user_data['username'] or 'нет'}\n"
-            f"• Зарегистрирован: {created_date.strftime('%d.%m.%Y %H:%M')}\n"
-            f"• Пробный период: {'✅ Использован' if user_data.get('trial_used') else '🆓 Доступен'}\n"
-            f"• Статус: {'🚫 Заблокирован' if user_data.get('is_banned') else '✅ Активен'}\n\n"
+            f"• Имя: {user_data.full_name or 'Не указано'}\n"
+            f"• Username: @{user_data.username or 'нет'}\n"
+            f"• Зарегистрирован: {format_date(user_data.created_ts)}\n"
+            f"• Пробный период: {'✅ Использован' if user_data.trial_used else '🆓 Доступен'}\n"
+            f"• Статус: {'🚫 Заблокирован' if user_data.is_banned else '✅ Активен'}\n\n"
             f"💰 <b>Финансы:</b>\n"
-            f"• Потрачено: {user_data['total_spent']:.2f}₽\n"
-            f"• Месяцев куплено: {user_data['total_months']}\n"
+            f"• Потрачено: {user_data.total_spent:.2f}₽\n"
+            f"• Месяцев куплено: {user_data.total_months}\n"
             f"• Реферальный баланс: {user_data.get('referral_balance', 0):.2f}₽\n"
-            f"• Реферер: {'Не указан' if not user_data.get('referred_by') else f'ID: {user_data['referred_by']}'}\n"
-            f"• Рефералов: {len(referrals)}\n\n"
-            f"🔑 <b>Ключи ({len(user_keys)}):</b>\n"
+            f"• Реферер: {'Не указан' if not user_data.referred_by else f'ID: {user_data.referred_by}'}\n"
+            f"• Рефералов: {user_data.referral_count}\n\n"
+            f"🔑 <b>Ключи ({user_data.key_count}):</b>\n"
         )
         
-        now = datetime.now()
-        active_keys = 0
-        for key in user_keys[:5]:
-            expiry_date = datetime.fromisoformat(key['expiry_date']) if isinstance(key['expiry_date'], str) else key['expiry_date']
-            is_active = expiry_date > now
-            status = "✅" if is_active else "❌"
-            if is_active:
-                active_keys += 1
-            text += f"{status} {key['host_name']} до {expiry_date.strftime('%d.%m.%Y')}\n"
+        for key in user_keys:
+            status = "❌" if key.is_expired else "✅"
+            text += f"{status} {key.host_name} до {format_date_short(key.expiry_ts)}\n"
         
-        if len(user_keys) > 5:
-            text += f"... и еще {len(user_keys) - 5} ключей\n"
+        if user_data.key_count > len(user_keys):
+            text += f"... и еще {user_data.key_count - len(user_keys)} ключей\n"
         
-        text += f"\n📊 <b>Активных ключей:</b> {active_keys}"
+        text += f"\n📊 <b>Активных ключей:</b> {user_data.active_key_count}"
         
         builder = InlineKeyboardBuilder()
         
-        if user_data.get('is_banned'):
+        if user_data.is_banned:
             builder.button(text="✅ Разблокировать", callback_data=f"admin_unban_{user_id}")
         else:
             builder.button(text="🚫 Заблокировать", callback_data=f"admin_ban_{user_id}")
@@ -3087,8 +6222,8 @@ async def admin_ban_handler(callback: types.CallbackQuery):
     
     try:
         user_id = int(callback.data.split("_")[2])
-        db.ban_user(user_id)
-        db.log_admin_action(callback.from_user.id, "ban_user", f"Заблокировал пользователя {user_id}")
+        await db.ban_user(user_id)
+        await db.log_admin_action(callback.from_user.id, "ban_user", f"Заблокировал пользователя {user_id}")
         
         await callback.answer(f"✅ Пользователь {user_id} заблокирован", show_alert=True)
         await admin_view_user_handler(callback)
@@ -3106,8 +6241,8 @@ async def admin_unban_handler(callback: types.CallbackQuery):
     
     try:
         user_id = int(callback.data.split("_")[2])
-        db.unban_user(user_id)
-        db.log_admin_action(callback.from_user.id, "unban_user", f"Разблокировал пользователя {user_id}")
+        await db.unban_user(user_id)
+        await db.log_admin_action(callback.from_user.id, "unban_user", f"Разблокировал пользователя {user_id}")
         
         await callback.answer(f"✅ Пользователь {user_id} разблокирован", show_alert=True)
         await admin_view_user_handler(callback)
@@ -3125,7 +6260,7 @@ async def admin_delete_user_keys_handler(callback: types.CallbackQuery):
     
     try:
         user_id = int(callback.data.split("_")[4])
-        user_data = db.get_user(user_id)
+        user_data = await db.get_user(user_id)
         
         if not user_data:
             await callback.answer("Пользователь не найден", show_alert=True)
@@ -3137,7 +6272,7 @@ async def admin_delete_user_keys_handler(callback: types.CallbackQuery):
         
         await callback.message.edit_text(
             f"🗑️ <b>Удаление всех ключей пользователя</b>\n\n"
-            f"Вы уверены, что хотите удалить ВСЕ ключи пользователя {user_data['full_name'] or user_data['username']}?\n"
+            f"Вы уверены, что хотите удалить ВСЕ ключи пользователя {user_data.full_name or user_data.username}?\n"
             f"⚠️ Это действие нельзя отменить!\n"
             f"⚠️ Все VPN подключения пользователя перестанут работать!",
             reply_markup=builder.as_markup()
@@ -3157,26 +6292,26 @@ async def admin_confirm_delete_keys_handler(callback: types.CallbackQuery):
     
     try:
         user_id = int(callback.data.split("_")[4])
-        user_data = db.get_user(user_id)
+        user_data = await db.get_user(user_id)
         
         if not user_data:
             await callback.answer("Пользователь не найден", show_alert=True)
             return
         
-        user_keys = db.get_user_keys(user_id)
+        user_keys = await db.get_user_keys(user_id)
         deleted_count = 0
         
         for key in user_keys:
             # Удаляем из X-UI
-            host_data = db.get_host(key['host_name'])
+            host_data = await db.get_host(key.host_name)
             if host_data:
-                await xui_api.delete_client(host_data, key['xui_client_uuid'])
+                await xui_api.delete_client(host_data, key.xui_client_uuid)
             
             # Удаляем из базы
-            db.delete_key(key['key_id'])
+            await db.delete_key(key.key_id)
             deleted_count += 1
         
-        db.log_admin_action(callback.from_user.id, "delete_user_keys", 
+        await db.log_admin_action(callback.from_user.id, "delete_user_keys", 
                           f"Удалил {deleted_count} ключей пользователя {user_id}")
         
         await callback.answer(f"✅ Удалено {deleted_count} ключей", show_alert=True)
@@ -3193,21 +6328,21 @@ async def admin_hosts_handler(callback: types.CallbackQuery):
         await callback.answer("⛔ Нет прав доступа", show_alert=True)
         return
     
-    hosts = db.get_all_hosts()
+    hosts = await db.get_all_hosts()
     
     text = f"🖥️ <b>Хосты</b> ({len(hosts)})\n\n"
     
     builder = InlineKeyboardBuilder()
     
     for host in hosts:
-        plans = db.get_plans_for_host(host['host_name'])
-        text += f"🖥️ <b>{host['host_name']}</b>\n"
-        text += f"🔗 {host['host_url']}\n"
-        text += f"👤 {host['host_username']}\n"
-        text += f"🆔 Inbound: {host['host_inbound_id']}\n"
+        plans = await db.get_plans_for_host(host.host_name)
+        text += f"🖥️ <b>{host.host_name}</b>\n"
+        text += f"🔗 {host.host_url}\n"
+        text += f"👤 {host.host_username}\n"
+        text += f"🆔 Inbound: {host.host_inbound_id}\n"
         text += f"📦 Тарифов: {len(plans)}\n\n"
         
-        builder.button(text=host['host_name'], callback_data=f"admin_view_host_{host['host_name']}")
+        builder.button(text=host.host_name, callback_data=f"admin_view_host_{host.host_name}")
     
     builder.button(text="➕ Добавить хост", callback_data="admin_add_host")
     builder.button(text="🔄 Тестировать подключения", callback_data="admin_test_hosts")
@@ -3225,26 +6360,26 @@ async def admin_view_host_handler(callback: types.CallbackQuery):
         return
     
     host_name = callback.data.split("_")[3]
-    host = db.get_host(host_name)
+    host = await db.get_host(host_name)
     
     if not host:
         await callback.answer("Хост не найден", show_alert=True)
         return
     
-    plans = db.get_plans_for_host(host_name)
+    plans = await db.get_plans_for_host(host_name)
     
     text = (
         f"🖥️ <b>Хост: {host_name}</b>\n\n"
-        f"🔗 <b>URL:</b> {host['host_url']}\n"
-        f"👤 <b>Логин:</b> {host['host_username']}\n"
-        f"🔑 <b>Пароль:</b> {'*' * len(host['host_pass'])}\n"
-        f"🆔 <b>Inbound ID:</b> {host['host_inbound_id']}\n\n"
+        f"🔗 <b>URL:</b> {host.host_url}\n"
+        f"👤 <b>Логин:</b> {host.host_username}\n"
+        f"🔑 <b>Пароль:</b> {'*' * len(host.host_pass)}\n"
+        f"🆔 <b>Inbound ID:</b> {host.host_inbound_id}\n\n"
         f"📦 <b>Тарифы ({len(plans)}):</b>\n"
     )
     
     if plans:
         for plan in plans[:5]:
-            text += f"• {plan['plan_name']} - {plan['months']}м - {plan['price']}₽\n"
+            text += f"• {plan.plan_name} - {plan.months}м - {plan.price}₽\n"
         if len(plans) > 5:
             text += f"  ... и еще {len(plans) - 5}\n"
     else:
@@ -3328,8 +6463,9 @@ async def process_add_host(message: Message, state: FSMContext):
             return
         
         # Добавляем хост
-        db.add_host(host_name, host_url, host_username, host_pass, host_inbound_id)
-        db.log_admin_action(message.from_user.id, "add_host", 
+        await db.add_host(host_name, host_url, host_username, host_pass, host_inbound_id)
+        xui_api.invalidate_inbounds(host_url)
+        await db.log_admin_action(message.from_user.id, "add_host", 
                           f"Добавил хост {host_name}")
         
         await message.answer(
@@ -3356,7 +6492,7 @@ async def admin_test_host_handler(callback: types.CallbackQuery):
         return
     
     host_name = callback.data.split("_")[3]
-    host = db.get_host(host_name)
+    host = await db.get_host(host_name)
     
     if not host:
         await callback.answer("Хост не найден", show_alert=True)
@@ -3365,9 +6501,9 @@ async def admin_test_host_handler(callback: types.CallbackQuery):
     await callback.answer("🔄 Тестирую подключение...", show_alert=False)
     
     success, error = await xui_api.test_connection(
-        host['host_url'],
-        host['host_username'],
-        host['host_pass']
+        host.host_url,
+        host.host_username,
+        host.host_pass
     )
     
     if success:
@@ -3405,8 +6541,11 @@ async def admin_confirm_delete_host_handler(callback: types.CallbackQuery):
         return
     
     host_name = callback.data.split("_")[4]
-    db.delete_host(host_name)
-    db.log_admin_action(callback.from_user.id, "delete_host", 
+    host = await db.get_host(host_name)
+    await db.delete_host(host_name)
+    if host:
+        await xui_api.close_session(host.host_url)
+    await db.log_admin_action(callback.from_user.id, "delete_host", 
                       f"Удалил хост {host_name}")
     
     await callback.answer(f"✅ Хост {host_name} удален", show_alert=True)
@@ -3419,11 +6558,11 @@ async def admin_plans_handler(callback: types.CallbackQuery):
         await callback.answer("⛔ Нет прав доступа", show_alert=True)
         return
     
-    plans = db.get_all_plans()
+    plans = await db.get_all_plans()
     
     plans_by_host = {}
     for plan in plans:
-        host_name = plan['host_name']
+        host_name = plan.host_name
         if host_name not in plans_by_host:
             plans_by_host[host_name] = []
         plans_by_host[host_name].append(plan)
@@ -3435,8 +6574,8 @@ async def admin_plans_handler(callback: types.CallbackQuery):
     for host_name, host_plans in plans_by_host.items():
         text += f"🖥️ <b>{host_name}</b> ({len(host_plans)} тарифов):\n"
         for plan in host_plans[:5]:
-            price_text = f"{int(plan['price'])}₽" if plan['price'].is_integer() else f"{plan['price']:.2f}₽"
-            text += f"• {plan['plan_name']} - {plan['months']}м - {price_text}\n"
+            price_text = f"{int(plan.price)}₽" if plan.price.is_integer() else f"{plan.price:.2f}₽"
+            text += f"• {plan.plan_name} - {plan.months}м - {price_text}\n"
         
         if len(host_plans) > 5:
             text += f"  ... и еще {len(host_plans) - 5}\n"
@@ -3459,7 +6598,7 @@ async def admin_add_plan_select_handler(callback: types.CallbackQuery):
         await callback.answer("⛔ Нет прав доступа", show_alert=True)
         return
     
-    hosts = db.get_all_hosts()
+    hosts = await db.get_all_hosts()
     
     if not hosts:
         await callback.answer("❌ Нет хостов. Сначала добавьте хост.", show_alert=True)
@@ -3468,7 +6607,7 @@ async def admin_add_plan_select_handler(callback: types.CallbackQuery):
     builder = InlineKeyboardBuilder()
     
     for host in hosts:
-        builder.button(text=host['host_name'], callback_data=f"admin_add_plan_{host['host_name']}")
+        builder.button(text=host.host_name, callback_data=f"admin_add_plan_{host.host_name}")
     
     builder.button(text="⬅️ Назад", callback_data="admin_plans")
     builder.adjust(1)
@@ -3488,7 +6627,7 @@ async def admin_add_plan_handler(callback: types.CallbackQuery, state: FSMContex
         return
     
     host_name = callback.data.split("_")[3]
-    host = db.get_host(host_name)
+    host = await db.get_host(host_name)
     
     if not host:
         await callback.answer("Хост не найден", show_alert=True)
@@ -3552,8 +6691,8 @@ async def process_add_plan(message: Message, state: FSMContext):
             return
         
         # Добавляем тариф
-        db.add_plan(host_name, plan_name, months, price)
-        db.log_admin_action(message.from_user.id, "add_plan", 
+        await db.add_plan(host_name, plan_name, months, price)
+        await db.log_admin_action(message.from_user.id, "add_plan", 
                           f"Добавил тариф {plan_name} для {host_name}")
         
         await message.answer(
@@ -3571,47 +6710,36 @@ async def process_add_plan(message: Message, state: FSMContext):
     finally:
         await state.clear()
 
-@dp.callback_query(F.data == "admin_transactions")
+@dp.callback_query(page_callback_filter("admin_transactions"))
 async def admin_transactions_handler(callback: types.CallbackQuery):
     """Транзакции"""
     if callback.from_user.id != ADMIN_ID:
         await callback.answer("⛔ Нет прав доступа", show_alert=True)
         return
     
-    transactions = db.get_all_transactions(50)
+    key, backward = parse_page_callback(callback.data)
+    page = await db.get_transactions_page(key, backward)
+    total_today = await db.get_today_revenue()
     
-    text = f"💳 <b>Транзакции</b> (последние {len(transactions)})\n\n"
+    text = "💳 <b>Транзакции</b>\n\n"
     
-    total_today = 0
-    for tx in transactions:
-        created_date = tx['created_date']
-        if isinstance(created_date, str):
-            try:
-                date_str = created_date[11:16]
-            except:
-                date_str = created_date[:16]
-        else:
-            date_str = created_date.strftime('%H:%M')
+    for tx in page.items:
+        date_str = format_date(tx['created_ts'])
         
         status_icon = "✅" if tx['status'] == 'paid' else "⏳" if tx['status'] == 'pending' else "❌"
         
         text += f"{status_icon} <b>{tx['username'] or tx['full_name'] or 'Без имени'}</b>\n"
         text += f"   🕒 {date_str} | 💰 {tx['amount_rub']:.2f}₽\n"
         text += f"   💳 {tx['payment_method']}\n\n"
-        
-        if tx['status'] == 'paid':
-            tx_date = created_date[:10] if isinstance(created_date, str) else created_date.date()
-            today = datetime.now().date()
-            if str(tx_date) == str(today):
-                total_today += tx['amount_rub']
     
     text += f"\n💰 <b>Сумма сегодня:</b> {total_today:.2f}₽"
     
     builder = InlineKeyboardBuilder()
     builder.button(text="🔄 Обновить", callback_data="admin_transactions")
     builder.button(text="📈 Статистика", callback_data="admin_revenue_stats")
-    builder.button(text="⬅️ Назад", callback_data="admin_panel")
     builder.adjust(2)
+    add_page_navigation(builder, "admin_transactions", page)
+    builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_panel"))
     
     await callback.message.edit_text(text, reply_markup=builder.as_markup())
     await callback.answer()
@@ -3623,7 +6751,7 @@ async def admin_withdrawals_handler(callback: types.CallbackQuery):
         await callback.answer("⛔ Нет прав доступа", show_alert=True)
         return
     
-    withdrawals = db.get_referral_withdrawals()
+    withdrawals = await db.get_referral_withdrawals()
     
     pending_withdrawals = [w for w in withdrawals if w['status'] == 'pending']
     completed_withdrawals = [w for w in withdrawals if w['status'] == 'completed']
@@ -3665,7 +6793,7 @@ async def admin_pending_withdrawals_handler(callback: types.CallbackQuery):
         await callback.answer("⛔ Нет прав доступа", show_alert=True)
         return
     
-    withdrawals = db.get_referral_withdrawals('pending')
+    withdrawals = await db.get_referral_withdrawals('pending')
     
     if not withdrawals:
         await callback.answer("❌ Нет ожидающих заявок", show_alert=True)
@@ -3702,13 +6830,7 @@ async def admin_view_withdrawal_handler(callback: types.CallbackQuery):
     
     try:
         withdrawal_id = int(callback.data.split("_")[3])
-        withdrawals = db.get_referral_withdrawals()
-        
-        withdrawal = None
-        for w in withdrawals:
-            if w['withdrawal_id'] == withdrawal_id:
-                withdrawal = w
-                break
+        withdrawal = await db.get_withdrawal(withdrawal_id)
         
         if not withdrawal:
             await callback.answer("Заявка не найдена", show_alert=True)
@@ -3758,18 +6880,18 @@ async def admin_approve_withdrawal_handler(callback: types.CallbackQuery):
     try:
         withdrawal_id = int(callback.data.split("_")[3])
         
-        # Обновляем статус
-        db.update_withdrawal_status(withdrawal_id, 'completed', 'Заявка одобрена администратором')
-        db.log_admin_action(callback.from_user.id, "approve_withdrawal", 
+        # Статус меняется только из pending, поэтому повторное нажатие не одобрит заявку дважды
+        if not await db.transition_withdrawal(withdrawal_id, 'pending', 'completed',
+                                              'Заявка одобрена администратором'):
+            await callback.answer("Заявка уже обработана", show_alert=True)
+            await admin_view_withdrawal_handler(callback)
+            return
+        
+        await db.log_admin_action(callback.from_user.id, "approve_withdrawal", 
                           f"Одобрил вывод #{withdrawal_id}")
         
         # Получаем данные заявки для уведомления пользователя
-        withdrawals = db.get_referral_withdrawals()
-        withdrawal = None
-        for w in withdrawals:
-            if w['withdrawal_id'] == withdrawal_id:
-                withdrawal = w
-                break
+        withdrawal = await db.get_withdrawal(withdrawal_id)
         
         if withdrawal:
             try:
@@ -3799,7 +6921,14 @@ async def admin_reject_withdrawal_handler(callback: types.CallbackQuery, state:
     
     try:
         withdrawal_id = int(callback.data.split("_")[3])
+        withdrawal = await db.get_withdrawal(withdrawal_id)
+        
+        if not withdrawal or withdrawal['status'] != 'pending':
+            await callback.answer("Заявка уже обработана", show_alert=True)
+            return
+        
         await state.update_data(withdrawal_id=withdrawal_id)
+        await state.set_state(Form.waiting_for_withdrawal_reject_reason)
         
         await callback.message.edit_text(
             f"❌ <b>Отклонение заявки #{withdrawal_id}</b>\n\n"
@@ -3817,7 +6946,7 @@ async def admin_reject_withdrawal_handler(callback: types.CallbackQuery, state:
         logger.error(f"Error starting reject withdrawal: {e}")
         await callback.answer("Ошибка", show_alert=True)
 
-@dp.message(StateFilter(Form.waiting_for_settings))
+@dp.message(StateFilter(Form.waiting_for_withdrawal_reject_reason))
 async def process_reject_withdrawal_reason(message: Message, state: FSMContext):
     """Обработка причины отклонения заявки"""
     if message.from_user.id != ADMIN_ID:
@@ -3839,35 +6968,30 @@ async def process_reject_withdrawal_reason(message: Message, state: FSMContext):
             return
         
         # Обновляем статус и возвращаем средства
-        withdrawals = db.get_referral_withdrawals()
-        withdrawal = None
-        for w in withdrawals:
-            if w['withdrawal_id'] == withdrawal_id:
-                withdrawal = w
-                break
+        withdrawal = await db.reject_withdrawal(withdrawal_id, f"Отклонено: {reason}")
         
-        if withdrawal:
-            # Возвращаем средства на баланс
-            db.add_referral_balance(withdrawal['user_id'], withdrawal['amount'])
-            
-            # Обновляем статус заявки
-            db.update_withdrawal_status(withdrawal_id, 'rejected', f"Отклонено: {reason}")
-            
-            db.log_admin_action(message.from_user.id, "reject_withdrawal", 
-                              f"Отклонил вывод #{withdrawal_id}: {reason}")
-            
-            # Уведомляем пользователя
-            try:
-                user_text = (
-                    f"❌ <b>Ваша заявка на вывод #{withdrawal_id} отклонена</b>\n\n"
-                    f"💰 <b>Сумма:</b> {withdrawal['amount']:.2f}₽\n"
-                    f"📅 <b>Дата:</b> {datetime.now().strftime('%d.%m.%Y %H:%M')}\n"
-                    f"📝 <b>Причина:</b> {reason}\n\n"
-                    f"Средства возвращены на ваш реферальный баланс."
-                )
-                await bot.send_message(withdrawal['user_id'], user_text)
-            except:
-                pass
+        if not withdrawal:
+            await message.answer(
+                f"❌ Заявка #{withdrawal_id} уже обработана",
+                reply_markup=create_back_button("admin_withdrawals")
+            )
+            return
+        
+        await db.log_admin_action(message.from_user.id, "reject_withdrawal", 
+                          f"Отклонил вывод #{withdrawal_id}: {reason}")
+        
+        # Уведомляем пользователя
+        try:
+            user_text = (
+                f"❌ <b>Ваша заявка на вывод #{withdrawal_id} отклонена</b>\n\n"
+                f"💰 <b>Сумма:</b> {withdrawal['amount']:.2f}₽\n"
+                f"📅 <b>Дата:</b> {datetime.now().strftime('%d.%m.%Y %H:%M')}\n"
+                f"📝 <b>Причина:</b> {reason}\n\n"
+                f"Средства возвращены на ваш реферальный баланс."
+            )
+            await bot.send_message(withdrawal['user_id'], user_text)
+        except:
+            pass
         
         await message.answer(
             f"✅ <b>Заявка #{withdrawal_id} отклонена</b>\n\n"
@@ -3889,7 +7013,7 @@ async def admin_support_handler(callback: types.CallbackQuery):
         await callback.answer("⛔ Нет прав доступа", show_alert=True)
         return
     
-    messages = db.get_support_messages('open', 10)
+    messages = await db.get_support_messages('open', 10)
     
     text = f"💬 <b>Сообщения в поддержку</b> (открытых: {len(messages)})\n\n"
     
@@ -3927,8 +7051,8 @@ async def admin_crypto_payments_handler(callback: types.CallbackQuery):
         await callback.answer("⛔ Нет прав доступа", show_alert=True)
         return
     
-    pending_payments = db.get_payments_by_status('pending', 10)
-    paid_payments = db.get_payments_by_status('paid', 10)
+    pending_payments = await db.get_payments_by_status('pending', 10)
+    paid_payments = await db.get_payments_by_status('paid', 10)
     
     text = (
         f"🤖 <b>Платежи CryptoBot</b>\n\n"
@@ -3939,14 +7063,14 @@ async def admin_crypto_payments_handler(callback: types.CallbackQuery):
     if pending_payments:
         text += "<b>Последние ожидающие:</b>\n"
         for payment in pending_payments[:3]:
-            created_at = payment['created_at']
+            created_at = payment.created_at
             if isinstance(created_at, str):
                 date_str = created_at[11:16]
             else:
                 date_str = created_at.strftime('%H:%M')
             
-            text += f"• {payment['username']} - {payment['amount']} {payment['asset']}\n"
-            text += f"  {payment['plan_name']} | {date_str}\n\n"
+            text += f"• {payment.username} - {payment.amount} {payment.asset}\n"
+            text += f"  {payment.plan_name} | {date_str}\n\n"
     
     builder = InlineKeyboardBuilder()
     
@@ -3961,6 +7085,43 @@ async def admin_crypto_payments_handler(callback: types.CallbackQuery):
     await callback.message.edit_text(text, reply_markup=builder.as_markup())
     await callback.answer()
 
+async def show_payments_page(callback: types.CallbackQuery, status: str, prefix: str, title: str):
+    """Страница платежей CryptoBot с заданным статусом"""
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("⛔ Нет прав доступа", show_alert=True)
+        return
+    
+    key, backward = parse_page_callback(callback.data)
+    page = await db.get_payments_page(status, key, backward)
+    
+    text = f"{title}\n\n"
+    
+    if not page.items:
+        text += "Платежей нет."
+    
+    for payment in page.items:
+        username = payment.username or payment.full_name or f"ID: {payment.user_id}"
+        text += f"• {username} - {payment.amount} {payment.asset}\n"
+        text += f"  {payment.plan_name or 'Тариф удален'} | {format_date(payment.created_ts)}\n"
+        text += f"  <code>{payment.invoice_id}</code>\n\n"
+    
+    builder = InlineKeyboardBuilder()
+    add_page_navigation(builder, prefix, page)
+    builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_crypto_payments"))
+    
+    await callback.message.edit_text(text, reply_markup=builder.as_markup())
+    await callback.answer()
+
+@dp.callback_query(page_callback_filter("admin_pending_crypto_payments"))
+async def admin_pending_crypto_payments_handler(callback: types.CallbackQuery):
+    """Ожидающие платежи CryptoBot"""
+    await show_payments_page(callback, 'pending', "admin_pending_crypto_payments", "⏳ <b>Ожидающие платежи</b>")
+
+@dp.callback_query(page_callback_filter("admin_paid_crypto_payments"))
+async def admin_paid_crypto_payments_handler(callback: types.CallbackQuery):
+    """Оплаченные платежи CryptoBot"""
+    await show_payments_page(callback, 'paid', "admin_paid_crypto_payments", "✅ <b>Оплаченные платежи</b>")
+
 @dp.callback_query(F.data == "admin_check_all_payments")
 async def admin_check_all_payments_handler(callback: types.CallbackQuery):
     """Проверка всех платежей"""
@@ -3971,12 +7132,12 @@ async def admin_check_all_payments_handler(callback: types.CallbackQuery):
     await callback.answer("🔄 Начинаю проверку всех платежей...", show_alert=False)
     
     try:
-        pending_payments = db.get_pending_payments()
+        pending_payments = await db.get_pending_payments()
         checked = 0
         paid = 0
         
         for payment in pending_payments:
-            invoice_id = payment['invoice_id']
+            invoice_id = payment.invoice_id
             
             # Проверяем статус в CryptoBot
             result = await crypto_bot.get_invoices(invoice_ids=[invoice_id])
@@ -3985,7 +7146,7 @@ async def admin_check_all_payments_handler(callback: types.CallbackQuery):
                 invoices = result.get('invoices', [])
                 if invoices and invoices[0]['status'] == 'paid':
                     # Обновляем статус
-                    db.update_crypto_payment_status(invoice_id, 'paid')
+                    await db.update_crypto_payment_status(invoice_id, 'paid')
                     paid += 1
             
             checked += 1
@@ -4041,7 +7202,7 @@ async def process_broadcast(message: Message, state: FSMContext):
             return
         
         # Получаем всех пользователей
-        users = db.get_all_users()
+        users = await db.get_all_users()
         total_users = len(users)
         
         if total_users == 0:
@@ -4050,7 +7211,7 @@ async def process_broadcast(message: Message, state: FSMContext):
             return
         
         # Создаем запись о рассылке
-        broadcast_id = db.create_broadcast(message.from_user.id, broadcast_text, total_users)
+        broadcast_id = await db.create_broadcast(message.from_user.id, broadcast_text, total_users)
         
         await message.answer(
             f"📢 <b>Начинаю рассылку</b>\n\n"
@@ -4069,7 +7230,7 @@ async def process_broadcast(message: Message, state: FSMContext):
     finally:
         await state.clear()
 
-async def send_broadcast(broadcast_id: int, message_text: str, users: List[Dict]):
+async def send_broadcast(broadcast_id: int, message_text: str, users: List[UserRow]):
     """Асинхронная рассылка сообщений"""
     sent = 0
     failed = 0
@@ -4077,16 +7238,16 @@ async def send_broadcast(broadcast_id: int, message_text: str, users: List[Dict]
     for user in users:
         try:
             # Пропускаем заблокированных пользователей
-            if user.get('is_banned'):
+            if user.is_banned:
                 failed += 1
                 continue
             
-            await bot.send_message(user['telegram_id'], message_text, parse_mode="HTML")
+            await bot.send_message(user.telegram_id, message_text, parse_mode="HTML")
             sent += 1
             
             # Обновляем статистику каждые 10 отправок
             if (sent + failed) % 10 == 0:
-                db.update_broadcast_stats(broadcast_id, sent, failed, 'sending')
+                await db.update_broadcast_stats(broadcast_id, sent, failed, 'sending')
                 sent = 0
                 failed = 0
             
@@ -4094,11 +7255,11 @@ async def send_broadcast(broadcast_id: int, message_text: str, users: List[Dict]
             await asyncio.sleep(0.1)
             
         except Exception as e:
-            logger.error(f"Error sending broadcast to user {user['telegram_id']}: {e}")
+            logger.error(f"Error sending broadcast to user {user.telegram_id}: {e}")
             failed += 1
     
     # Финальное обновление статистики
-    db.update_broadcast_stats(broadcast_id, sent, failed, 'completed')
+    await db.update_broadcast_stats(broadcast_id, sent, failed, 'completed')
     
     # Уведомляем админа
     try:
@@ -4120,7 +7281,7 @@ async def admin_settings_handler(callback: types.CallbackQuery):
         await callback.answer("⛔ Нет прав доступа", show_alert=True)
         return
     
-    settings = db.get_all_settings()
+    settings = await db.get_all_settings()
     
     text = "⚙️ <b>Настройки бота</b>\n\n"
     
@@ -4168,7 +7329,7 @@ async def admin_edit_settings_handler(callback: types.CallbackQuery):
         await callback.answer("⛔ Нет прав доступа", show_alert=True)
         return
     
-    settings = db.get_all_settings()
+    settings = await db.get_all_settings()
     
     text = "✏️ <b>Редактирование настроек</b>\n\n"
     text += "Выберите настройку для редактирования:\n\n"
@@ -4205,8 +7366,8 @@ async def admin_edit_setting_handler(callback: types.CallbackQuery, state: FSMCo
         await callback.answer("⛔ Нет прав доступа", show_alert=True)
         return
     
-    setting_key = callback.data.split("_")[3]
-    current_value = db.get_setting(setting_key, "")
+    setting_key = callback.data[len("admin_edit_setting_"):]
+    current_value = await db.get_setting(setting_key, "")
     
     await state.set_state(Form.waiting_for_edit_setting)
     await state.update_data(setting_key=setting_key)
@@ -4242,6 +7403,12 @@ async def process_edit_setting(message: Message, state: FSMContext):
                 await message.answer("❌ ID администратора должен быть числом")
                 return
         
+        elif setting_key in ['trial_enabled', 'enable_referrals']:
+            new_value = new_value.lower()
+            if new_value not in ('true', 'false'):
+                await message.answer("❌ Значение должно быть true или false")
+                return
+        
         elif setting_key == 'trial_duration_days':
             try:
                 days = int(new_value)
@@ -4270,8 +7437,8 @@ async def process_edit_setting(message: Message, state: FSMContext):
                 return
         
         # Обновляем настройку
-        db.update_setting(setting_key, new_value)
-        db.log_admin_action(message.from_user.id, "update_setting", 
+        await db.update_setting(setting_key, new_value)
+        await db.log_admin_action(message.from_user.id, "update_setting", 
                           f"Обновил настройку {setting_key}: {new_value}")
         
         await message.answer(
@@ -4287,23 +7454,20 @@ async def process_edit_setting(message: Message, state: FSMContext):
     finally:
         await state.clear()
 
-@dp.callback_query(F.data == "admin_logs")
+@dp.callback_query(page_callback_filter("admin_logs"))
 async def admin_logs_handler(callback: types.CallbackQuery):
     """Логи административных действий"""
     if callback.from_user.id != ADMIN_ID:
         await callback.answer("⛔ Нет прав доступа", show_alert=True)
         return
     
-    logs = db.get_admin_logs(50)
+    key, backward = parse_page_callback(callback.data)
+    page = await db.get_admin_logs_page(key, backward)
     
-    text = f"📋 <b>Логи административных действий</b> (последние {len(logs)})\n\n"
+    text = "📋 <b>Логи административных действий</b>\n\n"
     
-    for log in logs[:10]:
-        created_at = log['created_at']
-        if isinstance(created_at, str):
-            time_str = created_at[11:16]
-        else:
-            time_str = created_at.strftime('%H:%M')
+    for log in page.items:
+        time_str = format_date(log['created_at'])
         
         username = log['username'] or log['full_name'] or f"ID: {log['admin_id']}"
         action = log['action']
@@ -4312,14 +7476,12 @@ async def admin_logs_handler(callback: types.CallbackQuery):
         text += f"🕒 {time_str} - {username}\n"
         text += f"📝 {action}: {details}\n\n"
     
-    if len(logs) > 10:
-        text += f"... и еще {len(logs) - 10} записей\n"
-    
     builder = InlineKeyboardBuilder()
     builder.button(text="🔄 Обновить", callback_data="admin_logs")
     builder.button(text="🗑️ Очистить логи", callback_data="admin_clear_logs")
-    builder.button(text="⬅️ Назад", callback_data="admin_panel")
     builder.adjust(2)
+    add_page_navigation(builder, "admin_logs", page)
+    builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_panel"))
     
     await callback.message.edit_text(text, reply_markup=builder.as_markup())
     await callback.answer()
@@ -4351,12 +7513,9 @@ async def admin_confirm_clear_logs_handler(callback: types.CallbackQuery):
         return
     
     try:
-        with db._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM admin_logs")
-            cursor.execute("VACUUM")
+        await db.clear_admin_logs()
         
-        db.log_admin_action(callback.from_user.id, "clear_logs", "Очистил логи")
+        await db.log_admin_action(callback.from_user.id, "clear_logs", "Очистил логи")
         
         await callback.answer("✅ Логи очищены", show_alert=True)
         await admin_logs_handler(callback)
@@ -4366,14 +7525,25 @@ async def admin_confirm_clear_logs_handler(callback: types.CallbackQuery):
         await callback.answer("❌ Ошибка при очистке логов", show_alert=True)
 
 # === ПЕРИОДИЧЕСКИЕ ЗАДАЧИ ===
+def payment_retry_due(payment: PaymentRow, now: float) -> bool:
+    """Пора ли фоновой проверке снова забрать платеж. Попытки и время следующей
+    хранятся в metadata и записываются process_successful_payment"""
+    if payment.status != 'error':
+        return True
+    retry = (payment.metadata or {}).get('retry', {})
+    return retry.get('attempts', 0) < PAYMENT_RETRY_LIMIT and retry.get('next_ts', 0) <= now
+
 async def check_pending_payments():
-    """Периодическая проверка pending платежей"""
+    """Периодическая проверка pending платежей и повтор выдачи ключа по платежам в статусе 'error'"""
     while True:
         try:
-            payments = db.get_pending_payments()
+            payments = await db.get_pending_payments(include_errors=True)
+            now = time.time()
             
             for payment in payments:
-                invoice_id = payment['invoice_id']
+                invoice_id = payment.invoice_id
+                if not payment_retry_due(payment, now):
+                    continue
                 
                 # Проверяем статус в CryptoBot
                 result = await crypto_bot.get_invoices(invoice_ids=[invoice_id])
@@ -4382,9 +7552,6 @@ async def check_pending_payments():
                     invoices = result.get('invoices', [])
                     
                     if invoices and invoices[0]['status'] == 'paid':
-                        # Обновляем статус
-                        db.update_crypto_payment_status(invoice_id, 'paid')
-                        
                         # Обрабатываем успешный платеж
                         await process_successful_payment(payment)
             
@@ -4395,43 +7562,150 @@ async def check_pending_payments():
             logger.error(f"Error in check_pending_payments: {e}")
             await asyncio.sleep(60)
 
-async def process_successful_payment(payment_data: Dict):
-    """Обработка успешного платежа"""
+async def provision_payment_key(payment_data: PaymentRow, plan: PlanRow, host_data: HostRow) -> Dict:
+    """Клиент X-UI для оплаченного счета. Созданный клиент запоминается в платеже до записи
+    ключа, поэтому повторная обработка (после ошибки или перезапуска) берет его, а не создает второй"""
+    # Метаданные перечитываются после claim: прошлая попытка могла записать клиента уже после
+    # того, как вызывающий прочитал платеж
+    current = await db.get_crypto_payment(payment_data.invoice_id)
+    metadata = current.metadata if current else payment_data.metadata
+    client = metadata.get('xui_client')
+    if client and client['host_name'] == host_data.host_name:
+        connection_string = await xui_api.get_connection_string(host_data, client['client_uuid'], client['email'])
+        return {
+            "success": True,
+            "client_uuid": client['client_uuid'],
+            "email": client['email'],
+            "expiry_date": datetime.fromtimestamp(client['expiry_ts']),
+            "connection_string": connection_string,
+            "host_name": host_data.host_name
+        }
+    
+    email = f"user{payment_data.user_id}-{plan.plan_id}@{host_data.host_name.replace(' ', '').lower()}.vpn"
+    result = await xui_api.create_client(
+        host_data,
+        email,
+        plan.months * 30  # Переводим месяцы в дни
+    )
+    if result.get('error'):
+        return result
+    
+    metadata = dict(metadata, xui_client={
+        'host_name': host_data.host_name,
+        'client_uuid': result['client_uuid'],
+        'email': email,
+        'expiry_ts': int(result['expiry_date'].timestamp())
+    })
+    try:
+        await db.update_crypto_payment_metadata(payment_data.invoice_id, metadata)
+    except Exception as e:
+        # Без записи в платеже клиент потерялся бы: повтор создал бы второй
+        logger.error(f"Error saving X-UI client for payment {payment_data.invoice_id}: {e}")
+        await xui_api.delete_client(host_data, result['client_uuid'])
+        return {"error": "Payment update failed"}
+    return result
+
+async def fulfill_payment_key(payment_data: PaymentRow, plan: PlanRow, host_data: HostRow, result: Dict) -> Optional[int]:
+    """Запись ключа по оплаченному счету. При ошибке платеж помечается 'error', чтобы
+    повторная проверка забрала его снова с тем же клиентом X-UI; возвращает None"""
     try:
-        user_id = payment_data['user_id']
-        plan_id = payment_data['plan_id']
-        plan = db.get_plan_by_id(plan_id)
+        return await db.fulfill_crypto_payment(
+            payment_data.invoice_id,
+            host_data.host_name,
+            result['client_uuid'],
+            result['email'],
+            result['expiry_date'],
+            months=plan.months,
+            price_rub=payment_data.metadata.get('price_rub', 0),
+            referral_percentage=bot_settings.referral_percentage if bot_settings.enable_referrals else 0
+        )
+    except Exception as e:
+        logger.error(f"Error saving key for payment {payment_data.invoice_id}: {e}")
+        try:
+            await db.update_crypto_payment_status(payment_data.invoice_id, 'error')
+        except Exception as e:
+            logger.error(f"Error marking payment {payment_data.invoice_id} failed: {e}")
+        return None
+
+async def record_payment_retry(payment_data: PaymentRow) -> int:
+    """Записывает в платеж очередную попытку повтора и время следующей; платеж должен быть
+    забран claim_crypto_payment, иначе запись перетрет metadata другой обработки. Возвращает номер попытки"""
+    current = await db.get_crypto_payment(payment_data.invoice_id)
+    metadata = dict(current.metadata if current else payment_data.metadata)
+    attempts = metadata.get('retry', {}).get('attempts', 0) + 1
+    metadata['retry'] = {
+        'attempts': attempts,
+        'next_ts': int(time.time()) + PAYMENT_RETRY_DELAY_SEC * 2 ** (attempts - 1)
+    }
+    await db.update_crypto_payment_metadata(payment_data.invoice_id, metadata)
+    return attempts
+
+async def notify_payment_retries_exhausted(payment_data: PaymentRow):
+    """Сообщает админу о платеже, по которому фоновая проверка больше не будет выдавать ключ"""
+    current = await db.get_crypto_payment(payment_data.invoice_id)
+    if not current or current.status != 'error':
+        return
+    try:
+        await bot.send_message(
+            ADMIN_ID,
+            f"⚠️ <b>Ключ по оплаченному счету не выдан</b>\n\n"
+            f"💰 <b>Платеж:</b> {payment_data.invoice_id}\n"
+            f"👤 <b>Пользователь:</b> {payment_data.username} (ID: {payment_data.user_id})\n"
+            f"🔁 <b>Повторов:</b> {PAYMENT_RETRY_LIMIT}, автоматические повторы остановлены. "
+            f"Пользователь может повторить проверку оплаты сам",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"Error notifying admin about payment {payment_data.invoice_id}: {e}")
+
+async def process_successful_payment(payment_data: PaymentRow):
+    """Обработка успешного платежа. Платеж в статусе 'error' повторяется с учетом попыток:
+    после последней неудачной админ получает уведомление"""
+    try:
+        if not await db.claim_crypto_payment(payment_data.invoice_id):
+            return
+        
+        attempt = await record_payment_retry(payment_data) if payment_data.status == 'error' else 0
+        await process_claimed_payment(payment_data)
+        if attempt >= PAYMENT_RETRY_LIMIT:
+            await notify_payment_retries_exhausted(payment_data)
+    except Exception as e:
+        logger.error(f"Error processing payment: {e}")
+
+async def process_claimed_payment(payment_data: PaymentRow):
+    """Выдача ключа по оплаченному и уже забранному в обработку счету"""
+    try:
+        user_id = payment_data.user_id
+        plan_id = payment_data.plan_id
+        plan = await db.get_plan_by_id(plan_id)
         
         if not plan:
-            logger.error(f"Plan {plan_id} not found for payment {payment_data['invoice_id']}")
+            logger.error(f"Plan {plan_id} not found for payment {payment_data.invoice_id}")
+            await db.update_crypto_payment_status(payment_data.invoice_id, 'error')
             return
         
-        host_data = db.get_host(plan['host_name'])
+        host_data = await db.get_host(plan.host_name)
         if not host_data:
-            logger.error(f"Host {plan['host_name']} not found for payment {payment_data['invoice_id']}")
+            logger.error(f"Host {plan.host_name} not found for payment {payment_data.invoice_id}")
+            await db.update_crypto_payment_status(payment_data.invoice_id, 'error')
             return
         
-        # Создаем ключ
-        email = f"user{user_id}-{plan_id}@{host_data['host_name'].replace(' ', '').lower()}.vpn"
-        
-        result = await xui_api.create_client(
-            host_data,
-            email,
-            plan['months'] * 30
-        )
+        # Создаем ключ (или берем созданный при прошлой попытке)
+        result = await provision_payment_key(payment_data, plan, host_data)
         
         if result.get('error'):
-            logger.error(f"Error creating key for payment {payment_data['invoice_id']}: {result['error']}")
+            logger.error(f"Error creating key for payment {payment_data.invoice_id}: {result['error']}")
+            await db.update_crypto_payment_status(payment_data.invoice_id, 'error')
             
             # Уведомляем админа об ошибке
             try:
                 await bot.send_message(
                     ADMIN_ID,
                     f"❌ <b>Ошибка создания ключа</b>\n\n"
-                    f"💰 <b>Платеж:</b> {payment_data['invoice_id']}\n"
-                    f"👤 <b>Пользователь:</b> {payment_data['username']} (ID: {user_id})\n"
-                    f"📦 <b>План:</b> {plan['plan_name']}\n"
-                    f"🖥️ <b>Сервер:</b> {plan['host_name']}\n"
+                    f"💰 <b>Платеж:</b> {payment_data.invoice_id}\n"
+                    f"👤 <b>Пользователь:</b> {payment_data.username} (ID: {user_id})\n"
+                    f"📦 <b>План:</b> {plan.plan_name}\n"
+                    f"🖥️ <b>Сервер:</b> {plan.host_name}\n"
                     f"❌ <b>Ошибка:</b> {result['error'][:200]}",
                     parse_mode="HTML"
                 )
@@ -4440,52 +7714,10 @@ async def process_successful_payment(payment_data: Dict):
             
             return
         
-        # Сохраняем ключ
-        key_id = db.add_key(
-            user_id,
-            host_data['host_name'],
-            result['client_uuid'],
-            email,
-            result['expiry_date']
-        )
-        
-        # Обновляем статистику
-        metadata = json.loads(payment_data['metadata'])
-        price_rub = metadata.get('price_rub', 0)
-        
-        db.update_user_stats(user_id, price_rub, plan['months'])
-        
-        # Логируем транзакцию
-        user_data = db.get_user(user_id)
-        db.log_transaction(
-            username=user_data.get('username') or user_data.get('full_name'),
-            user_id=user_id,
-            status='paid',
-            amount_rub=price_rub,
-            payment_method='CryptoBot',
-            metadata={
-                'plan_id': plan_id,
-                'key_id': key_id,
-                'invoice_id': payment_data['invoice_id']
-            }
-        )
-        
-        # Начисляем реферальный бонус
-        if ENABLE_REFERRALS and user_data and user_data.get('referred_by'):
-            referrer_id = user_data['referred_by']
-            bonus_amount = price_rub * (REFERRAL_PERCENTAGE / 100)
-            db.add_referral_balance(referrer_id, bonus_amount)
-        
-        # Обновляем payment с key_id
-        db.create_crypto_payment(
-            invoice_id=payment_data['invoice_id'],
-            user_id=user_id,
-            plan_id=plan_id,
-            amount=payment_data['amount'],
-            asset=payment_data['asset'],
-            metadata=metadata,
-            key_id=key_id
-        )
+        # Ключ, статистика, транзакция и бонус реферера - одной транзакцией
+        key_id = await fulfill_payment_key(payment_data, plan, host_data, result)
+        if key_id is None:
+            return
         
         # Отправляем ключ пользователю
         expiry_date = result['expiry_date']
@@ -4494,9 +7726,9 @@ async def process_successful_payment(payment_data: Dict):
         success_text = (
             f"🎉 <b>Оплата подтверждена!</b>\n\n"
             f"✅ <b>Ваш VPN ключ создан:</b>\n"
-            f"🖥️ <b>Сервер:</b> {host_data['host_name']}\n"
+            f"🖥️ <b>Сервер:</b> {host_data.host_name}\n"
             f"📅 <b>Действует до:</b> {expiry_formatted}\n"
-            f"📅 <b>Срок:</b> {plan['months']} месяцев\n\n"
+            f"📅 <b>Срок:</b> {plan.months} месяцев\n\n"
             f"<code>{result['connection_string']}</code>"
         )
         
@@ -4517,7 +7749,7 @@ async def process_successful_payment(payment_data: Dict):
                     f"📩 <b>Не удалось отправить ключ пользователю</b>\n\n"
                     f"👤 <b>Пользователь:</b> ID: {user_id}\n"
                     f"🔑 <b>Ключ:</b> #{key_id}\n"
-                    f"🖥️ <b>Сервер:</b> {host_data['host_name']}\n"
+                    f"🖥️ <b>Сервер:</b> {host_data.host_name}\n"
                     f"📅 <b>Срок:</b> до {expiry_formatted}\n\n"
                     f"<code>{result['connection_string']}</code>",
                     parse_mode="HTML"
@@ -4533,20 +7765,17 @@ async def check_expiring_keys():
     while True:
         try:
             # Ключи которые истекут в ближайшие 3 дня
-            expiring_keys = db.get_expiring_keys(3)
+            expiring_keys = await db.get_expiring_keys(3)
             
             for key in expiring_keys:
-                expiry_date = datetime.fromisoformat(key['expiry_date']) if isinstance(key['expiry_date'], str) else key['expiry_date']
-                days_left = calculate_days_left(expiry_date)
-                
                 # Отправляем напоминание за 1 день до истечения
-                if days_left == 1:
+                if key.days_left == 1:
                     try:
                         reminder_text = (
                             f"⏰ <b>Напоминание!</b>\n\n"
                             f"Ваш ключ VPN истекает через <b>1 день</b>!\n"
-                            f"🖥️ <b>Сервер:</b> {key['host_name']}\n"
-                            f"📅 <b>Истекает:</b> {expiry_date.strftime('%d.%m.%Y %H:%M')}\n\n"
+                            f"🖥️ <b>Сервер:</b> {key.host_name}\n"
+                            f"📅 <b>Истекает:</b> {format_date(key.expiry_ts)}\n\n"
                             f"Чтобы продолжить использование, продлите или купите новый ключ."
                         )
                         
@@ -4555,7 +7784,7 @@ async def check_expiring_keys():
                         builder.button(text="🔑 Мои ключи", callback_data="manage_keys")
                         builder.adjust(1)
                         
-                        await bot.send_message(key['user_id'], reminder_text, reply_markup=builder.as_markup())
+                        await bot.send_message(key.user_id, reminder_text, reply_markup=builder.as_markup())
                     except:
                         pass
             
@@ -4566,6 +7795,51 @@ async def check_expiring_keys():
             logger.error(f"Error checking expiring keys: {e}")
             await asyncio.sleep(60 * 60)  # 1 час при ошибке
 
+async def run_database_maintenance():
+    """Перенос старых строк в архив и возврат освободившегося места небольшими шагами"""
+    while True:
+        try:
+            for table in RETENTION_POLICIES:
+                archived = 0
+                while moved := await db.archive_batch(table):
+                    archived += moved
+                    # Между пачками отпускаем блокировку записи для обработчиков
+                    await asyncio.sleep(0.1)
+                if archived:
+                    logger.info(f"Перенесено в архив из {table}: {archived}")
+            
+            while await db.incremental_vacuum():
+                await asyncio.sleep(0.1)
+            
+            await asyncio.sleep(DB_MAINTENANCE_INTERVAL_SEC)
+            
+        except Exception as e:
+            logger.error(f"Error in database maintenance: {e}")
+            await asyncio.sleep(60 * 60)  # 1 час при ошибке
+
+backup_lock = asyncio.Lock()
+
+async def run_backup() -> str:
+    """Резервная копия в отдельном потоке; одновременно выполняется только одна"""
+    async with backup_lock:
+        started = time.perf_counter()
+        backup_path = await asyncio.to_thread(create_backup)
+        logger.info(
+            f"Резервная копия базы: {backup_path} "
+            f"({backup_size(backup_path) / 1024 / 1024:.1f} МБ, {time.perf_counter() - started:.0f} с)"
+        )
+        return backup_path
+
+async def run_database_backups():
+    """Периодическое резервное копирование SQLite"""
+    while True:
+        try:
+            await run_backup()
+            await asyncio.sleep(DB_BACKUP_INTERVAL_SEC)
+        except Exception as e:
+            logger.error(f"Error in database backup: {e}")
+            await asyncio.sleep(60 * 60)  # 1 час при ошибке
+
 # === ЗАПУСК БОТА ===
 async def main():
     """Основная функция запуска бота"""
@@ -4576,20 +7850,31 @@ async def main():
     print("🚀 Запуск VLESS Telegram Bot v8.0...")
     
     try:
+        await db.connect()
         bot_info = await bot.get_me()
         print(f"✅ Бот запущен: @{bot_info.username}")
         print(f"👑 Админ ID: {ADMIN_ID}")
-        print(f"🗄️  База данных: vless_bot.db")
+        print(f"🗄️  База данных: {DB_PATH if DB_BACKEND == 'sqlite' else 'PostgreSQL'}")
         print(f"🤖 CryptoBot: {'✅ Подключен' if crypto_bot else '❌ Не настроен'}")
-        print(f"🖥️  X-UI хостов: {db.get_hosts_count()}")
-        print(f"📦  Тарифов: {db.get_plans_count()}")
-        print(f"👥  Пользователей: {db.get_user_count()}")
+        hosts_count = await db.get_hosts_count()
+        plans_count = await db.get_plans_count()
+        users_count = await db.get_user_count()
+        print(f"🖥️  X-UI хостов: {hosts_count}")
+        print(f"📦  Тарифов: {plans_count}")
+        print(f"👥  Пользователей: {users_count}")
+        
+        released = await db.release_interrupted_crypto_payments()
+        if released:
+            logger.warning(f"Возвращено в очередь прерванных платежей: {released}")
         
         # Запускаем периодические задачи в фоне
         if crypto_bot:
             asyncio.create_task(check_pending_payments())
         
         asyncio.create_task(check_expiring_keys())
+        asyncio.create_task(run_database_maintenance())
+        if DB_BACKEND == "sqlite" and DB_BACKUP_INTERVAL_SEC > 0:
+            asyncio.create_task(run_database_backups())
         
         await dp.start_polling(bot)
         
@@ -4599,10 +7884,76 @@ async def main():
         
     finally:
         await bot.session.close()
+        await xui_api.close()
         if crypto_bot:
             await crypto_bot.close()
+        await db.close()
+
+def run_explain_command():
+    """python bot.py explain: EXPLAIN QUERY PLAN всего SQL хранилища на временной базе SQLite.
+    Завершается с кодом 1, если нашлись полные сканирования вне EXPLAIN_ALLOWED_SCANS
+    или методы, которые не удалось вызвать, - так команда годится для проверки в CI"""
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        results, errors = collect_query_plans(scratch_dir)
+    flagged = [
+        result for result in results
+        if result['error'] or set(result['full_scans']) - set(EXPLAIN_ALLOWED_SCANS)
+    ]
+    for result in flagged:
+        problem = result['error'] or f"полное сканирование {', '.join(dict.fromkeys(result['full_scans']))}"
+        print(f"❌ {result['method'] or '?'}: {problem}\n   {' '.join(result['sql'].split())}")
+        for line in result['plan']:
+            print(f"     {line}")
+    for error in errors:
+        print(f"❌ Не удалось вызвать {error}")
+    print(f"{'❌' if flagged or errors else '✅'} Проверено запросов: {len(results)}, "
+          f"с полным сканированием: {len(flagged)}, ошибок вызова: {len(errors)}")
+    sys.exit(1 if flagged or errors else 0)
+
+def run_vacuum_command():
+    """python bot.py vacuum: перевод базы в auto_vacuum=INCREMENTAL при остановленном боте"""
+    if DB_BACKEND != "sqlite":
+        print("❌ Команда нужна только для DB_BACKEND=sqlite")
+        sys.exit(2)
+    # Соединения, открытые при импорте модуля, закрываются до VACUUM
+    asyncio.run(db.close())
+    print(f"⏳ VACUUM {DB_PATH}...")
+    if enable_incremental_vacuum(DB_PATH):
+        print("✅ База переведена в auto_vacuum=INCREMENTAL")
+    else:
+        print("✅ База уже в режиме auto_vacuum=INCREMENTAL")
+
+def run_backup_command(args: List[str]):
+    """python bot.py backup | verify <архив> | restore <архив>"""
+    command = args[0]
+    if DB_BACKEND != "sqlite":
+        print("❌ Резервные копии поддерживаются только для DB_BACKEND=sqlite")
+        sys.exit(2)
+    if command == "backup":
+        print(f"✅ Копия создана: {create_backup()}")
+    elif command == "verify" and len(args) == 2:
+        problems = verify_backup(args[1])
+        print("✅ Копия цела" if not problems else "❌ Ошибки integrity_check:\n" + "\n".join(problems[:20]))
+        sys.exit(1 if problems else 0)
+    elif command == "restore" and len(args) == 2:
+        # Соединения, открытые при импорте модуля, закрываются до замены файла
+        asyncio.run(db.close())
+        previous_path = restore_backup(args[1])
+        print(f"✅ База восстановлена из {args[1]}, прежняя сохранена в {previous_path}")
+    else:
+        print("Использование: python bot.py backup | verify <архив> | restore <архив>")
+        sys.exit(2)
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in ("backup", "verify", "restore"):
+        run_backup_command(sys.argv[1:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "vacuum":
+        run_vacuum_command()
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "explain":
+        run_explain_command()
+    
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
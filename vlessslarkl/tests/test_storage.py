@@ -0,0 +1,340 @@
+"""Контракт хранилища: одни и те же проверки для SQLite (AsyncDatabase) и PostgresDatabase"""
+import asyncio
+import inspect
+from datetime import datetime, timedelta
+
+import pytest
+
+import bot
+from conftest import TEST_DATABASE_URL, BlockingStorage
+
+INTERFACE = bot.storage_interface()
+# Образцовые вызовы, которым нужно подготовленное состояние кроме sample_seed_calls()
+CALL_PREREQUISITES = {
+    'fulfill_crypto_payment': [('claim_crypto_payment', ('explain-1',))],
+    'reject_withdrawal': [('withdraw_referral_balance', (1, 1.0, 'explain'))],
+    'transition_withdrawal': [('withdraw_referral_balance', (1, 1.0, 'explain'))],
+}
+
+
+def seed(storage):
+    for name, args, kwargs in bot.sample_seed_calls():
+        getattr(storage, name)(*args, **kwargs)
+
+
+def required_parameters(method):
+    return [
+        parameter.name for parameter in inspect.signature(method).parameters.values()
+        if parameter.default is parameter.empty and parameter.name != 'self'
+        and parameter.kind not in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD)
+    ]
+
+
+@pytest.mark.parametrize('name', INTERFACE)
+def test_postgres_implements_method(name):
+    method = getattr(bot.PostgresDatabase, name, None)
+    assert method is not None, f"PostgresDatabase не реализует {name}"
+    assert inspect.iscoroutinefunction(method)
+    assert required_parameters(method) == required_parameters(getattr(bot.Database, name))
+    # Необязательные параметры Database должны приниматься и PostgresDatabase
+    assert set(inspect.signature(getattr(bot.Database, name)).parameters) <= set(inspect.signature(method).parameters)
+
+
+@pytest.mark.parametrize('name,arguments', bot.storage_calls(), ids=lambda value: value if isinstance(value, str) else '')
+def test_method_runs(storage, name, arguments):
+    seed(storage)
+    for prerequisite, args in CALL_PREREQUISITES.get(name, []):
+        getattr(storage, prerequisite)(*args)
+    method = getattr(storage, name)
+    if bot.is_page_method(getattr(bot.Database, name)):
+        page = method(**arguments, limit=1)
+        assert len(page.items) == 1 and page.next_key
+        following = method(**arguments, key=page.next_key, limit=1)
+        assert len(following.items) == 1
+        assert method(**arguments, key=following.prev_key, backward=True, limit=1).items == page.items
+    else:
+        method(**arguments)
+
+
+def test_explain_statements(storage):
+    seed(storage)
+    bot.query_stats.clear_statements()
+    for name, arguments in bot.storage_calls():
+        for prerequisite, args in CALL_PREREQUISITES.get(name, []):
+            getattr(storage, prerequisite)(*args)
+        getattr(storage, name)(**arguments)
+    results = storage.explain_statements()
+    assert len(results) > 50
+    assert [(result['sql'], result['error']) for result in results if result['error']] == []
+
+
+
+def test_slow_query_log_has_no_parameter_values(storage, monkeypatch, caplog):
+    monkeypatch.setattr(bot, 'DB_SLOW_QUERY_MS', 0)
+    with caplog.at_level('WARNING'):
+        storage.add_host('nl', 'https://nl.example:54321', 'admin', 'panel-secret', 1)
+        storage.get_host('nl')
+
+    slow = [record.getMessage() for record in caplog.records if 'Медленный запрос' in record.getMessage()]
+    assert slow
+    assert not [message for message in slow if 'panel-secret' in message or 'nl.example' in message]
+
+def test_users(storage):
+    storage.register_user(1, 'alice', 'Alice')
+    storage.register_user(2, 'bob', 'Bob', referrer_id=1)
+    storage.register_user(2, 'bob', 'Bob again', referrer_id=1)
+
+    user = storage.get_user(2)
+    assert isinstance(user, bot.UserRow)
+    assert (user.username, user.full_name, user.referred_by, user.is_banned) == ('bob', 'Bob', 1, False)
+    assert storage.get_user(3) is None
+    assert storage.get_user_count() == 2
+    assert storage.get_today_users() == 2
+
+    storage.update_user_profile(2, 'bobby', 'Bob B')
+    assert storage.get_user(2).username == 'bobby'
+    storage.update_user_stats(2, 150.0, 3)
+    storage.set_trial_used(2)
+    user = storage.get_user(2)
+    assert (user.total_spent, user.total_months, user.trial_used) == (150.0, 3, True)
+
+    storage.ban_user(2)
+    assert [user.telegram_id for user in storage.get_banned_users()] == [2]
+    assert [user.telegram_id for user in storage.get_active_users()] == [1]
+    assert (storage.get_banned_users_count(), storage.get_active_users_count()) == (1, 1)
+    storage.unban_user(2)
+    assert storage.get_banned_users_count() == 0
+
+    assert [user.telegram_id for user in storage.get_referrals(1)] == [2]
+    assert storage.get_referral_count(1) == 1
+    counts = storage.get_user_with_counts(1)
+    assert (counts.key_count, counts.referral_count) == (0, 1)
+
+
+def test_search_users(storage):
+    storage.register_user(1, 'alice', 'Alice Liddell')
+    storage.register_user(2, 'bob', 'Bob')
+    storage.add_key(2, 'nl', 'a3bb189e-8bf9-3888-9912-ace4e6543002', 'bob-key@example.vpn', datetime(2030, 1, 1))
+
+    assert [user.telegram_id for user in storage.search_users('2')] == [2]
+    assert [user.telegram_id for user in storage.search_users('@al')] == [1]
+    assert [user.telegram_id for user in storage.search_users('iddel')] == [1]
+    assert [user.telegram_id for user in storage.search_users('bob-key')] == [2]
+    assert [user.telegram_id for user in storage.search_users('vless://A3BB189E-8BF9-3888-9912-ACE4E6543002@host')] == [2]
+    assert storage.search_users('100%_') == []
+
+
+def test_keys(storage):
+    storage.register_user(1, 'alice', 'Alice')
+    soon = datetime.now() + timedelta(days=3, hours=1)
+    later = datetime.now() + timedelta(days=30, hours=1)
+    first = storage.add_key(1, 'nl', 'uuid-1', 'one@example.vpn', later)
+    second = storage.add_key(1, 'nl', 'uuid-2', 'two@example.vpn', soon)
+    assert isinstance(first, int) and second != first
+
+    keys = storage.get_user_keys(1)
+    assert {key.key_id for key in keys} == {first, second}
+    assert len(storage.get_user_keys(1, limit=1)) == 1
+    key = storage.get_key_by_id(second)
+    assert isinstance(key, bot.KeyRow)
+    assert (key.key_email, key.days_left, key.is_expired) == ('two@example.vpn', 3, False)
+    assert storage.get_next_key_number(1) == 3
+    assert [key.key_id for key in storage.get_expiring_keys(7)] == [second]
+    assert storage.get_active_keys_count() == 2
+    assert storage.get_total_keys_count() == 2
+
+    storage.update_key_expiry(second, datetime.now() - timedelta(days=1))
+    assert storage.get_key_by_id(second).is_expired
+    assert [key.key_id for key in storage.get_active_user_keys(1)] == [first]
+    context = storage.get_user_context(1)
+    assert (context['key_count'], context['active_key_count'], context['user'].telegram_id) == (2, 1, 1)
+
+    storage.delete_key(first)
+    assert storage.get_key_by_id(first) is None
+    storage.delete_user_keys(1)
+    assert storage.get_user_keys(1) == []
+    assert storage.get_total_keys_count() == 0
+
+
+def test_crypto_payment_is_fulfilled_once(storage):
+    storage.register_user(1, 'alice', 'Alice')
+    storage.register_user(2, 'bob', 'Bob', referrer_id=1)
+    storage.add_host('nl', 'https://nl.example:54321', 'admin', 'secret', 1)
+    storage.add_plan('nl', 'Month', 1, 200.0)
+    plan_id = storage.get_plans_for_host('nl')[0].plan_id
+    storage.create_crypto_payment('inv-1', 2, plan_id, 2.5, 'USDT', {'months': 1})
+
+    payment = storage.get_crypto_payment('inv-1')
+    assert isinstance(payment, bot.PaymentRow)
+    assert (payment.status, payment.metadata) == ('pending', {'months': 1})
+    assert [payment.invoice_id for payment in storage.get_pending_payments()] == ['inv-1']
+    assert storage.get_stats_summary()['pending_payments'] == 1
+
+    with pytest.raises(ValueError):
+        storage.fulfill_crypto_payment('inv-1', 'nl', 'uuid-1', 'bob@example.vpn', datetime(2030, 1, 1), 1, 200.0)
+    assert storage.claim_crypto_payment('inv-1')
+    assert not storage.claim_crypto_payment('inv-1')
+    storage.update_crypto_payment_metadata('inv-1', {'months': 1, 'xui_client': {'client_uuid': 'uuid-1'}})
+    key_id = storage.fulfill_crypto_payment('inv-1', 'nl', 'uuid-1', 'bob@example.vpn',
+                                            datetime(2030, 1, 1), 1, 200.0, referral_percentage=10)
+
+    payment = storage.get_crypto_payment('inv-1')
+    assert (payment.status, payment.key_id) == ('paid', key_id)
+    assert payment.metadata['xui_client'] == {'client_uuid': 'uuid-1'}
+    assert storage.get_key_by_id(key_id).user_id == 2
+    assert storage.get_user(2).total_spent == 200.0
+    assert storage.get_user(1).referral_balance == 20.0
+    assert storage.get_total_revenue() == 200.0
+    assert storage.get_today_revenue() == 200.0
+    assert storage.get_revenue_stats(7)[0]['revenue'] == 200.0
+    assert [transaction['status'] for transaction in storage.get_user_transactions(2)] == ['paid']
+    assert [payment.invoice_id for payment in storage.get_payments_by_status('paid')] == ['inv-1']
+    assert storage.get_stats_summary()['pending_payments'] == 0
+    assert not storage.claim_crypto_payment('inv-1')
+
+
+
+def test_error_payments_are_retried_with_backoff(storage):
+    storage.register_user(1, 'alice', 'Alice')
+    storage.add_host('nl', 'https://nl.example:54321', 'admin', 'secret', 1)
+    storage.add_plan('nl', 'Month', 1, 200.0)
+    plan_id = storage.get_plans_for_host('nl')[0].plan_id
+    storage.create_crypto_payment('inv-1', 1, plan_id, 2.5, 'USDT', {'price_rub': 200.0})
+    assert storage.claim_crypto_payment('inv-1')
+    storage.update_crypto_payment_status('inv-1', 'error')
+
+    assert storage.get_pending_payments() == []
+    [payment] = storage.get_pending_payments(include_errors=True)
+    assert payment.status == 'error'
+    assert bot.payment_retry_due(payment, now=0)
+
+    assert storage.claim_crypto_payment('inv-1')
+    storage.update_crypto_payment_metadata('inv-1', dict(payment.metadata, retry={'attempts': 1, 'next_ts': 1000}))
+    storage.update_crypto_payment_status('inv-1', 'error')
+    [payment] = storage.get_pending_payments(include_errors=True)
+    assert payment.metadata == {'price_rub': 200.0, 'retry': {'attempts': 1, 'next_ts': 1000}}
+    assert not bot.payment_retry_due(payment, now=999)
+    assert bot.payment_retry_due(payment, now=1000)
+
+    payment.metadata['retry']['attempts'] = bot.PAYMENT_RETRY_LIMIT
+    assert not bot.payment_retry_due(payment, now=1000)
+
+def test_withdrawal_is_rejected_once(storage):
+    storage.register_user(1, 'alice', 'Alice')
+    storage.add_referral_balance(1, 300.0)
+    withdrawal_id = storage.withdraw_referral_balance(1, 200.0, 'card 0000')
+    assert storage.get_user(1).referral_balance == 100.0
+    assert storage.get_withdrawal(withdrawal_id)['status'] == 'pending'
+    assert [row['withdrawal_id'] for row in storage.get_referral_withdrawals('pending')] == [withdrawal_id]
+
+    assert storage.reject_withdrawal(withdrawal_id, 'wrong card')['amount'] == 200.0
+    assert storage.reject_withdrawal(withdrawal_id, 'wrong card') is None
+    assert storage.get_user(1).referral_balance == 300.0
+    assert not storage.transition_withdrawal(withdrawal_id, 'pending', 'completed')
+    assert storage.get_withdrawal(withdrawal_id)['status'] == 'rejected'
+
+
+def test_settings(storage):
+    storage.update_setting('support_user', '@help')
+    assert storage.get_setting('support_user') == '@help'
+    assert storage.sync.get_setting('support_user') == '@help'
+    assert storage.get_all_settings()['support_user'] == '@help'
+    storage.delete_setting('support_user')
+    assert storage.get_setting('support_user', 'none') == 'none'
+    storage.reload_settings()
+
+
+def test_catalog(storage):
+    storage.add_host('nl', 'https://nl.example:54321', 'admin', 'secret', 1)
+    storage.add_host('de', 'https://de.example:54321', 'admin', 'secret', 2)
+    storage.update_host('de', host_inbound_id=3)
+    host = storage.get_host('de')
+    assert isinstance(host, bot.HostRow) and host.host_inbound_id == 3
+    assert storage.get_host_by_id(host.host_id) == host
+    assert storage.get_hosts_count() == 2
+
+    storage.add_plan('nl', 'Month', 1, 200.0)
+    storage.add_plan('nl', 'Year', 12, 2000.0)
+    plans = storage.get_plans_for_host('nl')
+    assert [plan.plan_name for plan in plans] == ['Month', 'Year']
+    storage.update_plan(plans[0].plan_id, price=250.0)
+    assert storage.get_plan_by_id(plans[0].plan_id).price == 250.0
+    storage.delete_plan(plans[1].plan_id)
+    assert storage.get_plans_count() == 1
+
+    storage.delete_host('de')
+    assert not storage.get_host('de').is_active
+    assert [host.host_name for host in storage.get_all_hosts()] == ['nl']
+    storage.reload_catalog()
+    assert len(storage.get_all_plans()) == 1
+
+
+def test_pages(storage):
+    for telegram_id in range(1, 6):
+        storage.register_user(telegram_id, f'user{telegram_id}', 'User', referrer_id=1 if telegram_id > 1 else None)
+        storage.log_transaction(f'user{telegram_id}', telegram_id, 'paid', 100.0, 'CryptoBot', {})
+        storage.log_admin_action(1, 'test', str(telegram_id))
+
+    for method, arguments in (('get_users_page', {}), ('get_referrals_page', {'referrer_id': 1}),
+                              ('get_transactions_page', {}), ('get_admin_logs_page', {})):
+        method = getattr(storage, method)
+        pages = [method(**arguments, limit=2)]
+        while pages[-1].next_key:
+            pages.append(method(**arguments, key=pages[-1].next_key, limit=2))
+        items = [item for page in pages for item in page.items]
+        assert len(items) == (4 if 'referrer_id' in arguments else 5)
+        assert len({repr(item) for item in items}) == len(items)
+        assert method(**arguments, key=pages[1].prev_key, backward=True, limit=2).items == pages[0].items
+
+
+def test_support_and_broadcasts(storage):
+    storage.register_user(1, 'alice', 'Alice')
+    message_id = storage.create_support_message(1, 'help')
+    assert [message['message_id'] for message in storage.get_support_messages('open')] == [message_id]
+    storage.update_support_message(message_id, 'closed', 'done')
+    assert storage.get_support_messages('open') == []
+
+    broadcast_id = storage.create_broadcast(1, 'news', 10)
+    storage.update_broadcast_stats(broadcast_id, sent=9, failed=1, status='completed')
+    broadcast = storage.get_broadcasts()[0]
+    assert (broadcast['sent_count'], broadcast['failed_count'], broadcast['status']) == (9, 1, 'completed')
+
+
+def test_archive_batch_moves_old_rows(storage):
+    storage.register_user(1, 'alice', 'Alice')
+    for number in range(3):
+        storage.log_admin_action(1, 'test', str(number))
+    storage.execute("UPDATE admin_logs SET created_at = '2000-01-01 00:00:00' WHERE details <> '2'")
+
+    assert storage.archive_batch('admin_logs', batch_size=1) == 1
+    assert storage.archive_batch('admin_logs') == 1
+    assert storage.archive_batch('admin_logs') == 0
+    assert [log['details'] for log in storage.get_admin_logs_page().items] == ['2']
+    storage.clear_admin_logs()
+    assert storage.get_admin_logs_page().items == []
+
+
+def test_pg_placeholders():
+    assert bot.pg_placeholders("SELECT * FROM t WHERE a = ? AND b > ?") == "SELECT * FROM t WHERE a = $1 AND b > $2"
+    assert bot.pg_placeholders("SELECT '?', 'it''s ?', \"col?\" FROM t WHERE a = ?") == \
+        "SELECT '?', 'it''s ?', \"col?\" FROM t WHERE a = $1"
+    assert bot.pg_placeholders("SELECT 1 -- why?\nFROM t WHERE (a, b) < (?, ?)") == \
+        "SELECT 1 -- why?\nFROM t WHERE (a, b) < ($1, $2)"
+
+
+def test_postgres_instances_share_caches(storage):
+    if not isinstance(storage.storage, bot.PostgresDatabase):
+        pytest.skip("кэши между экземплярами синхронизирует только PostgreSQL")
+    other = BlockingStorage(bot.PostgresDatabase(TEST_DATABASE_URL), storage.loop)
+    other.connect()
+    try:
+        storage.update_setting('support_user', '@help')
+        storage.add_host('nl', 'https://nl.example:54321', 'admin', 'secret', 1)
+        for _ in range(50):
+            if other.sync.get_setting('support_user') == '@help' and other.get_host('nl'):
+                break
+            storage.loop.run_until_complete(asyncio.sleep(0.05))
+        assert other.sync.get_setting('support_user') == '@help'
+        assert other.get_host('nl').host_url == 'https://nl.example:54321'
+    finally:
+        other.close()
@@ -0,0 +1,99 @@
+"""Запись клиентов X-UI на поддельной панели вместо HTTP-запросов"""
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import bot
+
+HOST = bot.HostRow(host_id=1, host_name="test", host_url="https://panel.example:2053",
+                   host_username="admin", host_pass="secret", host_inbound_id=7)
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def ms(moment: datetime) -> int:
+    return int(moment.timestamp() * 1000)
+
+
+class FakePanel:
+    """Клиенты одного инбаунда и записанные запросы; updateClient заменяет клиента целиком, как 3x-ui"""
+
+    def __init__(self, monkeypatch, clients):
+        self.api = bot.XUIAPI()
+        monkeypatch.setattr(self.api, "_make_request", self.request)
+        self.clients = {client['id']: dict(client) for client in clients}
+        self.calls = []
+
+    async def request(self, host_url, path, method="GET", data=None, username=None, password=None):
+        self.calls.append((method, path))
+        if path == f"/panel/api/inbounds/get/{HOST.host_inbound_id}":
+            settings = json.dumps({"clients": list(self.clients.values())})
+            return True, {"success": True, "obj": {"id": HOST.host_inbound_id, "settings": settings}}
+        if path.startswith("/panel/api/inbounds/updateClient/"):
+            client_id = path.rsplit("/", 1)[1]
+            if client_id not in self.clients:
+                return True, {"success": False, "msg": "Client not found"}
+            [client] = json.loads(data['settings'])['clients']
+            self.clients[client_id] = client
+            return True, {"success": True}
+        return False, f"HTTP 404: {path}"
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def client(client_id, expiry, **fields):
+    return {"id": client_id, "email": f"{client_id}@test", "enable": True, "flow": "xtls-rprx-vision",
+            "totalGB": 0, "expiryTime": expiry, "limitIp": 0, "fingerprint": "chrome", "tgId": "", "subId": "",
+            **fields}
+
+
+def extend(loop, panel, client_id, days):
+    return loop.run_until_complete(panel.api.update_client_expiry(HOST, client_id, f"{client_id}@test", days))
+
+
+def test_extend_keeps_client_fields(monkeypatch, loop):
+    expiry = ms(datetime.now() + timedelta(days=3))
+    limited = client("limited", expiry, enable=False, flow="", totalGB=50 * 1024 ** 3, limitIp=2,
+                     tgId="12345", subId="sub-limited")
+    panel = FakePanel(monkeypatch, [limited])
+
+    result = extend(loop, panel, "limited", 30)
+
+    assert result['success']
+    assert panel.clients["limited"] == {**limited, "expiryTime": expiry + 30 * DAY_MS}
+    assert result['expiry_date'] == datetime.fromtimestamp((expiry + 30 * DAY_MS) / 1000)
+
+
+def test_extend_enables_expired_client(monkeypatch, loop):
+    expiry = ms(datetime.now() - timedelta(days=1))
+    panel = FakePanel(monkeypatch, [client("expired", expiry, enable=False, limitIp=1)])
+
+    assert extend(loop, panel, "expired", 30)['success']
+    assert panel.clients["expired"]['enable'] is True
+    assert panel.clients["expired"]['limitIp'] == 1
+
+
+def test_batched_extends_fetch_inbound_once(monkeypatch, loop):
+    expiry = ms(datetime.now() + timedelta(days=1))
+    panel = FakePanel(monkeypatch, [client("first", expiry), client("second", expiry)])
+
+    async def extend_together():
+        return await asyncio.gather(
+            panel.api.update_client_expiry(HOST, "first", "first@test", 10),
+            panel.api.update_client_expiry(HOST, "first", "first@test", 5),
+            panel.api.update_client_expiry(HOST, "second", "second@test", 1),
+            panel.api.update_client_expiry(HOST, "missing", "missing@test", 1),
+        )
+    first, first_again, second, missing = loop.run_until_complete(extend_together())
+
+    assert first['success'] and first == first_again and second['success']
+    assert missing == {"error": "Client not found"}
+    assert panel.clients["first"]['expiryTime'] == expiry + 15 * DAY_MS
+    assert panel.clients["second"]['expiryTime'] == expiry + DAY_MS
+    assert [call for call in panel.calls if call[0] == "GET"] == [("GET", "/panel/api/inbounds/get/7")]